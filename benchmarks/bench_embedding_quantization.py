@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Resident size, gather time and eval accuracy of the frozen embedding
+tables for each --embedding_quantization mode.
+
+Takes the flags of an eval only run of run_entity_linking.py, e.g.
+
+python benchmarks/bench_embedding_quantization.py --eval_only_mode --load_best \
+    --ckpt_path CKPT --eval_data ... --candidates_file ... --word_embedding_file ...
+"""
+import os
+import sys
+import time
+
+import gflags
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncel.models.base import get_flags, flag_defaults, log_path
+from ncel.models.base import load_data_and_embeddings, init_model, quantizeEmbeddings
+from ncel.models.entity_linking import evaluate
+from ncel.utils import afs_safe_logger
+from ncel.utils.Candidates import getCandidateHandler
+from ncel.utils.layers import EMBEDDING_QUANTIZATION
+from ncel.utils.logging import create_log_formatter
+from ncel.utils.trainer import ModelTrainer
+import ncel.utils.logging_pb2 as pb
+
+FLAGS = gflags.FLAGS
+
+GATHER_ROWS = 100000
+
+def gather_time(emb):
+    idx = np.random.randint(0, emb.shape[0], size=GATHER_ROWS)
+    start = time.time()
+    emb.take(idx, axis=0)
+    return time.time() - start
+
+def run():
+    logger = afs_safe_logger.ProtoLogger(
+        log_path(FLAGS), print_formatter=create_log_formatter(), write_proto=False)
+    FLAGS.embedding_quantization = "none"
+    vocabulary, initial_embeddings, _, eval_iterators, _, base_feature_dim = \
+        load_data_and_embeddings(FLAGS, logger, getCandidateHandler())
+
+    results = []
+    for dtype in EMBEDDING_QUANTIZATION:
+        embeddings = initial_embeddings if dtype == "none" else quantizeEmbeddings(initial_embeddings, dtype)
+        nbytes = sum([emb.nbytes for emb in embeddings if emb is not None])
+        gather = sum([gather_time(emb) for emb in embeddings if emb is not None])
+
+        model = init_model(FLAGS, base_feature_dim, embeddings, logger)
+        # restores the checkpoint given by --ckpt_path
+        ModelTrainer(model, logger, 1, vocabulary, FLAGS)
+        log_entry = pb.NcelEntry()
+        mi_precs = []
+        for index, eval_set in enumerate(eval_iterators):
+            metrics = evaluate(FLAGS, model, eval_set, log_entry, logger,
+                               vocabulary=vocabulary, eval_index=index)
+            mi_precs.append(metrics[2])
+        results.append((dtype, nbytes, gather, mi_precs))
+
+    _, base_bytes, _, base_precs = results[0]
+    for dtype, nbytes, gather, mi_precs in results:
+        logger.Log("{:8s} {:10.1f}MB ({:.2f}x) gather {} rows: {:.3f}s, mi_prec: {}".format(
+            dtype, nbytes / 2.0**20, base_bytes / float(nbytes), GATHER_ROWS, gather,
+            ", ".join(["{:.4f} ({:+.4f})".format(p, p - b) for p, b in zip(mi_precs, base_precs)])))
+
+if __name__ == '__main__':
+    get_flags()
+    FLAGS(sys.argv)
+    flag_defaults(FLAGS)
+    run()
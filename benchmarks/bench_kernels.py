@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Time of each compiled kernel in ncel/utils/kernels.py against its NumPy
+fallback, on random inputs of the sizes given by the flags.
+
+python benchmarks/bench_kernels.py --nodes 200 --dim 300 --repeats 20
+"""
+import os
+import sys
+import time
+
+import gflags
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+start = time.time()
+from ncel.utils import kernels
+IMPORT_TIME = time.time() - start
+
+FLAGS = gflags.FLAGS
+
+def best_time(fn, *args):
+    fn(*args)
+    times = []
+    for _ in range(FLAGS.repeats):
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def report(name, kernel, fallback, args):
+    diff = np.max(np.abs(np.asarray(kernel(*args), dtype=np.float64) -
+                         np.asarray(fallback(*args), dtype=np.float64)))
+    t_kernel = best_time(kernel, *args)
+    t_fallback = best_time(fallback, *args)
+    print("{:24s} kernel {:9.3f}ms numpy {:9.3f}ms ({:5.2f}x) max diff {:.2e}".format(
+        name, t_kernel * 1000, t_fallback * 1000, t_fallback / max(t_kernel, 1e-9), diff))
+
+def cosine_pairs(cos, embeds):
+    return [cos(embeds[i], embeds[i+1]) for i in range(len(embeds) - 1)]
+
+def run():
+    print("kernels module import (numba {}): {:.3f}s".format(
+        kernels.numba.__version__ if kernels.numba is not None else "missing", IMPORT_TIME))
+    rng = np.random.RandomState(0)
+    for dtype in [np.float32, np.float64]:
+        embeds = rng.randn(FLAGS.nodes, FLAGS.dim).astype(dtype)
+        adj = np.abs(embeds.dot(embeds.T))
+        suffix = np.dtype(dtype).name
+        report("cosineSimilarity " + suffix,
+               lambda e: cosine_pairs(kernels.cosineSimilarity, e),
+               lambda e: cosine_pairs(kernels.cosineSimilarityNumpy, e), (embeds,))
+        report("normalizeAdjacency " + suffix, kernels.normalizeAdjacency,
+               kernels.normalizeAdjacencyNumpy, (adj,))
+        report("fullGraph " + suffix, kernels.fullGraph, kernels.fullGraphNumpy,
+               (embeds, dtype(FLAGS.threshold)))
+
+if __name__ == '__main__':
+    gflags.DEFINE_integer("nodes", 200, "Candidate nodes of a document graph.")
+    gflags.DEFINE_integer("dim", 300, "Embedding dimension.")
+    gflags.DEFINE_float("threshold", 0.0, "Similarity threshold of fullGraph.")
+    gflags.DEFINE_integer("repeats", 20, "Timed calls per kernel, the fastest is reported.")
+    FLAGS(sys.argv)
+    run()
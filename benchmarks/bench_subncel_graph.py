@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Time and peak memory of SUBNCEL.buildGraph against the expand/concat
+graph it replaces, for each cand_num and neighbor_cand_window of the flags.
+Both adjacencies are checked to be bitwise equal.
+
+python benchmarks/bench_subncel_graph.py --mentions 64 --cand_nums 5,10,20 --windows 1,3
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import gflags
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncel.models.subncel import SUBNCEL
+
+FLAGS = gflags.FLAGS
+
+# buildGraph before the gathered neighbor index
+def expand_graph(model, cand_emb, window, num_mentions, thred=0.0):
+    batch_size, cand_num = num_mentions.shape
+    neigh_cands = model.getNeighCandidates(cand_emb, window, num_mentions)
+    cand_emb_expand = cand_emb.unsqueeze(1).expand(batch_size * cand_num,
+                                                   2*window*cand_num, model._dim)
+    adj = torch.clamp(F.cosine_similarity(cand_emb_expand, neigh_cands, dim=2), thred, 1)
+    if thred > 0.0:
+        adj[adj<=thred]=0.0
+    margin_col = torch.ones(batch_size*cand_num, 1)
+    adj = torch.cat((adj*model._rho, margin_col), dim=1)
+    return F.normalize(adj, p=1, dim=1)
+
+def new_graph(model, cand_emb, window, num_mentions, thred=0.0):
+    return model.buildGraph(cand_emb, window, num_mentions, thred=thred).data
+
+def make_inputs(cand_num):
+    rng = np.random.RandomState(0)
+    # documents of ten mentions
+    num_mentions = np.ones((FLAGS.mentions, cand_num), dtype=np.int64)
+    num_mentions[9::10] = 0
+    cand_emb = torch.from_numpy(rng.randn(FLAGS.mentions * cand_num, FLAGS.dim).astype(np.float32))
+    return cand_emb, num_mentions
+
+# the child is forked, so it inherits the model
+_memory_job = None
+
+# MB the peak resident size grows by while running, measured in a forked child
+def _peak_memory(_):
+    fn, model, cand_num, window = _memory_job
+    cand_emb, num_mentions = make_inputs(cand_num)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(model, cand_emb, window, num_mentions, FLAGS.threshold)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.0
+
+def peak_memory(fn, model, cand_num, window):
+    global _memory_job
+    _memory_job = (fn, model, cand_num, window)
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        return pool.apply(_peak_memory, (None,))
+
+def best_time(fn, *args):
+    times = []
+    for _ in range(FLAGS.repeats):
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def run():
+    rng = np.random.RandomState(0)
+    embeddings = [rng.randn(2, FLAGS.dim).astype(np.float32) for _ in range(4)]
+    model = SUBNCEL(1, embeddings, mlp_layers_dim=[2, 1], rho=0.1)
+    for cand_num in [int(n) for n in FLAGS.cand_nums]:
+        for window in [int(w) for w in FLAGS.windows]:
+            cand_emb, num_mentions = make_inputs(cand_num)
+            args = (model, cand_emb, window, num_mentions, FLAGS.threshold)
+            equal = np.array_equal(expand_graph(*args).numpy().view(np.int32),
+                                   new_graph(*args).numpy().view(np.int32))
+            t_expand = best_time(expand_graph, *args)
+            t_new = best_time(new_graph, *args)
+            m_expand = peak_memory(expand_graph, model, cand_num, window)
+            m_new = peak_memory(new_graph, model, cand_num, window)
+            print("cand_num {:3d} window {:2d}: expand {:9.2f}ms {:9.1f}MB  gather {:9.2f}ms {:9.1f}MB  "
+                  "bitwise equal {}".format(cand_num, window, t_expand * 1000, m_expand,
+                                            t_new * 1000, m_new, equal))
+
+if __name__ == '__main__':
+    gflags.DEFINE_integer("mentions", 64, "Mentions in a batch.")
+    gflags.DEFINE_list("cand_nums", ["5", "10", "20"], "Candidates per mention.")
+    gflags.DEFINE_list("windows", ["1", "3"], "Neighbor mentions on each side.")
+    gflags.DEFINE_integer("dim", 300, "Embedding dimension.")
+    gflags.DEFINE_float("threshold", 0.9, "Similarity threshold of the graph.")
+    gflags.DEFINE_integer("repeats", 3, "Timed calls per graph, the fastest is reported.")
+    FLAGS(sys.argv)
+    run()
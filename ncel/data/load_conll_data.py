@@ -4,25 +4,24 @@ import re
 
 DOC_GENRE = ('testa', 'testb', 'train')
 
+# reads the file lazily, only lines of documents in the split are kept
 def _CoNLLFileToDocIterator(fname, split='testa'):
-    f = open(fname,'r')
-    lines = f.readlines()
-
     curdocName = None
     curdocSplit = None
     curdoc = None
 
-    for line in lines:
-        line = line.strip()
-        if line.startswith('-DOCSTART-'):
-            if curdocName is not None and curdocSplit == split:
-                yield (curdoc, curdocName)
-            sp = line.split(' ')
-            curdocName = sp[2][:-1]
-            curdocSplit = DOC_GENRE[0] if sp[1].endswith(DOC_GENRE[0]) else (DOC_GENRE[1] if sp[1].endswith(DOC_GENRE[1]) else DOC_GENRE[2])
-            curdoc = []
-        else:
-            curdoc.append(line)
+    with open(fname,'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('-DOCSTART-'):
+                if curdocName is not None and curdocSplit == split:
+                    yield (curdoc, curdocName)
+                sp = line.split(' ')
+                curdocName = sp[2][:-1]
+                curdocSplit = DOC_GENRE[0] if sp[1].endswith(DOC_GENRE[0]) else (DOC_GENRE[1] if sp[1].endswith(DOC_GENRE[1]) else DOC_GENRE[2])
+                curdoc = []
+            elif curdocSplit == split:
+                curdoc.append(line)
     if curdocName is not None and curdocSplit == split:
         yield (curdoc, curdocName)
 
@@ -45,7 +44,7 @@ class CoNLLIterator:
             for line in doc_lines:
                 if len(line) == 0:
                     # sentence boundary.
-                    doc.sentences.append(sent)
+                    doc.endSentence()
                     sent = []
                     continue
                 t = line.split('\t')
@@ -78,16 +77,20 @@ class CoNLLIterator:
             for mention in doc.mentions:
                 yield mention
 
-def load_data(text_path=None, mention_file=None, supplement=None,
-              include_unresolved=False, lowercase=False, wiki_entity_file=None):
+def iter_data(text_path=None, mention_file=None, supplement=None,
+              include_unresolved=False, lowercase=False, wiki_entity_file=None, num_workers=1):
     assert not isinstance(mention_file, type(None)), "conll data requires mention file!"
     print("Loading", mention_file)
     if supplement is None or supplement not in [0, 1, 2]: supplement=0
-    docs = []
     doc_iter = CoNLLIterator(mention_file, genre=supplement, include_unresolved = include_unresolved, lowercase=lowercase)
     for doc in doc_iter.documents():
-        docs.append(doc)
-    return docs
+        yield doc
+
+def load_data(text_path=None, mention_file=None, supplement=None,
+              include_unresolved=False, lowercase=False, wiki_entity_file=None, num_workers=1):
+    return list(iter_data(text_path=text_path, mention_file=mention_file, supplement=supplement,
+                          include_unresolved=include_unresolved, lowercase=lowercase,
+                          wiki_entity_file=wiki_entity_file, num_workers=num_workers))
 
 if __name__ == "__main__":
     # Demo:
@@ -5,16 +5,15 @@ from ncel.utils.misc import loadWikiVocab
 import os
 import re
 
-def _WnedFileToDocIterator(fpath):
-    doc_name = None
-
-    files = os.listdir(fpath)
-    for fname in files:
+# [(doc_name, file_path), ...] of the raw files to parse, in directory order
+def _WnedDocFiles(fpath, doc_names=None):
+    doc_files = []
+    for fname in os.listdir(fpath):
         postfix_inf = fname.rfind(r'.')
         doc_name = fname if postfix_inf == -1 else fname[:postfix_inf]
-        f = open(os.path.join(fpath, fname), 'r')
-        lines = f.readlines()
-        yield (doc_name, lines)
+        if doc_names is not None and doc_name not in doc_names: continue
+        doc_files.append((doc_name, os.path.join(fpath, fname)))
+    return doc_files
 
 en_punctuation = " \'\",:()\-\n"
 zh_punctuation = " ·＂＃＄％＆＇（）＊＋，－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏"
@@ -45,113 +44,132 @@ class WnedDataLoader(xmlHandler):
 
         return sent
 
-    def documents(self):
-        all_mentions = dict()
+    def documents(self, num_workers=1):
+        self._all_mentions = dict()
         for (doc_name, mentions) in self.process(self._m_fname):
             postfix_inf = doc_name.rfind(r'.')
             doc_name = doc_name if postfix_inf == -1 else doc_name[:postfix_inf]
-            all_mentions[doc_name] = list(mentions)
-        i=0
-        for (doc_name, doc_lines) in _WnedFileToDocIterator(self._fpath):
-            if doc_name not in all_mentions : continue
-            # create doc mention offset index list
-            start_inx = dict()
-            end_inx = dict()
-            tmp_mentions = dict()
-            split_inx = set()
-            doc_mentions = all_mentions[doc_name]
-            for j, doc_mention in enumerate(doc_mentions):
-                # remove NIL entity
-                if not self._include_unresolved and doc_mention['wikiName'] == 'NIL': continue
-                if doc_mention['wikiName'] != 'NIL' and \
-                    not isinstance(self._wiki_label2id, type(None)) and\
-                      doc_mention['wikiName'] not in self._wiki_label2id : continue
-                wiki_id = self._wiki_label2id.get(doc_mention['wikiName'], 'NIL')
-
-                doc_start_inx = doc_mention['offset']
-                doc_end_inx = doc_mention['offset'] + doc_mention['length']
-                split_inx.add(doc_start_inx)
-                split_inx.add(doc_end_inx)
-                start_inx[doc_start_inx] = start_inx.get(doc_start_inx, [])
-                start_inx[doc_start_inx].append(j)
-                end_inx[doc_end_inx] = end_inx.get(doc_end_inx, [])
-                end_inx[doc_end_inx].append(j)
-                # [_, _, new_start_offset, new_tokens_num, has_add_to_doc]
-
-                tmp_mentions[j] = [doc_mention['mention'], doc_mention['wikiName'], wiki_id, -1, -1, False]
-
-            # skip those don't have any mention
-            if len(tmp_mentions) < 1: continue
-            # sort the slice inx
-            split_inx = sorted(split_inx)
-            split_inx_pos = 0
-            # processed line length
-            base_offset = 0
-
-            doc = Document(doc_name, i)
+            self._all_mentions[doc_name] = list(mentions)
+        jobs = _WnedDocFiles(self._fpath, self._all_mentions)
+        if num_workers > 1:
+            docs = self.parseDocumentFiles(jobs, num_workers)
+        else:
+            docs = (self.parseDocumentFile(*job) for job in jobs)
+        # ids follow the file order whether or not the files are parsed in parallel
+        i = 0
+        for doc in docs:
+            if doc is None: continue
+            doc.id = i
             i += 1
-            sent = []
-            for line in doc_lines:
-                if self.lowercase: line = line.lower()
-
-                line_offset = 0
-                line_len = len(line)
-
-                for p in split_inx[split_inx_pos:]:
-                    p -= base_offset
-                    line_slice = line[line_offset:p] if p < line_len else line[line_offset:]
-                    # process line segment, whose boundries are the annotations
-                    # update mention start index
-                    if line_offset+base_offset in start_inx:
-                        for j in start_inx[line_offset+base_offset]:
-                            tmp_mentions[j][3] = len(doc.tokens)
-                    sent = self._processLineSlice(line_slice, doc, sent)
-                    # update mention end index
-                    if p + base_offset in end_inx:
-                        for j in end_inx[p + base_offset]:
-                            if tmp_mentions[j][5]: continue
-                            tmp_mentions[j][4] = len(doc.tokens)
-                            if tmp_mentions[j][3] == -1 : continue
-                            if tmp_mentions[j][2] == 'NIL':
-                                m = Mention(doc, tmp_mentions[j][3], tmp_mentions[j][4], is_NIL=True)
-                            else:
-                                m = Mention(doc, tmp_mentions[j][3], tmp_mentions[j][4],
-                                        gold_ent_id=tmp_mentions[j][2], gold_ent_str=tmp_mentions[j][1])
-                            doc.mentions.append(m)
-                            tmp_mentions[j][5] = True
-
-                    if p >= line_len : break
-                    line_offset = p
-                    split_inx_pos += 1
-                if split_inx_pos == len(split_inx) and line_offset < line_len:
-                    sent = self._processLineSlice(line[line_offset:], doc, sent)
-                base_offset += line_len
-                if len(sent) > 0:
-                    doc.sentences.append(sent)
-                sent = []
-            for i, m in enumerate(doc.mentions):
-                doc.mentions[i].setStrAndLength()
             yield doc
 
+    def parseDocumentFile(self, doc_name, path):
+        with open(path, 'r') as f:
+            return self.parseDocument(doc_name, self._all_mentions[doc_name], f)
+
+    def parseDocument(self, doc_name, doc_mentions, doc_lines):
+        # create doc mention offset index list
+        start_inx = dict()
+        end_inx = dict()
+        tmp_mentions = dict()
+        split_inx = set()
+        for j, doc_mention in enumerate(doc_mentions):
+            # remove NIL entity
+            if not self._include_unresolved and doc_mention['wikiName'] == 'NIL': continue
+            if doc_mention['wikiName'] != 'NIL' and \
+                not isinstance(self._wiki_label2id, type(None)) and\
+                  doc_mention['wikiName'] not in self._wiki_label2id : continue
+            wiki_id = self._wiki_label2id.get(doc_mention['wikiName'], 'NIL')
+
+            doc_start_inx = doc_mention['offset']
+            doc_end_inx = doc_mention['offset'] + doc_mention['length']
+            split_inx.add(doc_start_inx)
+            split_inx.add(doc_end_inx)
+            start_inx[doc_start_inx] = start_inx.get(doc_start_inx, [])
+            start_inx[doc_start_inx].append(j)
+            end_inx[doc_end_inx] = end_inx.get(doc_end_inx, [])
+            end_inx[doc_end_inx].append(j)
+            # [_, _, new_start_offset, new_tokens_num, has_add_to_doc]
+
+            tmp_mentions[j] = [doc_mention['mention'], doc_mention['wikiName'], wiki_id, -1, -1, False]
+
+        # skip those don't have any mention
+        if len(tmp_mentions) < 1: return None
+        # sort the slice inx
+        split_inx = sorted(split_inx)
+        split_inx_pos = 0
+        # processed line length
+        base_offset = 0
+
+        # documents() numbers the parsed documents in file order
+        doc = Document(doc_name, 0)
+        sent = []
+        for line in doc_lines:
+            if self.lowercase: line = line.lower()
+
+            line_offset = 0
+            line_len = len(line)
+
+            for p in split_inx[split_inx_pos:]:
+                p -= base_offset
+                line_slice = line[line_offset:p] if p < line_len else line[line_offset:]
+                # process line segment, whose boundries are the annotations
+                # update mention start index
+                if line_offset+base_offset in start_inx:
+                    for j in start_inx[line_offset+base_offset]:
+                        tmp_mentions[j][3] = len(doc.tokens)
+                sent = self._processLineSlice(line_slice, doc, sent)
+                # update mention end index
+                if p + base_offset in end_inx:
+                    for j in end_inx[p + base_offset]:
+                        if tmp_mentions[j][5]: continue
+                        tmp_mentions[j][4] = len(doc.tokens)
+                        if tmp_mentions[j][3] == -1 : continue
+                        if tmp_mentions[j][2] == 'NIL':
+                            m = Mention(doc, tmp_mentions[j][3], tmp_mentions[j][4], is_NIL=True)
+                        else:
+                            m = Mention(doc, tmp_mentions[j][3], tmp_mentions[j][4],
+                                    gold_ent_id=tmp_mentions[j][2], gold_ent_str=tmp_mentions[j][1])
+                        doc.mentions.append(m)
+                        tmp_mentions[j][5] = True
+
+                if p >= line_len : break
+                line_offset = p
+                split_inx_pos += 1
+            if split_inx_pos == len(split_inx) and line_offset < line_len:
+                sent = self._processLineSlice(line[line_offset:], doc, sent)
+            base_offset += line_len
+            if len(sent) > 0:
+                doc.endSentence()
+            sent = []
+        for i, m in enumerate(doc.mentions):
+            doc.mentions[i].setStrAndLength()
+        return doc
+
     def mentions(self):
         for doc in self.documents():
             for mention in doc.mentions:
                 yield mention
 
-def load_data(text_path=None, mention_file=None, supplement=None,
+def iter_data(text_path=None, mention_file=None, supplement=None,
               include_unresolved=False, lowercase=False,
-              wiki_entity_file=None):
+              wiki_entity_file=None, num_workers=1):
     assert not isinstance(text_path, type(None)) and not isinstance(mention_file, type(None)),\
         "wned data requires raw text path and mention file!"
     print("Loading {0}, {1}".format(text_path,mention_file))
     wiki_map = loadWikiVocab(wiki_entity_file)
-    docs = []
     doc_iter = WnedDataLoader(text_path, mention_file,
                               include_unresolved=include_unresolved, lowercase=lowercase,
                               wiki_map=wiki_map)
-    for doc in doc_iter.documents():
-        docs.append(doc)
-    return docs
+    for doc in doc_iter.documents(num_workers=num_workers):
+        yield doc
+
+def load_data(text_path=None, mention_file=None, supplement=None,
+              include_unresolved=False, lowercase=False,
+              wiki_entity_file=None, num_workers=1):
+    return list(iter_data(text_path=text_path, mention_file=mention_file, supplement=supplement,
+                          include_unresolved=include_unresolved, lowercase=lowercase,
+                          wiki_entity_file=wiki_entity_file, num_workers=num_workers))
 
 if __name__ == "__main__":
     # Demo:
@@ -14,11 +14,10 @@ def _xlwikiFileToDocIterator(fpath):
         if file_type == "mentions" or not os.path.exists(os.path.join(fpath, file_name
                     + '.mentions')) or not os.path.exists(os.path.join(fpath, file_name
                     + '.txt')) : continue
-        f_txt = open(os.path.join(fpath, file_name+'.txt'), 'r', encoding = 'utf-8')
-        txt_lines = f_txt.readlines()
-        f_mention = open(os.path.join(fpath, file_name + '.mentions'), 'r', encoding = 'utf-8')
-        mention_lines = f_mention.readlines()
-        yield (file_name, txt_lines, mention_lines)
+        # both files stay open while the document is read, their lines are read lazily
+        with open(os.path.join(fpath, file_name+'.txt'), 'r', encoding = 'utf-8') as f_txt, \
+                open(os.path.join(fpath, file_name + '.mentions'), 'r', encoding = 'utf-8') as f_mention:
+            yield (file_name, f_txt, f_mention)
 
 en_punctuation = " \'\",:()\-\n"
 zh_punctuation = " ·＂＃＄％＆＇（）＊＋，－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏"
@@ -120,24 +119,28 @@ class XlwikiDataLoader():
                     sent = self._processLineSlice(line[line_offset:], doc, sent)
                 base_offset += line_len
                 if len(sent) > 0:
-                    doc.sentences.append(sent)
+                    doc.endSentence()
                 sent = []
             for i, m in enumerate(doc.mentions):
                 doc.mentions[i].setStrAndLength()
             yield doc
 
-def load_data(text_path=None, mention_file=None, supplement=None,
-              include_unresolved=False, lowercase=False, wiki_entity_file=None):
+def iter_data(text_path=None, mention_file=None, supplement=None,
+              include_unresolved=False, lowercase=False, wiki_entity_file=None, num_workers=1):
     assert not isinstance(text_path, type(None)), "xlwiki data requires raw path!"
     print("Loading", text_path)
     wiki_map = loadWikiVocab(wiki_entity_file)
     if supplement is None or supplement not in [0, 1, 2]: supplement=2
-    docs = []
     doc_iter = XlwikiDataLoader(text_path, genre=supplement,
                                 lowercase=lowercase, wiki_map=wiki_map)
     for doc in doc_iter.documents():
-        docs.append(doc)
-    return docs
+        yield doc
+
+def load_data(text_path=None, mention_file=None, supplement=None,
+              include_unresolved=False, lowercase=False, wiki_entity_file=None, num_workers=1):
+    return list(iter_data(text_path=text_path, mention_file=mention_file, supplement=supplement,
+                          include_unresolved=include_unresolved, lowercase=lowercase,
+                          wiki_entity_file=wiki_entity_file, num_workers=num_workers))
 
 if __name__ == "__main__":
     # Demo:
@@ -2,18 +2,25 @@
 import sys
 import os
 import time
+import pickle
 
 import gflags
 import re
 
 from ncel.data import load_conll_data, load_kbp_data, load_wned_data, load_xlwiki_data, load_ncel_data
-from ncel.utils.data import BuildVocabulary, BuildEntityVocabulary, AddCandidatesToDocs
-from ncel.utils.data import PreprocessDataset, LoadEmbeddingsFromBinary
-from ncel.utils.data import MakeEvalIterator, MakeTrainingIterator
+from ncel.utils.data import BuildVocabulary, BuildEntityVocabulary
+from ncel.utils.data import PreprocessDataset, LoadEmbeddingFilesConcurrently
+from ncel.utils.data import MakeEvalIterator, MakeTrainingIterator, CollectVocabularyStats
+from ncel.utils.shards import LoadShardManifest, SaveShardManifest, RemoveShards, WriteShard
+from ncel.utils.shards import ChunkDocuments, MakeShardedTrainingIterator
+from ncel.utils.preprocessed import DATASET_ARRAYS_VERSION, DatasetFingerprint, SaveDatasetArrays, LoadDatasetArrays
+from ncel.utils.string_features import StringFeatureCache
+from ncel.utils.candidate_index import IsCandidateIndex
 from ncel.models.featureGenerator import *
 from ncel.utils.logparse import parse_flags
 from ncel.utils.model_reader import ModelReader
-from ncel.utils.misc import loadWikiVocab, loadRedirectVocab, loadStopWords
+from ncel.utils.misc import loadWikiVocab, loadRedirectVocab, loadStopWords, EntityInterner
+from ncel.utils.layers import QuantizedEmbeddings, EMBEDDING_QUANTIZATION
 
 import ncel.models.ncel as ncel
 import ncel.models.pncel as pncel
@@ -67,12 +74,24 @@ def get_data_manager(data_type):
 
 def get_feature_manager(embeddings, embedding_dim, lowercase=True,
                  str_sim=True, prior=True, hasAtt=True,
-                 local_context_window=5, global_context_window=5):
+                 local_context_window=5, global_context_window=5,
+                 string_feature_cache_size=1000000, string_feature_cache=None):
 
     return FeatureGenerator(embeddings, embedding_dim, lowercase=lowercase,
                      str_sim=str_sim, prior=prior, hasAtt=hasAtt,
                  local_context_window=local_context_window,
-                global_context_window=global_context_window)
+                global_context_window=global_context_window,
+                string_features=StringFeatureCache(string_feature_cache_size, path=string_feature_cache))
+
+# frozen embedding tables only, fine tuned ones become nn.Embedding weights
+def quantizeEmbeddings(initial_embeddings, dtype, logger=None):
+    quantized = tuple(QuantizedEmbeddings(emb, dtype=dtype) if emb is not None else None
+                      for emb in initial_embeddings)
+    if logger is not None:
+        logger.Log("Quantized embeddings to {}: {:.1f}MB -> {:.1f}MB.".format(dtype,
+                   sum([emb.nbytes for emb in initial_embeddings if emb is not None]) / 2.0**20,
+                   sum([emb.nbytes for emb in quantized if emb is not None]) / 2.0**20))
+    return quantized
 
 def unwrapDataset(data_tuples):
     datasets = data_tuples.split(",")
@@ -88,15 +107,218 @@ def unwrapDataset(data_tuples):
     return unwraped_data_tuples
 
 def extractRawData(data_type, text_path, mention_file, supplement, FLAGS):
+    return list(iterRawData(data_type, text_path, mention_file, supplement, FLAGS))
+
+def iterRawData(data_type, text_path, mention_file, supplement, FLAGS):
     assert data_type in DATA_TYPE, "Wrong input data types!"
     data_manager = get_data_manager(data_type)
     if data_type in ["conll", "xlwiki"]:
         supplement = int(supplement)
-    raw_data = data_manager.load_data(text_path=text_path, mention_file=mention_file,
+    return data_manager.iter_data(text_path=text_path, mention_file=mention_file,
                  supplement=supplement, include_unresolved=FLAGS.include_unresolved,
-                lowercase=FLAGS.lowercase, wiki_entity_file=FLAGS.wiki_entity_vocab)
+                lowercase=FLAGS.lowercase, wiki_entity_file=FLAGS.wiki_entity_vocab,
+                num_workers=FLAGS.document_workers)
+
+def iterTrainingData(data_tuples, FLAGS):
+    for data_tuple in data_tuples:
+        for doc in iterRawData(data_tuple[0], data_tuple[2], data_tuple[3], data_tuple[1], FLAGS):
+            yield doc
+
+def internGoldEntities(raw_data, entity_interner, redirect_ids=None):
+    for doc in raw_data:
+        for mention in doc.mentions:
+            if mention.gold_ent_id() is not None:
+                mention._gold_ent_id = entity_interner.intern(mention.gold_ent_id())
+                if redirect_ids is not None and mention.gold_ent_id() in redirect_ids:
+                    mention._gold_ent_id = redirect_ids[mention.gold_ent_id()]
+
+# one streaming pass over the training data collects what vocabularies need,
+# the stats are kept in the shard manifest while the sources are unchanged
+def loadTrainingStats(data_tuples, FLAGS, logger):
+    sources = DatasetFingerprint([FLAGS.training_data, FLAGS.lowercase, FLAGS.include_unresolved],
+                               paths=[p for t in data_tuples for p in t[1:]] + [FLAGS.wiki_entity_vocab])
+    manifest = LoadShardManifest(FLAGS.training_shard_dir)
+    if manifest is not None and manifest['sources'] == sources:
+        logger.Log("Loaded training vocabulary stats from " + FLAGS.training_shard_dir)
+        return manifest
+    if manifest is not None:
+        RemoveShards(FLAGS.training_shard_dir, manifest)
+    logger.Log("Collecting training vocabulary stats ...")
+    words_in_data, mentions_in_data, gold_ids = set(), set(), set()
+    n_docs = 0
+    for doc in iterTrainingData(data_tuples, FLAGS):
+        CollectVocabularyStats([doc], words_in_data, mentions_in_data)
+        gold_ids.update([m.gold_ent_id() for m in doc.mentions if m.gold_ent_id() is not None])
+        n_docs += 1
+    logger.Log("Found {} training documents.".format(n_docs))
+    manifest = {'sources': sources, 'words': words_in_data, 'mentions': mentions_in_data,
+                'gold_ids': gold_ids, 'preprocess': None, 'shards': []}
+    SaveShardManifest(FLAGS.training_shard_dir, manifest)
+    return manifest
+
+# preprocesses the training data into shards once per vocabulary and settings
+def loadTrainingShards(manifest, data_tuples, FLAGS, logger, vocabulary, ids_vocabulary,
+                       initial_embeddings, candidate_handler, feature_manager, entity_interner,
+                       redirect_ids=None, stop_words={}):
+    preprocess = preprocessFingerprint(FLAGS, vocabulary, settings=[FLAGS.training_shard_size])
+    if manifest['preprocess'] == preprocess:
+        logger.Log("Reusing {} training shards in {}".format(len(manifest['shards']), FLAGS.training_shard_dir))
+    else:
+        RemoveShards(FLAGS.training_shard_dir, manifest)
+        for k, raw_data in enumerate(ChunkDocuments(iterTrainingData(data_tuples, FLAGS),
+                                                    FLAGS.training_shard_size)):
+            logger.Log("Processing raw training shard {} ...".format(k))
+            internGoldEntities(raw_data, entity_interner, redirect_ids=redirect_ids)
+            CollectVocabularyStats(raw_data, set(), set())
+            training_data = PreprocessDataset(raw_data,
+                                              ids_vocabulary,
+                                              initial_embeddings,
+                                              FLAGS.max_tokens,
+                                              FLAGS.max_candidates_per_document,
+                                              feature_manager,
+                                              stop_words=stop_words,
+                                              logger=logger,
+                                              include_unresolved=FLAGS.include_unresolved,
+                                              allow_cropping=FLAGS.allow_cropping,
+                                              candidate_handler=candidate_handler,
+                                              topn=FLAGS.topn_candidate,
+                                              num_workers=FLAGS.preprocess_workers)
+            if training_data.shape[0] == 0: continue
+            fname = WriteShard(FLAGS.training_shard_dir, k, training_data)
+            manifest['shards'].append((fname, training_data.shape[0]))
+        manifest['preprocess'] = preprocess
+        SaveShardManifest(FLAGS.training_shard_dir, manifest)
+    return makeShardedIterator(manifest, FLAGS)
+
+def makeShardedIterator(manifest, FLAGS):
+    shard_paths = [os.path.join(FLAGS.training_shard_dir, fname) for fname, _ in manifest['shards']]
+    training_data_length = sum([n for _, n in manifest['shards']])
+    training_data_iter = MakeShardedTrainingIterator(shard_paths, FLAGS.batch_size,
+                            FLAGS.smart_batching, prefetch=FLAGS.training_shard_prefetch)
+    return training_data_iter, training_data_length
+
+def candidateFilePaths(FLAGS):
+    return [f.split(':', 1)[-1] for f in re.split(r',', FLAGS.candidates_file or '') if len(f) > 0]
+
+# everything preprocessing depends on besides the raw documents
+def preprocessFingerprint(FLAGS, vocabulary, settings=(), paths=()):
+    word_vocab, entity_vocab, sense_vocab, _ = vocabulary
+    return DatasetFingerprint([DATASET_ARRAYS_VERSION, FLAGS.max_tokens, FLAGS.max_candidates_per_document,
+            FLAGS.topn_candidate, FLAGS.include_unresolved, FLAGS.allow_cropping, FLAGS.lowercase,
+            FLAGS.support_fuzzy, FLAGS.fuzzy_edit_distance, FLAGS.str_sim, FLAGS.prior, FLAGS.att,
+            FLAGS.local_context_window, FLAGS.global_context_window, FLAGS.embedding_dim,
+            FLAGS.embedding_quantization] + list(settings),
+        paths=[FLAGS.word_embedding_file, FLAGS.entity_embedding_file, FLAGS.sense_embedding_file,
+               FLAGS.stop_word_file, FLAGS.wiki_redirect_vocab, FLAGS.candidate_index] +
+              candidateFilePaths(FLAGS) + list(paths),
+        vocabularies=[word_vocab, entity_vocab, sense_vocab])
+
+# vocabularies of a run, keyed by every source they are built from
+def vocabularyCachePath(FLAGS, training_data_tuples, eval_data_tuples):
+    key = DatasetFingerprint([FLAGS.eval_only_mode, FLAGS.training_data if training_data_tuples else None,
+            FLAGS.eval_data, FLAGS.lowercase, FLAGS.include_unresolved, FLAGS.topn_candidate,
+            FLAGS.support_fuzzy, FLAGS.fuzzy_edit_distance],
+        paths=[p for t in training_data_tuples + eval_data_tuples for p in t[1:]] +
+              [FLAGS.wiki_entity_vocab, FLAGS.wiki_redirect_vocab, FLAGS.candidate_index,
+               FLAGS.word_embedding_file, FLAGS.entity_embedding_file, FLAGS.sense_embedding_file] +
+              candidateFilePaths(FLAGS))
+    return os.path.join(FLAGS.preprocessed_cache_dir, 'vocabulary-' + key + '.pkl')
+
+def datasetCachePath(FLAGS, vocabulary, data_tuples):
+    key = preprocessFingerprint(FLAGS, vocabulary, settings=[data_tuples],
+                                paths=[p for t in data_tuples for p in t[1:]])
+    return os.path.join(FLAGS.preprocessed_cache_dir, 'dataset-' + key + '.npz')
+
+def loadInitialEmbeddings(FLAGS, vocabulary, logger):
+    word_vocab, entity_vocab, sense_vocab, _ = vocabulary
+    jobs = [("words", word_vocab, FLAGS.embedding_dim, FLAGS.word_embedding_file, False),
+            ("entities", entity_vocab, FLAGS.embedding_dim, FLAGS.entity_embedding_file, False)]
+    if sense_vocab is not None:
+        jobs.append(("senses", sense_vocab, FLAGS.embedding_dim, FLAGS.sense_embedding_file, True))
+    logger.Log("Loading " + ", ".join(["{} {}".format(len(job[1]), job[0]) for job in jobs])
+               + " embeddings.")
+    loaded = LoadEmbeddingFilesConcurrently(jobs,
+                num_workers=len(jobs) if FLAGS.concurrent_embedding_loading else 1, logger=logger)
+    word_embeddings, entity_embeddings = loaded[:2]
+    sense_embeddings, mu_embeddings = loaded[2] if sense_vocab is not None else (None, None)
 
-    return raw_data
+    initial_embeddings = (word_embeddings, entity_embeddings, sense_embeddings, mu_embeddings)
+    if FLAGS.embedding_quantization != "none":
+        assert not FLAGS.fine_tune_loaded_embeddings, "Fine tuned embeddings can't be quantized!"
+        initial_embeddings = quantizeEmbeddings(initial_embeddings, FLAGS.embedding_quantization, logger=logger)
+    return initial_embeddings
+
+def makeDataIterators(FLAGS, training_data, eval_sets):
+    training_data_iter = MakeTrainingIterator(training_data, FLAGS.batch_size, FLAGS.smart_batching) \
+        if training_data is not None else None
+    eval_iterators = []
+    for eval_data in eval_sets:
+        eval_it = MakeEvalIterator(
+            eval_data,
+            FLAGS.batch_size)
+        eval_iterators.append(eval_it)
+    return training_data_iter, eval_iterators
+
+# a run whose vocabularies and datasets are all cached skips loading, candidates and preprocessing
+def loadPreprocessedCache(FLAGS, logger):
+    training_data_tuples = unwrapDataset(FLAGS.training_data) if not FLAGS.eval_only_mode else []
+    eval_data_tuples = unwrapDataset(FLAGS.eval_data)
+    vocab_path = vocabularyCachePath(FLAGS, training_data_tuples, eval_data_tuples)
+    if not os.path.isfile(vocab_path): return None
+    with open(vocab_path, 'rb') as fin:
+        cached = pickle.load(fin)
+    _, id2wiki_vocab = loadWikiVocab(FLAGS.wiki_entity_vocab)
+    vocabulary = cached['vocabulary'] + (id2wiki_vocab,)
+
+    eval_paths = [datasetCachePath(FLAGS, vocabulary, [t]) for t in eval_data_tuples]
+    training_path = None
+    training_manifest = None
+    if FLAGS.eval_only_mode:
+        pass
+    elif FLAGS.training_shard_dir is not None:
+        training_manifest = LoadShardManifest(FLAGS.training_shard_dir)
+        if training_manifest is None or training_manifest['preprocess'] != \
+                preprocessFingerprint(FLAGS, vocabulary, settings=[FLAGS.training_shard_size]):
+            return None
+    else:
+        training_path = datasetCachePath(FLAGS, vocabulary, training_data_tuples)
+        eval_paths.append(training_path)
+    if not all([os.path.isfile(path) for path in eval_paths]): return None
+
+    logger.Log("Loading preprocessed datasets from " + FLAGS.preprocessed_cache_dir)
+    initial_embeddings = loadInitialEmbeddings(FLAGS, vocabulary, logger)
+    eval_sets = [LoadDatasetArrays(path) for path in eval_paths[:len(eval_data_tuples)]]
+    training_data = LoadDatasetArrays(training_path) if training_path is not None else None
+    training_data_iter, eval_iterators = makeDataIterators(FLAGS, training_data, eval_sets)
+    training_data_length = training_data.shape[0] if training_data is not None else 0
+    if training_manifest is not None:
+        training_data_iter, training_data_length = makeShardedIterator(training_manifest, FLAGS)
+    return vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_data_length, \
+        cached['base_feature_dim']
+
+def preprocessOrLoadDataset(FLAGS, logger, vocabulary, data_tuples, raw_data, candidate_handler,
+                            ids_vocabulary, initial_embeddings, feature_manager, stop_words={}):
+    cache_path = datasetCachePath(FLAGS, vocabulary, data_tuples) \
+        if FLAGS.preprocessed_cache_dir is not None else None
+    if cache_path is not None and os.path.isfile(cache_path):
+        logger.Log("Loading preprocessed dataset from " + cache_path)
+        return LoadDatasetArrays(cache_path)
+    dataset = PreprocessDataset(raw_data,
+                                ids_vocabulary,
+                                initial_embeddings,
+                                FLAGS.max_tokens,
+                                FLAGS.max_candidates_per_document,
+                                feature_manager,
+                                stop_words=stop_words,
+                                logger=logger,
+                                include_unresolved=FLAGS.include_unresolved,
+                                allow_cropping=FLAGS.allow_cropping,
+                                candidate_handler=candidate_handler,
+                                topn=FLAGS.topn_candidate,
+                                num_workers=FLAGS.preprocess_workers)
+    if cache_path is not None:
+        SaveDatasetArrays(cache_path, dataset)
+    return dataset
 
 def load_data_and_embeddings(
         FLAGS,
@@ -114,58 +336,76 @@ def load_data_and_embeddings(
 
     # must cross_validation
     # wned only one eval [path, file]
+    if FLAGS.preprocessed_cache_dir is not None:
+        os.makedirs(FLAGS.preprocessed_cache_dir, exist_ok=True)
+        cached = loadPreprocessedCache(FLAGS, logger)
+        if cached is not None: return cached
+
     dataset_types = set()
     raw_training_data = None
+    # sharded training data is streamed from disk instead of held in memory
+    training_shards = FLAGS.training_shard_dir is not None and not FLAGS.eval_only_mode
+    training_manifest = None
+    training_data_tuples = []
     if not FLAGS.eval_only_mode:
-        raw_training_data = []
-        unwraped_data_tuples = unwrapDataset(FLAGS.training_data)
-        for data_tuple in unwraped_data_tuples:
+        training_data_tuples = unwrapDataset(FLAGS.training_data)
+        for data_tuple in training_data_tuples:
             dataset_types.add(data_tuple[0])
-            raw_training_data.extend(extractRawData(data_tuple[0],
-                      data_tuple[2], data_tuple[3], data_tuple[1], FLAGS))
+        if training_shards:
+            assert FLAGS.training_shard_size >= FLAGS.batch_size, "Shards must hold at least one batch!"
+            training_manifest = loadTrainingStats(training_data_tuples, FLAGS, logger)
+        else:
+            raw_training_data = []
+            for data_tuple in training_data_tuples:
+                raw_training_data.extend(extractRawData(data_tuple[0],
+                          data_tuple[2], data_tuple[3], data_tuple[1], FLAGS))
 
 
     raw_eval_sets = []
-    unwraped_data_tuples = unwrapDataset(FLAGS.eval_data)
-    for data_tuple in unwraped_data_tuples:
+    eval_data_tuples = unwrapDataset(FLAGS.eval_data)
+    for data_tuple in eval_data_tuples:
         dataset_types.add(data_tuple[0])
         raw_eval_sets.append(extractRawData(data_tuple[0],
                    data_tuple[2], data_tuple[3], data_tuple[1], FLAGS))
 
+    # entity ids are interned to ints from here on, vocabularies returned keep the id strings
+    entity_interner = EntityInterner()
+    raw_datasets = ([raw_training_data] if raw_training_data is not None else []) + raw_eval_sets
+    for raw_data in raw_datasets:
+        internGoldEntities(raw_data, entity_interner)
+
     # replace mention gold id in redirect to entity id
     redirect_vocab = None
+    redirect_ids = None
     if FLAGS.wiki_redirect_vocab is not None:
         gold_id_set = set()
-        if raw_training_data is not None:
-            gold_id_set.update([m.gold_ent_id() for doc in raw_training_data
-                                for m in doc.mentions if m.gold_ent_id() is not None])
-        for eval_data in raw_eval_sets:
-            gold_id_set.update([m.gold_ent_id() for doc in eval_data
+        if training_manifest is not None:
+            gold_id_set.update(training_manifest['gold_ids'])
+        for raw_data in raw_datasets:
+            gold_id_set.update([entity_interner.strings[m.gold_ent_id()] for doc in raw_data
                                 for m in doc.mentions if m.gold_ent_id() is not None])
         redirect_vocab = loadRedirectVocab(FLAGS.wiki_redirect_vocab, id_vocab=gold_id_set)
-        if raw_training_data is not None:
-            for i, doc in enumerate(raw_training_data):
+        redirect_ids = entity_interner.internMap(redirect_vocab)
+        for raw_data in raw_datasets:
+            for i, doc in enumerate(raw_data):
                 for j, mention in enumerate(doc.mentions):
-                    if mention.gold_ent_id() in redirect_vocab:
-                        raw_training_data[i].mentions[j]._gold_ent_id = redirect_vocab[mention.gold_ent_id()]
-        for eval_data in raw_eval_sets:
-            for i, doc in enumerate(eval_data):
-                for j, mention in enumerate(doc.mentions):
-                    if mention.gold_ent_id() in redirect_vocab:
-                        eval_data[i].mentions[j]._gold_ent_id = redirect_vocab[mention.gold_ent_id()]
+                    if mention.gold_ent_id() in redirect_ids:
+                        raw_data[i].mentions[j]._gold_ent_id = redirect_ids[mention.gold_ent_id()]
 
     # Prepare the word and mention vocabulary.
     word_vocab, mention_vocab = BuildVocabulary(
         raw_training_data,
         raw_eval_sets,
         FLAGS.word_embedding_file,
-        logger=logger)
+        logger=logger,
+        training_stats=(training_manifest['words'], training_manifest['mentions'])
+            if training_manifest is not None else None)
 
     wiki2id_vocab, id2wiki_vocab = loadWikiVocab(FLAGS.wiki_entity_vocab)
 
     # candidate file types
     candidate_types = []
-    files = re.split(r',', FLAGS.candidates_file)
+    files = re.split(r',', FLAGS.candidates_file) if FLAGS.candidates_file is not None else []
     for f in files:
         tmp_items = re.split(r':', f)
         candidate_types.append(tmp_items[0])
@@ -173,50 +413,61 @@ def load_data_and_embeddings(
     candidate_handler = candidate_manager(FLAGS.candidates_file, vocab=mention_vocab,
                           lowercase=FLAGS.lowercase, id2label=id2wiki_vocab,
                         label2id=wiki2id_vocab, support_fuzzy=FLAGS.support_fuzzy,
-                          redirect_vocab=redirect_vocab, topn=FLAGS.topn_candidate)
-    candidate_handler.loadCandidates()
+                          redirect_vocab=redirect_vocab, topn=FLAGS.topn_candidate,
+                          num_workers=FLAGS.candidate_workers, fuzzy_distance=FLAGS.fuzzy_edit_distance,
+                          interner=entity_interner)
+    # one set of digests for the index check, the cache and a rebuild
+    index_settings = candidate_handler.indexSettings()
+    stale_index = candidate_handler.staleIndexSettings(FLAGS.candidate_index, settings=index_settings) \
+        if IsCandidateIndex(FLAGS.candidate_index) else None
+    # an index without candidate files to rebuild it from fails to load when stale
+    if stale_index is not None and (len(stale_index) == 0 or FLAGS.candidates_file is None):
+        logger.Log("Loading compiled candidate index from " + FLAGS.candidate_index)
+        candidate_handler.loadCandidateIndex(FLAGS.candidate_index, settings=index_settings)
+    elif FLAGS.candidate_cache_dir is not None:
+        hit = candidate_handler.loadCachedCandidates(FLAGS.candidate_cache_dir, settings=index_settings)
+        logger.Log("Candidate cache {} in {}".format("hit" if hit else "miss", FLAGS.candidate_cache_dir))
+    else:
+        if stale_index:
+            logger.Log("Rebuilding candidate index {}, it was compiled with other {}".format(
+                FLAGS.candidate_index, ', '.join(stale_index)))
+        candidate_handler.loadCandidates()
+        if FLAGS.candidate_index is not None:
+            n_mentions, n_candidates = candidate_handler.saveCandidateIndex(FLAGS.candidate_index,
+                                                                            settings=index_settings)
+            logger.Log("Compiled {} mentions with {} candidates to {}".format(
+                n_mentions, n_candidates, FLAGS.candidate_index))
     if FLAGS.save_candidates_path is not None:
         fuzzy_str = 'fuzzy' if FLAGS.support_fuzzy else 'nofuzzy'
         candidate_handler.saveCandidatesToFile(os.path.join(FLAGS.save_candidates_path,
              '-'.join(dataset_types)+'-'.join(candidate_types)+'_candidate_'+fuzzy_str))
 
+    covered_mentions = sum([1 for m in mention_vocab if m in candidate_handler._mention_dict])
     logger.Log("Unk mention types rate: {:2.6f}% ({}/{}), average candidates: {:2.2f} ({}/{}) from {}!".format(
-        (len(mention_vocab)-len(candidate_handler._mention_dict))*100/float(len(mention_vocab)),
-        len(mention_vocab) - len(candidate_handler._mention_dict), len(mention_vocab), candidate_handler._candidates_total/float(len(candidate_handler._mention_dict)),
-         candidate_handler._candidates_total, len(candidate_handler._mention_dict), FLAGS.candidates_file))
+        (len(mention_vocab)-covered_mentions)*100/float(len(mention_vocab)),
+        len(mention_vocab) - covered_mentions, len(mention_vocab), candidate_handler._candidates_total/float(max(covered_mentions, 1)),
+         candidate_handler._candidates_total, covered_mentions, FLAGS.candidate_index or FLAGS.candidates_file))
 
     entity_vocab, sense_vocab = BuildEntityVocabulary(candidate_handler._entity_set,
                                          FLAGS.entity_embedding_file, FLAGS.sense_embedding_file,
-                                        logger=logger)
+                                        logger=logger, interner=entity_interner)
 
-    # Load pretrained embeddings.
-    logger.Log("Loading vocabulary with " + str(len(word_vocab))
-               + " words from " + FLAGS.word_embedding_file)
-    word_embeddings = LoadEmbeddingsFromBinary(
-        word_vocab, FLAGS.embedding_dim, FLAGS.word_embedding_file)
-
-    logger.Log("Loading vocabulary with " + str(len(entity_vocab))
-               + " entities from " + FLAGS.entity_embedding_file)
-    entity_embeddings = LoadEmbeddingsFromBinary(
-        entity_vocab, FLAGS.embedding_dim, FLAGS.entity_embedding_file)
-
-    sense_embeddings = None
-    mu_embeddings = None
-    if sense_vocab is not None:
-        sense_embeddings, mu_embeddings = LoadEmbeddingsFromBinary(
-            sense_vocab, FLAGS.embedding_dim, FLAGS.sense_embedding_file, isSense=True)
-        logger.Log("Loading vocabulary with " + str(len(sense_vocab))
-                   + " senses from " + FLAGS.sense_embedding_file)
-
-    initial_embeddings = (word_embeddings, entity_embeddings, sense_embeddings, mu_embeddings)
     vocabulary = (word_vocab, entity_vocab, sense_vocab, id2wiki_vocab)
+    # Load pretrained embeddings.
+    initial_embeddings = loadInitialEmbeddings(FLAGS, vocabulary, logger)
+    # the same vocabularies keyed by interned entity ids, for preprocessing
+    entity_ids_vocab = entity_interner.internKeys(entity_vocab)
+    sense_ids_vocab = entity_interner.internKeys(sense_vocab) if sense_vocab is not None else None
+    ids_vocabulary = (word_vocab, entity_ids_vocab, sense_ids_vocab, id2wiki_vocab)
     stop_words = loadStopWords(FLAGS.stop_word_file) if FLAGS.stop_word_file is not None else {}
 
     feature_manager = get_feature_manager(initial_embeddings, FLAGS.embedding_dim,
                                           lowercase=FLAGS.lowercase,
                  str_sim=FLAGS.str_sim, prior=FLAGS.prior, hasAtt=FLAGS.att,
                  local_context_window=FLAGS.local_context_window,
-                  global_context_window=FLAGS.global_context_window)
+                  global_context_window=FLAGS.global_context_window,
+                  string_feature_cache_size=FLAGS.string_feature_cache_size,
+                  string_feature_cache=FLAGS.string_feature_cache)
 
     # Trim dataset, convert token sequences to integer sequences, crop, and
     # pad. construct data iterator
@@ -224,47 +475,42 @@ def load_data_and_embeddings(
     eval_sets = []
     for i, raw_eval_data in enumerate(raw_eval_sets):
         logger.Log("Processing {} raw eval data ...".format(i))
-        AddCandidatesToDocs(raw_eval_sets[i], candidate_handler, topn=FLAGS.topn_candidate,
-                            vocab=entity_vocab, logger=logger,
-                            include_unresolved=FLAGS.include_unresolved)
-        eval_data = PreprocessDataset(raw_eval_sets[i],
-                                      vocabulary,
-                                      initial_embeddings,
-                                      FLAGS.max_tokens,
-                                      FLAGS.max_candidates_per_document,
-                                      feature_manager,
-                                      stop_words=stop_words,
-                                      logger=logger,
-                                      include_unresolved=FLAGS.include_unresolved,
-                                      allow_cropping=FLAGS.allow_cropping)
+        eval_data = preprocessOrLoadDataset(FLAGS, logger, vocabulary, [eval_data_tuples[i]],
+                        raw_eval_sets[i], candidate_handler, ids_vocabulary, initial_embeddings,
+                        feature_manager, stop_words=stop_words)
         eval_sets.append(eval_data)
+    training_data = None
     training_data_iter = None
     training_data_length = 0
-    if raw_training_data is not None:
+    if training_manifest is not None:
+        training_data_iter, training_data_length = loadTrainingShards(training_manifest,
+                training_data_tuples, FLAGS, logger, vocabulary, ids_vocabulary, initial_embeddings,
+                candidate_handler, feature_manager, entity_interner, redirect_ids=redirect_ids,
+                stop_words=stop_words)
+    elif raw_training_data is not None:
         logger.Log("Processing raw training data ...")
-        AddCandidatesToDocs(raw_training_data, candidate_handler, topn=FLAGS.topn_candidate,
-                            vocab=entity_vocab, logger=logger,
-                            include_unresolved=FLAGS.include_unresolved)
-        training_data = PreprocessDataset(raw_training_data,
-                                          vocabulary,
-                                          initial_embeddings,
-                                          FLAGS.max_tokens,
-                                          FLAGS.max_candidates_per_document,
-                                          feature_manager,
-                                          stop_words=stop_words,
-                                          logger=logger,
-                                          include_unresolved=FLAGS.include_unresolved,
-                                          allow_cropping=FLAGS.allow_cropping)
+        training_data = preprocessOrLoadDataset(FLAGS, logger, vocabulary, training_data_tuples,
+                            raw_training_data, candidate_handler, ids_vocabulary, initial_embeddings,
+                            feature_manager, stop_words=stop_words)
         training_data_length = training_data.shape[0]
-        training_data_iter = MakeTrainingIterator(training_data, FLAGS.batch_size, FLAGS.smart_batching)
     logger.Log("Processing raw eval data ...")
-    eval_iterators = []
-    for eval_data in eval_sets:
-        eval_it = MakeEvalIterator(
-            eval_data,
-            FLAGS.batch_size)
-        eval_iterators.append(eval_it)
-    return vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_data_length, feature_manager.base_feature_dim
+    shards_iter = training_data_iter
+    training_data_iter, eval_iterators = makeDataIterators(FLAGS, training_data, eval_sets)
+    if shards_iter is not None:
+        training_data_iter = shards_iter
+    feature_manager.string_features.save()
+    base_feature_dim = feature_manager.base_feature_dim
+    if base_feature_dim is None:
+        # cached datasets skip setBaseFeature
+        base_feature_dim = next((len(c.getBaseFeature()) for dataset in eval_sets + [training_data]
+                                 if dataset is not None for doc in dataset for m in doc.mentions
+                                 for c in m.candidates), None)
+    if FLAGS.preprocessed_cache_dir is not None:
+        # written last, so a cached vocabulary means every dataset of the run is cached
+        with open(vocabularyCachePath(FLAGS, training_data_tuples, eval_data_tuples), 'wb') as fout:
+            pickle.dump({'vocabulary': vocabulary[:3], 'base_feature_dim': base_feature_dim}, fout,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    return vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_data_length, base_feature_dim
 
 
 # python entity_linking.py -log_path -experiment_name -cross_validation -data_type -genre
@@ -329,15 +575,39 @@ def get_flags():
                                  "type:file, type in ['ppr','wiki_title', 'wiki_anchor', 'wiki_redirect', 'dictionary','yago','ncel']"
                                  "use ',' to separate multiple eval data.")
     gflags.DEFINE_boolean("support_fuzzy", True, "")
+    gflags.DEFINE_integer("fuzzy_edit_distance", 0, "Mentions without exact candidates take those of the closest "
+                                                    "mention within this edit distance, 0 to disable.")
+    gflags.DEFINE_string("candidate_index", None, "Directory of a compiled candidate index, read through mmap. "
+                                                  "Compiled from candidates_file if it doesn't exist yet, "
+                                                  "see run_build_candidate_index.py.")
+    gflags.DEFINE_string("preprocessed_cache_dir", None, "Cache preprocessed datasets and vocabularies "
+                         "here, a rerun with the same sources and settings skips preprocessing.")
+    gflags.DEFINE_string("training_shard_dir", None, "Preprocess training data once into shards "
+                         "in this directory and stream them while training.")
+    gflags.DEFINE_integer("training_shard_size", 10000, "Documents per training shard.")
+    gflags.DEFINE_integer("training_shard_prefetch", 2, "Training shards read ahead of the one in use.")
+    gflags.DEFINE_integer("document_workers", 1, "Processes parsing raw text files of wned, kbp and ncel data.")
+    gflags.DEFINE_integer("preprocess_workers", 1, "Processes adding candidates, ids and base features to documents.")
+    gflags.DEFINE_integer("string_feature_cache_size", 1000000,
+                          "Most (entity label, mention) pairs whose string features are kept in memory.")
+    gflags.DEFINE_string("string_feature_cache", None,
+                         "File persisting string features across runs, not persisted if unset.")
+    gflags.DEFINE_integer("candidate_workers", 1, "Processes parsing each candidate file in line aligned byte ranges.")
+    gflags.DEFINE_string("candidate_cache_dir", None, "Caches the merged candidates as compiled indexes, "
+                                                      "keyed by the source files, mention vocabulary and settings.")
     gflags.DEFINE_string(
         "save_candidates_path", None, "Each line: <string><tab><cprob><tab><id>"
                                   "type is ncel.")
     gflags.DEFINE_string("wiki_entity_vocab", None, "line: entity_label \t entity_id")
     gflags.DEFINE_string("wiki_redirect_vocab", None, "line: redirect_id \t entity_id")
-    gflags.DEFINE_string("word_embedding_file", None, "")
-    gflags.DEFINE_string("entity_embedding_file", None, "")
-    gflags.DEFINE_string("sense_embedding_file", None, "")
+    gflags.DEFINE_string("word_embedding_file", None, "word2vec binary file, or a .npy matrix with "
+                                                     "its .vocab file, see run_convert_embeddings.py.")
+    gflags.DEFINE_string("entity_embedding_file", None, "Same formats as word_embedding_file.")
+    gflags.DEFINE_string("sense_embedding_file", None, "Binary file of sense and mu vectors, "
+                                                      "or a (n, 2, dim) .npy matrix with its .vocab file.")
     gflags.DEFINE_string("stop_word_file", None, "")
+    gflags.DEFINE_boolean("concurrent_embedding_loading", True,
+                          "Load word, entity and sense embedding files in parallel threads.")
 
     gflags.DEFINE_boolean(
         "allow_cropping",
@@ -365,6 +635,8 @@ def get_flags():
     gflags.DEFINE_boolean("smart_batching", True, "Organize batches using sequence length.")
     gflags.DEFINE_boolean("fine_tune_loaded_embeddings", False,
                           "If set, backpropagate into embeddings even when initializing from pretrained.")
+    gflags.DEFINE_enum("embedding_quantization", "none", EMBEDDING_QUANTIZATION,
+                       "Store frozen embedding tables as float16, or int8 with a per-row scale.")
 
     # Evaluation settings
     gflags.DEFINE_boolean("lowercase", True, "When True, ignore case.")
@@ -391,6 +663,10 @@ def get_flags():
                                               "-1 indicates no local context feature, "
                                               "0 indicates the whole sentence. ")
     gflags.DEFINE_integer("global_context_window", 0, ".")
+    gflags.DEFINE_boolean("packed_graph_batches", True, "NCEL stacks the document graphs of a batch as one "
+                                                     "sparse graph instead of padding them to the largest.")
+    gflags.DEFINE_integer("graph_topk", 10, "Edges kept for each candidate in the packed NCEL graphs.")
+    gflags.DEFINE_float("graph_sim_thred", 0.0, "Candidates less similar than this are not connected in NCEL graphs.")
 
     gflags.DEFINE_integer("embedding_dim", 200, ".")
     gflags.DEFINE_boolean(
@@ -7,7 +7,7 @@ import time
 import gflags
 
 from ncel.utils import afs_safe_logger
-from ncel.utils.data import SimpleProgressBar, get_batch
+from ncel.utils.data import SimpleProgressBar, get_batch, get_graph_batch
 from ncel.utils.logging import stats, create_log_formatter
 from ncel.utils.logging import eval_stats, print_samples, finalStats
 import ncel.utils.logging_pb2 as pb
@@ -57,9 +57,12 @@ def evaluate(FLAGS, model, eval_set, log_entry,
                                 split_by_sent=FLAGS.split_by_sent)
         # batch_candidates = eval_num_candidates_batch.sum()
         # Run model. output: batch_size * node_num
-        output = model(context1, base, cids, m_strs,
-                       contexts2=context2, candidates_sense=cids_sense,
-                       num_mentions=num_mentions, length=num_candidates)
+        if FLAGS.model_type == "NCEL":
+            output = run_graph_model(FLAGS, model, dataset_batch, num_candidates)
+        else:
+            output = model(context1, base, cids, m_strs,
+                           contexts2=context2, candidates_sense=cids_sense,
+                           num_mentions=num_mentions, length=num_candidates)
 
         if show_sample:
             samples = print_samples(output.data.cpu().numpy(), vocabulary, dataset_batch, only_one=True)
@@ -125,6 +128,17 @@ def sequence_mask(sequence_length, max_length):
     seq_length_expand = lengths.unsqueeze(1)
     return seq_range_expand < seq_length_expand
 
+# NCEL classifies the candidates on graphs of whole documents, output: batch_size * cand_num
+def run_graph_model(FLAGS, model, doc_batch, num_candidates):
+    x, adj, length, nodes = get_graph_batch(doc_batch, model.entity_embeddings, packed=FLAGS.packed_graph_batches,
+                                            thred=FLAGS.graph_sim_thred, topk=FLAGS.graph_topk)
+    if FLAGS.packed_graph_batches:
+        probs = model.forwardPacked(x, adj)
+    else:
+        # drop the padded nodes, the others are in the order of nodes
+        probs = model(x, adj, length=length)[to_gpu(sequence_mask(length, x.shape[1]))]
+    return model.candidateScores(probs, nodes, num_candidates)
+
 def train_loop(
         FLAGS,
         model,
@@ -175,9 +189,12 @@ def train_loop(
         trainer.optimizer_zero_grad()
 
         # Run model. output: batch_size * cand_num
-        output = model(context1, base, cids, m_strs,
-                       contexts2=context2, candidates_sense=cids_sense,
-                       num_mentions=num_mentions, length=num_candidates)
+        if FLAGS.model_type == "NCEL":
+            output = run_graph_model(FLAGS, model, doc_batch, num_candidates)
+        else:
+            output = model(context1, base, cids, m_strs,
+                           contexts2=context2, candidates_sense=cids_sense,
+                           num_mentions=num_mentions, length=num_candidates)
 
         target = torch.from_numpy(y).long()
         # Calculate accuracy.
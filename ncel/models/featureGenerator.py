@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
-import numba
 import numpy as np
-from pyxdameraulevenshtein import normalized_damerau_levenshtein_distance
 from ncel.utils.layers import cosSim
+from ncel.utils.string_features import StringFeatureCache, STRING_FEATURE_DIM
 
 class FeatureGenerator:
     def __init__(self, initial_embeddings, embedding_dim,
                  lowercase=True, str_sim=True, prior=True, hasAtt=True,
-                 local_context_window=5, global_context_window=5, use_embeddings=True):
+                 local_context_window=5, global_context_window=5, use_embeddings=True,
+                 string_features=None):
         self._lowercase = lowercase
         self._has_str_sim = str_sim
         self._has_prior = prior
@@ -18,6 +18,7 @@ class FeatureGenerator:
          self.sense_embeddings, self.mu_embeddings) = initial_embeddings
         self._dim = embedding_dim
         self._use_embeddings = use_embeddings
+        self.string_features = string_features if string_features is not None else StringFeatureCache()
 
 
         self._split_by_sent = True
@@ -105,58 +106,47 @@ class FeatureGenerator:
         return self._feature_dim
 
     def setBaseFeature(self, doc):
-        for m in doc.mentions:
-            # max prior
-            max_pem = 0
-            # number of candidates
-            n_candidates = len(m.candidates)
-            for c in m.candidates:
-                if max_pem < c.getEntityMentionPrior():
-                    max_pem = c.getEntityMentionPrior()
-            for cand in m.candidates:
-                c_feature = self.getCandidateBaseFeature(cand, n_candidates, max_pem)
-                cand.setBaseFeature(np.array(c_feature, dtype=float))
-                if self.base_feature_dim is None:
-                    self.base_feature_dim = len(c_feature)
-
-    def getCandidateBaseFeature(self, candidate, num_candidates, max_prior):
-        # base feature_num
-        features = []
-        m_label = candidate.getMentionText()
+        self.setBaseFeatures([doc])
+
+    # base features of all candidates in dataset as one float32 matrix shared by
+    # the documents, each candidate keeps its row
+    def setBaseFeatures(self, dataset, stats=None):
+        mentions = [m for doc in dataset for m in doc.mentions]
+        candidates = [c for m in mentions for c in m.candidates]
+        n_candidates = np.array([len(m.candidates) for m in mentions], dtype=np.int64)
+        pem = np.array([c.getEntityMentionPrior() for c in candidates], dtype=np.float64)
+        dim = 2 + (STRING_FEATURE_DIM if self._has_str_sim else 0) + (1 if self._has_prior else 0)
+        features = np.zeros((len(candidates), dim), dtype=np.float32)
         # number of candidates
-        features.append(num_candidates)
-        # max_prior
-        features.append(max_prior)
+        features[:, 0] = np.repeat(n_candidates, n_candidates)
+        # max prior, a segment max over the candidates of each mention
+        max_pem = np.zeros(len(mentions))
+        has_candidates = n_candidates > 0
+        if len(candidates) > 0:
+            starts = (np.cumsum(n_candidates) - n_candidates)[has_candidates]
+            max_pem[has_candidates] = np.maximum(np.maximum.reduceat(pem, starts), 0)
+        features[:, 1] = np.repeat(max_pem, n_candidates)
+        col = 2
 
         # string similarity features
         if self._has_str_sim:
-            c_label = candidate.label
-            if self._lowercase : c_label = c_label.lower()
-            # edit_distance
-            features.append(normalized_damerau_levenshtein_distance(c_label, m_label))
-            # is equal
-            features.append(1 if c_label==m_label else 0)
-            # mlabel contains clabel
-            features.append(1 if c_label in m_label else 0)
-            # clabel contains mlabel
-            features.append(1 if m_label in c_label else 0)
-            # mlabel starts with clabel
-            features.append(1 if m_label.startswith(c_label) else 0)
-            # clabel starts with mlabel
-            features.append(1 if c_label.startswith(m_label) else 0)
-            # mlabel ends with clabel
-            features.append(1 if m_label.endswith(c_label) else 0)
-            # clabel ends with mlabel
-            features.append(1 if c_label.endswith(m_label) else 0)
+            pairs = [(c.label.lower() if self._lowercase else c.label, c.getMentionText()) for c in candidates]
+            features[:, col:col+STRING_FEATURE_DIM] = np.array(self.string_features.features(pairs, stats=stats),
+                                dtype=np.float32).reshape(len(candidates), STRING_FEATURE_DIM)
+            col += STRING_FEATURE_DIM
 
         # prior
         if self._has_prior:
             # entity prior
-            features.append(candidate.getEntityMentionPrior())
+            features[:, col] = pem
 
-        return features
+        for doc in dataset:
+            doc.base_features = features
+        for i, cand in enumerate(candidates):
+            cand.setBaseRow(i)
+        if self.base_feature_dim is None and len(candidates) > 0:
+            self.base_feature_dim = dim
 
-    @numba.autojit
     def getSeqEmbeddings(self, sent_embeds, query_emb=None):
         if query_emb is None:
             embeds = np.mean(sent_embeds, axis=0)
@@ -7,19 +7,23 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 
-from ncel.utils.layers import GraphConvolutionNetwork, Linear, to_gpu, UniInitializer, LayerNormalization
+from ncel.utils.layers import GraphConvolutionNetwork, Linear, to_gpu, UniInitializer, LayerNormalization, \
+    sparseAdjacency
 
 
-def build_model(feature_dim, FLAGS):
+def build_model(base_feature_dim, initial_embeddings, FLAGS, logger):
     model_cls = NCEL
+    gc_dim = 100
+    num_gc_layer = 2
+    gc_ln = False
     return model_cls(
-        feature_dim,
-        FLAGS.gc_dim,
-        num_gc_layer=FLAGS.num_gc_layer,
-        gc_ln=FLAGS.gc_ln,
-        class_ln=FLAGS.cm_ln,
-        dropout=FLAGS.dropout,
-        res_gc_layer_num=FLAGS.res_gc_layer_num
+        base_feature_dim,
+        gc_dim,
+        entity_embeddings=initial_embeddings[1],
+        num_gc_layer=num_gc_layer,
+        gc_ln=gc_ln,
+        class_ln=FLAGS.mlp_ln,
+        dropout=FLAGS.dropout
     )
 
 
@@ -28,29 +32,34 @@ class NCEL(nn.Module):
     def __init__(self,
                  input_dim, # feature_dim
                  gc_dim,
+                 entity_embeddings=None,
                  num_gc_layer=2,
                  gc_ln=False,
                  class_ln=False,
-                 dropout = 0.0,
-                 res_gc_layer_num=0
+                 dropout = 0.0
                  ):
         super(NCEL, self).__init__()
 
         self.drop_out_rate = dropout
+        # graphs of the documents connect similar candidate entities, see get_graph_batch
+        self.entity_embeddings = entity_embeddings
         self.class_ln = class_ln
 
-        self.gc_layer = GraphConvolutionNetwork(input_dim, gc_dim, gc_ln=gc_ln, bias=True,
-            num_layers=num_gc_layer, dropout=dropout, res_gc_layer_num=res_gc_layer_num)
+        self.gc_layer = GraphConvolutionNetwork(input_dim, gc_dim, layers_dim=[gc_dim] * (num_gc_layer - 1),
+            gc_ln=gc_ln, bias=True, dropout=dropout)
 
         if self.class_ln:
-            self.ln_inp = LayerNormalization(input_dim)
+            self.ln_inp = LayerNormalization(gc_dim)
 
         self.classifer = Linear(initializer=UniInitializer)(gc_dim, 2)
 
     # x: batch_size * node_num * feature_dim
     # adj: batch_size * node_num * node_num
     # length: batch_size
+    # or packed by PackDocuments, x: node_num * feature_dim, adj: CSR arrays
     def forward(self, x, adj, length=None):
+        if isinstance(adj, tuple):
+            return self.forwardPacked(x, adj)
         batch_size, node_num, feature_dim = x.shape
         h = to_gpu(Variable(torch.from_numpy(x), requires_grad=False)).float()
 
@@ -75,6 +84,25 @@ class NCEL(nn.Module):
         output = masked_softmax(output, mask=class_mask)
         return output
 
+    # node_num * self._num_class, without padding the cost grows with the edges
+    def forwardPacked(self, x, adj):
+        h = to_gpu(Variable(torch.from_numpy(x), requires_grad=False)).float()
+        adj = to_gpu(sparseAdjacency(*adj))
+        h = self.gc_layer(h, adj)
+        if self.class_ln:
+            h = self.ln_inp(h)
+        h = F.dropout(h, self.drop_out_rate, training=self.training)
+        return F.softmax(self.classifer(h), dim=1)
+
+    # probs: node_num * self._num_class, nodes: (mention, candidate) of the nodes
+    # return log probabilities of the candidates being gold, batch_size * cand_num
+    def candidateScores(self, probs, nodes, num_candidates):
+        m_rows, c_cols = [to_gpu(torch.from_numpy(n)).long() for n in nodes]
+        # padded candidates are never picked
+        scores = to_gpu(torch.full((len(num_candidates), max(num_candidates)), float('-inf')))
+        scores[m_rows, c_cols] = torch.log(probs[:, 1].clamp(min=1e-12))
+        return scores
+
     def reset_parameters(self):
         self.gc_layer.reset_parameters()
         self.classifer.reset_parameters()
@@ -10,6 +10,8 @@ import torch.nn.functional as F
 from ncel.utils.layers import Embed, to_gpu, MLPClassifier, Linear, SubGraphConvolution
 from ncel.utils.layers import UniInitializer, LayerNormalization
 DEFAULT_SIM = 0.0
+# mention blocks of buildGraph gather at most this many neighbor candidate elements
+GRAPH_BLOCK_ELEMENTS = 1 << 24
 
 def build_model(base_feature_dim, initial_embeddings, FLAGS, logger):
     model_cls = SUBNCEL
@@ -256,18 +258,57 @@ class SUBNCEL(nn.Module):
         neigh_cands = torch.cat((left_cands, right_cands), dim=1)
         return neigh_cands
 
+    # the rows getNeighCandidates gathers for each mention, in emb padded with one zero
+    # row, and their masks: batch * (cand_num*window*2), numpy
+    def getNeighCandidateIndex(self, window, num_mentions):
+        batch_size, cand_num = num_mentions.shape
+        rows = np.arange(batch_size * cand_num, dtype=np.int64).reshape(batch_size, cand_num)
+        num_mentions = num_mentions.astype(np.float32)
+        left_index, left_mask = [], []
+        right_index, right_mask = [], []
+        # a neighbor d mentions away is masked out if a document ends in between
+        left_m = np.ones((batch_size, cand_num), dtype=np.float32)
+        right_m = np.ones((batch_size, cand_num), dtype=np.float32)
+        for d in range(1, window + 1):
+            index = np.full((batch_size, cand_num), batch_size * cand_num, dtype=np.int64)
+            index[d:] = rows[:-d]
+            shifted = np.zeros((batch_size, cand_num), dtype=np.float32)
+            shifted[d:] = num_mentions[:-d]
+            left_m = left_m * shifted
+            left_index.append(index)
+            left_mask.append(left_m)
+
+            index = np.full((batch_size, cand_num), batch_size * cand_num, dtype=np.int64)
+            index[:-d] = rows[d:]
+            shifted = np.zeros((batch_size, cand_num), dtype=np.float32)
+            shifted[:max(batch_size-d+1, 0)] = num_mentions[d-1:]
+            right_m = right_m * shifted
+            right_index.append(index)
+            right_mask.append(right_m)
+        return np.concatenate(left_index + right_index, axis=1), np.concatenate(left_mask + right_mask, axis=1)
+
     # cand_emb: (batch * cand) * dim, tensor
     # adj: (batch_size * cand_num) * (2*window*cand_num+1)
     def buildGraph(self, cand_emb, window, num_mentions, thred=0.0):
         batch_size, cand_num = num_mentions.shape
-        # (batch * cand) * (cand_num*window*2) * dim
-        neigh_cands = self.getNeighCandidates(cand_emb, window, num_mentions)
-
-        # (batch * cand) * (cand_num*window*2) * dim
-        cand_emb_expand = cand_emb.unsqueeze(1).expand(batch_size * cand_num,
-                                                       2*window*cand_num, self._dim)
+        neigh_num = 2 * window * cand_num
+        # candidates of a mention share their neighbors, which are gathered once per mention
+        # and compared a block of mentions at a time instead of expanded for every candidate
+        index, mask = self.getNeighCandidateIndex(window, num_mentions)
+        index = to_gpu(torch.from_numpy(index))
+        mask = to_gpu(torch.from_numpy(mask))
+        padded_emb = torch.cat((cand_emb, to_gpu(torch.zeros(1, self._dim))), dim=0)
+        cand_emb = cand_emb.view(batch_size, cand_num, 1, self._dim)
+        block = max(1, GRAPH_BLOCK_ELEMENTS // max(1, cand_num * neigh_num * self._dim))
+        adj = []
+        for start in range(0, batch_size, block):
+            end = min(start + block, batch_size)
+            # block * 1 * (cand_num*window*2) * dim
+            neigh_cands = padded_emb.index_select(0, index[start:end].view(-1)) * mask[start:end].view(-1, 1)
+            neigh_cands = neigh_cands.view(end - start, 1, neigh_num, self._dim)
+            adj.append(F.cosine_similarity(cand_emb[start:end], neigh_cands, dim=3).view(-1, neigh_num))
         # (batch * cand) * (cand_num*window*2)
-        adj = torch.clamp(F.cosine_similarity(cand_emb_expand, neigh_cands, dim=2), thred, 1)
+        adj = torch.clamp(torch.cat(adj, dim=0), thred, 1)
         if thred > 0.0:
             adj[adj<=thred]=0.0
         # add self connection
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 import re
+import os
+import hashlib
+import io
+import multiprocessing
 from ncel.utils.layers import cosSim
+from ncel.utils.candidate_index import CandidateIndex, SaveCandidateIndex, IsCandidateIndex
+from ncel.utils.candidate_index import FuzzyMentionIndex, LoadCandidateIndexSettings, ALL_MENTIONS
+from ncel.utils.misc import EntityInterner
 
 DEFAULT_PRIOR = 0.0
 
@@ -8,11 +15,121 @@ DEFAULT_PRIOR = 0.0
 # wiki_anchor, dictionary, average
 SOURCE = ['ppr','wiki_title', 'wiki_anchor', 'wiki_redirect', 'dictionary','yago','ncel']
 
+# bounds of the byte ranges parsed by one worker
+MIN_RANGE_BYTES = 1 << 23
+MAX_RANGE_BYTES = 1 << 26
+
+def openFileRange(filename, start=0, end=None, errors='strict'):
+    if start == 0 and end is None:
+        return open(filename, 'r', encoding='UTF-8', errors=errors)
+    with open(filename, 'rb') as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(data), encoding='UTF-8', errors=errors)
+
+# [(start, end), ...] byte ranges starting at line beginnings
+def splitFileByLines(filename, num_workers):
+    size = os.path.getsize(filename)
+    n = max(num_workers * 4, size // MAX_RANGE_BYTES + 1)
+    n = min(n, size // MIN_RANGE_BYTES + 1)
+    bounds = [0]
+    with open(filename, 'rb') as fin:
+        for i in range(1, n):
+            fin.seek(max(size * i // n, bounds[-1]))
+            fin.readline()
+            if fin.tell() >= size: break
+            if fin.tell() > bounds[-1]: bounds.append(fin.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# workers are forked, so they inherit the handler and its vocabularies
+_range_handler = None
+
+# entities first interned in a worker come back as strings, ids below base are shared
+def _parseCandidateRange(args):
+    base, job = args
+    mention_dict, entity_set = _range_handler.loadCandidatesFromFileRange(*job)
+    return mention_dict, entity_set, _range_handler._interner.strings[base:]
+
+def _remapEntities(ids, base, remap):
+    return [id if id < base else remap[id - base] for id in ids]
+
+def _remapCandidateChunk(chunk, base, remap):
+    mention_dict, entity_set, new_entities = chunk
+    if len(new_entities) == 0:
+        return mention_dict, entity_set
+    for m, cands in mention_dict.items():
+        if isinstance(cands, set):
+            mention_dict[m] = set(_remapEntities(cands, base, remap))
+        else:
+            mention_dict[m] = dict(zip(_remapEntities(cands.keys(), base, remap), cands.values()))
+    return mention_dict, set(_remapEntities(entity_set, base, remap))
+
+def parseCandidateRanges(handler, type, filename, ranges, num_workers):
+    global _range_handler
+    jobs = [(type, filename, start, end) for start, end in ranges]
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        return [handler.loadCandidatesFromFileRange(*job) for job in jobs]
+    base = len(handler._interner)
+    _range_handler = handler
+    try:
+        with context.Pool(num_workers) as pool:
+            chunks = pool.map(_parseCandidateRange, [(base, job) for job in jobs], chunksize=1)
+    finally:
+        _range_handler = None
+    results = []
+    for chunk in chunks:
+        remap = [handler._interner.intern(entity) for entity in chunk[2]]
+        results.append(_remapCandidateChunk(chunk, base, remap))
+    return results
+
+# merge per range results in file order, as if the file was read in one pass
+def mergeCandidateChunks(type, chunks):
+    mention_dict = {}
+    entity_set = set()
+    for chunk_dict, chunk_entities in chunks:
+        entity_set.update(chunk_entities)
+        for m, cands in chunk_dict.items():
+            if m not in mention_dict:
+                mention_dict[m] = cands
+            elif isinstance(cands, set):
+                mention_dict[m].update(cands)
+            elif type == SOURCE[2]:
+                # anchor counts are summed
+                tmp_cand = mention_dict[m]
+                for ent_id, count in cands.items():
+                    tmp_cand[ent_id] = tmp_cand.get(ent_id, 0.0) + count
+            elif type == SOURCE[4]:
+                # dictionary priors are kept in order and averaged afterwards
+                tmp_cand = mention_dict[m]
+                for ent_id, cprobs in cands.items():
+                    tmp_cand.setdefault(ent_id, []).extend(cprobs)
+            else:
+                # later lines overwrite
+                mention_dict[m].update(cands)
+    return mention_dict, entity_set
+
+# fold the priors of each dictionary pair into its running average
+def averageDictPriors(mention_dict):
+    for m in mention_dict:
+        tmp_cand = mention_dict[m]
+        for ent_id in tmp_cand:
+            cprobs = tmp_cand[ent_id]
+            prior = cprobs[0]
+            for cprob in cprobs[1:]:
+                prior = (prior + cprob) / 2.0
+            tmp_cand[ent_id] = prior
+
 class CandidatesHandler:
     def __init__(self, file, vocab=None, lowercase=False, id2label=None, label2id=None,
-                 support_fuzzy=True, redirect_vocab=None, topn=0):
-        self._files = file.split(',')
+                 support_fuzzy=True, redirect_vocab=None, topn=0, num_workers=1, fuzzy_distance=0,
+                 interner=None):
+        self._files = file.split(',') if file is not None else []
         self._vocab = vocab         # mention vocab
+        # entity ids are interned ints, see EntityInterner
+        self._interner = interner if interner is not None else EntityInterner()
         self._mention_dict = None       # {str:{ent:pem,...},...}
         self._entity_set = None     #entity set
 
@@ -26,9 +143,21 @@ class CandidatesHandler:
         self._id2label = id2label
         self._label2id = label2id
         self._support_fuzzy = support_fuzzy
-        self._redirect_vocab = redirect_vocab
+        self._redirect_vocab = self._interner.internMap(redirect_vocab) if redirect_vocab is not None else None
+        # processes parsing byte ranges of each source file
+        self._num_workers = num_workers
+        # edit distance of approximate mention lookups, 0 for exact match only
+        self._fuzzy_distance = fuzzy_distance
+        self._vocab_fuzzy_index = None
+        self._fuzzy_index = None
+        self._fuzzy_cache = {}
+        self._vocab_fuzzy_cache = {}
+        self._index_settings = None
 
     def loadCandidates(self):
+        if self._fuzzy_distance > 0 and self._vocab is not None:
+            # keep source mentions close to the vocab, they are the fuzzy fallbacks
+            self._vocab_fuzzy_index = FuzzyMentionIndex(self._vocab, max_distance=self._fuzzy_distance)
         for f in self._files:
             items = f.split(':')
             is_uniform, mention_dict, entity_set = self.loadCandidatesFromFile(items[0],items[1])
@@ -36,9 +165,124 @@ class CandidatesHandler:
                 self.addToUniformCandidates(mention_dict)
             else:
                 self.addToCandidates(mention_dict)
+        self._vocab_fuzzy_cache = {}
         self.combineCandidates()
         self._candidates_total = sum([len(self._mention_dict[m]) for m in self._mention_dict])
 
+    # replace the mention dict by a compiled index, see candidate_index.py
+    def loadCandidateIndex(self, path, settings=None):
+        stale = self.staleIndexSettings(path, settings=settings)
+        if len(stale) > 0:
+            raise ValueError("Candidate index {} was compiled with other {}, rebuild it!".format(
+                path, ', '.join(stale)))
+        # the fuzzy lookup table holds every key of the map, bounded only for an index of the vocab
+        if self._fuzzy_distance > 0 and LoadCandidateIndexSettings(path).get('mentions') == ALL_MENTIONS:
+            raise ValueError("Candidate index {} has all mentions, fuzzy lookups need one compiled for "
+                             "the mention vocab, see --candidate_cache_dir.".format(path))
+        index = CandidateIndex(path, interner=self._interner)
+        self._mention_dict = index
+        self._entity_set = set()
+        if self._vocab is None:
+            self._entity_set.update(index.entity_ids)
+            self._candidates_total = index.totalCandidates()
+            return
+        # an index may be compiled for all mentions, only count those in the vocab
+        self._candidates_total = 0
+        for m in self._vocab:
+            cand_list = self.lookupCandidates(m)
+            self._entity_set.update([cand[0] for cand in cand_list])
+            self._candidates_total += len(cand_list)
+
+    def inMentionVocab(self, m_str):
+        if self._vocab is None or m_str in self._vocab: return True
+        if self._vocab_fuzzy_index is None: return False
+        # sources repeat a mention on many lines, look each one up once
+        if m_str not in self._vocab_fuzzy_cache:
+            self._vocab_fuzzy_cache[m_str] = self._vocab_fuzzy_index.lookup(m_str) is not None
+        return self._vocab_fuzzy_cache[m_str]
+
+    # exact candidates of a mention string, else those of the closest mention within fuzzy_distance
+    def lookupCandidates(self, m_str):
+        cand_list = self._mention_dict.get(m_str)
+        if cand_list is not None or self._fuzzy_distance < 1:
+            return cand_list if cand_list is not None else []
+        if m_str not in self._fuzzy_cache:
+            if self._fuzzy_index is None:
+                self._fuzzy_index = FuzzyMentionIndex(self._mention_dict, max_distance=self._fuzzy_distance)
+            self._fuzzy_cache[m_str] = self._fuzzy_index.lookup(m_str)
+        key = self._fuzzy_cache[m_str]
+        return self._mention_dict[key] if key is not None else []
+
+    def saveCandidateIndex(self, path, settings=None):
+        assert self._mention_dict is not None, "load candidates first!"
+        return SaveCandidateIndex(path, self._mention_dict, entity_strings=self._interner.strings,
+                                  settings=settings if settings is not None else self.indexSettings())
+
+    # source files and every setting that changes the merged candidates,
+    # computed once as the vocabularies do not change after __init__
+    def indexSettings(self):
+        if self._index_settings is None:
+            self._index_settings = self._computeIndexSettings()
+        return dict(self._index_settings)
+
+    def _computeIndexSettings(self):
+        sources = hashlib.sha1()
+        for f in self._files:
+            items = f.split(':')
+            st = os.stat(items[1])
+            sources.update("{}\t{}\t{}\t{}\n".format(items[0], os.path.abspath(items[1]),
+                                                     st.st_size, st.st_mtime_ns).encode('utf-8'))
+        vocabularies = hashlib.sha1()
+        strings = self._interner.strings
+        redirect_vocab = dict([(strings[k], strings[v]) for k, v in self._redirect_vocab.items()]) \
+            if self._redirect_vocab is not None else None
+        for vocab in [redirect_vocab, self._label2id]:
+            vocabularies.update(b'vocab\n')
+            if vocab is None: continue
+            for k in sorted(vocab):
+                vocabularies.update("{}\t{}\n".format(k, vocab[k]).encode('utf-8'))
+        # with a mention vocab only mentions close to it are kept
+        mentions = ALL_MENTIONS
+        if self._vocab is not None:
+            sha = hashlib.sha1("{}\n".format(self._fuzzy_distance).encode('utf-8'))
+            for m in sorted(self._vocab):
+                sha.update(m.encode('utf-8') + b'\n')
+            mentions = sha.hexdigest()
+        return {'sources': sources.hexdigest(), 'topn': str(self._topn), 'lowercase': str(self._lowercase),
+                'support_fuzzy': str(self._support_fuzzy), 'vocabularies': vocabularies.hexdigest(),
+                'mentions': mentions}
+
+    # names of the settings an index was compiled with that differ from ours. Without
+    # source files the index is the only source, and an index of all mentions covers any vocab
+    def staleIndexSettings(self, path, settings=None):
+        saved = LoadCandidateIndexSettings(path)
+        if settings is None:
+            settings = self.indexSettings()
+        return [name for name, value in sorted(settings.items())
+                if saved.get(name) != value and not (name == 'sources' and len(self._files) == 0)
+                and not (name == 'mentions' and saved.get(name) == ALL_MENTIONS)]
+
+    # key of the merged candidates
+    def candidatesFingerprint(self, settings=None):
+        if settings is None:
+            settings = self.indexSettings()
+        sha = hashlib.sha1()
+        for name, value in sorted(settings.items()):
+            sha.update("{}\t{}\n".format(name, value).encode('utf-8'))
+        return sha.hexdigest()
+
+    # returns whether the cache was hit, a miss loads the sources and fills it
+    def loadCachedCandidates(self, cache_dir, settings=None):
+        if settings is None:
+            settings = self.indexSettings()
+        path = os.path.join(cache_dir, self.candidatesFingerprint(settings=settings))
+        if IsCandidateIndex(path) and len(self.staleIndexSettings(path, settings=settings)) == 0:
+            self.loadCandidateIndex(path, settings=settings)
+            return True
+        self.loadCandidates()
+        self.saveCandidateIndex(path, settings=settings)
+        return False
+
     def combineCandidates(self):
         if self._uni_mention_dict is not None:
             for m in self._uni_mention_dict:
@@ -92,36 +336,44 @@ class CandidatesHandler:
 
     # SOURCE = ['ppr','wiki_title', 'wiki_anchor', 'wiki_redirect', 'dictionary','yago','ncel']
     def loadCandidatesFromFile(self, type, filename):
+        is_uniform = type in [SOURCE[0], SOURCE[1], SOURCE[3], SOURCE[5]]
+        ranges = splitFileByLines(filename, self._num_workers) if self._num_workers > 1 else []
+        if len(ranges) > 1:
+            chunks = parseCandidateRanges(self, type, filename, ranges, self._num_workers)
+            mention_dict, entity_set = mergeCandidateChunks(type, chunks)
+        else:
+            mention_dict, entity_set = self.loadCandidatesFromFileRange(type, filename)
+        if type == SOURCE[4]:
+            averageDictPriors(mention_dict)
+        return is_uniform, mention_dict, entity_set
+
+    # parses the lines in [start, end) bytes of a source file
+    def loadCandidatesFromFileRange(self, type, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
-        is_uniform = False
         if type == SOURCE[0]:
-            mention_dict, entity_set = self.loadCandidatesFromPPR(filename)
-            is_uniform = True
+            mention_dict, entity_set = self.loadCandidatesFromPPR(filename, start, end)
         elif type == SOURCE[1]:
-            mention_dict, entity_set = self.loadCandidatesFromWikiTitle(filename)
-            is_uniform = True
+            mention_dict, entity_set = self.loadCandidatesFromWikiTitle(filename, start, end)
         elif type == SOURCE[2]:
-            mention_dict, entity_set = self.loadCandidatesFromWikiAnchor(filename)
+            mention_dict, entity_set = self.loadCandidatesFromWikiAnchor(filename, start, end)
         elif type == SOURCE[3]:
-            mention_dict, entity_set = self.loadCandidatesFromWikiRedirect(filename)
-            is_uniform = True
+            mention_dict, entity_set = self.loadCandidatesFromWikiRedirect(filename, start, end)
         elif type == SOURCE[4]:
-            mention_dict, entity_set = self.loadCandidatesFromDict(filename)
+            # priors are averaged after all ranges are merged
+            mention_dict, entity_set = self.loadCandidatesFromDict(filename, start, end, average=False)
         elif type == SOURCE[5]:
-            mention_dict, entity_set = self.loadCandidatesFromYago(filename)
-            is_uniform = True
+            mention_dict, entity_set = self.loadCandidatesFromYago(filename, start, end)
         elif type == SOURCE[6]:
-            mention_dict, entity_set = self.loadCandidatesFromNcel(filename)
-
-        return is_uniform, mention_dict, entity_set
+            mention_dict, entity_set = self.loadCandidatesFromNcel(filename, start, end)
+        return mention_dict, entity_set
 
     # <string><tab><cprob><tab><id>
     def saveCandidatesToFile(self, filename):
         with open(filename, 'w', encoding='UTF-8') as fout:
             for m in self._mention_dict:
                 for c in self._mention_dict[m]:
-                    fout.write("{}\t{}\t{}\n".format(m, c[1], c[0]))
+                    fout.write("{}\t{}\t{}\n".format(m, c[1], self._interner.strings[c[0]]))
 
     def candidateSoftmax(self, cand_list):
         total_prior = sum([cand[1] for cand in cand_list])
@@ -132,16 +384,16 @@ class CandidatesHandler:
         return new_cands
 
     # wiki redirect
-    def loadCandidatesFromWikiRedirect(self, filename):
+    def loadCandidatesFromWikiRedirect(self, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
-        with open(filename, 'r', encoding='UTF-8') as fin:
+        with openFileRange(filename, start, end) as fin:
             for line in fin:
                 items = re.split(r'\t', line.strip())
                 m_str = items[0]
                 if self._lowercase: m_str = m_str.lower()
-                if len(items) < 2 or (not isinstance(self._vocab, type(None)) and m_str not in self._vocab) : continue
-                ent_id = items[1]
+                if len(items) < 2 or not self.inMentionVocab(m_str) : continue
+                ent_id = self._interner.intern(items[1])
                 tmp_cand_set = mention_dict.get(m_str, set())
                 tmp_cand_set.add(ent_id)
                 mention_dict[m_str] = tmp_cand_set
@@ -150,17 +402,17 @@ class CandidatesHandler:
 
     # wiki title
     # omit brackets
-    def loadCandidatesFromWikiTitle(self, filename):
+    def loadCandidatesFromWikiTitle(self, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
         bracketRE = re.compile(r'\(.*\)')
-        with open(filename, 'r', encoding='UTF-8') as fin:
+        with openFileRange(filename, start, end) as fin:
             for line in fin:
                 items = re.split(r'\t', line.strip())
                 m_str = bracketRE.sub('', items[0]).strip()
                 if self._lowercase: m_str = m_str.lower()
-                if len(items) < 2 or (not isinstance(self._vocab, type(None)) and m_str not in self._vocab): continue
-                ent_id = items[1]
+                if len(items) < 2 or not self.inMentionVocab(m_str): continue
+                ent_id = self._interner.intern(items[1])
                 entity_set.add(ent_id)
                 tmp_cand_set = mention_dict.get(m_str, set())
                 tmp_cand_set.add(ent_id)
@@ -173,7 +425,7 @@ class CandidatesHandler:
                     for sf_m_str in sf_items:
                         if self._lowercase: sf_m_str = sf_m_str.lower()
                         # filter mention out of mention vocab
-                        if not isinstance(self._vocab, type(None)) and sf_m_str not in self._vocab: continue
+                        if not self.inMentionVocab(sf_m_str): continue
                         tmp_cand_set = mention_dict.get(sf_m_str, set())
                         tmp_cand_set.add(ent_id)
                         mention_dict[sf_m_str] = tmp_cand_set
@@ -181,40 +433,41 @@ class CandidatesHandler:
 
     # Personalized Page Rank for Named Entity Disambiguation
     # str \t id \t ...
-    def loadCandidatesFromPPR(self, filename):
+    def loadCandidatesFromPPR(self, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
-        with open(filename, 'r', encoding='UTF-8') as fin:
+        with openFileRange(filename, start, end) as fin:
             for line in fin:
                 if self._lowercase : line = line.lower()
                 items = re.split(r'\t', line.strip())
                 ment_name = items[0]
                 if len(items) < 2: continue
                 # filter mention out of mention vocab
-                if not isinstance(self._vocab, type(None)) and ment_name not in self._vocab: continue
+                if not self.inMentionVocab(ment_name): continue
                 tmp_cand_set = mention_dict.get(ment_name, set())
-                tmp_cand_set.update(items[1:])
-                entity_set.update(items[1:])
+                ent_ids = [self._interner.intern(item) for item in items[1:]]
+                tmp_cand_set.update(ent_ids)
+                entity_set.update(ent_ids)
                 mention_dict[ment_name] = tmp_cand_set
         return mention_dict, entity_set
 
     # anchors
     # enti_id \t gobal_prior \t cand_ment::=count \t ...
-    def loadCandidatesFromWikiAnchor(self, filename):
+    def loadCandidatesFromWikiAnchor(self, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
-        with open(filename, 'r', encoding='UTF-8') as fin:
+        with openFileRange(filename, start, end) as fin:
             for line in fin:
                 if self._lowercase: line = line.lower()
                 items = re.split(r'\t', line.strip())
                 if len(items) < 3 : continue
-                ent_id = items[0]
+                ent_id = self._interner.intern(items[0])
                 for ment_count in items[2:]:
                     mc = ment_count.split('::=')
                     if len(mc) != 2: continue
                     m_str = mc[0]
                     count = float(mc[1])
-                    if not isinstance(self._vocab, type(None)) and m_str not in self._vocab: continue
+                    if not self.inMentionVocab(m_str): continue
                     tmp_cand = mention_dict.get(m_str, {})
                     tmp_count = tmp_cand.get(ent_id, 0.0)
                     tmp_cand[ent_id] = tmp_count + count
@@ -224,40 +477,39 @@ class CandidatesHandler:
 
     # A cross-lingual dictionary for english wikipedia con- cepts
     # <string><tab><cprob><space><url>[<space><score>]*
-    def loadCandidatesFromDict(self, filename):
+    def loadCandidatesFromDict(self, filename, start=0, end=None, average=True):
         mention_dict = {}
         entity_set = set()
         assert self._label2id is not None, "Dict needs label2id dict!"
-        with open(filename, 'r', encoding='UTF-8', errors='ignore') as fin:
+        with openFileRange(filename, start, end, errors='ignore') as fin:
             for line in fin:
                 items = re.split(r'\t', line.strip())
                 if len(items) < 2 : continue
                 m_str = items[0]
                 if self._lowercase: m_str = m_str.lower()
-                if not isinstance(self._vocab, type(None)) and m_str not in self._vocab: continue
+                if not self.inMentionVocab(m_str): continue
                 tmp_items = items[1].split(' ')
                 if len(tmp_items) < 2 : continue
                 cprob = float(tmp_items[0])
                 wiki_label = re.sub(r'_', ' ', tmp_items[1])
                 if wiki_label not in self._label2id : continue
-                ent_id = self._label2id[wiki_label]
+                ent_id = self._interner.intern(self._label2id[wiki_label])
                 entity_set.add(ent_id)
                 tmp_cand = mention_dict.get(m_str, {})
-                if ent_id in tmp_cand:
-                    tmp_cand[ent_id] = (tmp_cand[ent_id] + cprob ) / 2.0
-                else:
-                    tmp_cand[ent_id] = cprob
+                tmp_cand.setdefault(ent_id, []).append(cprob)
                 mention_dict[m_str] = tmp_cand
+        if average:
+            averageDictPriors(mention_dict)
         return mention_dict, entity_set
 
     # <Alexander_de_Brus,_Earl_of_Carrick> \t rdfs:label \t "Alexander de Brus, Earl of Carrick"@eng .
     # <wordnet_superfecta_100507539> \t skos:prefLabel \t "superfecta"@eng .
     # <Edward_Berkowitz> \t <redirectedFrom> \t "Edward D. Berkowitz"@eng .
-    def loadCandidatesFromYago(self, filename):
+    def loadCandidatesFromYago(self, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
         assert self._label2id is not None, "Yago needs label2id dict!"
-        with open(filename, 'r', encoding='UTF-8') as fin:
+        with openFileRange(filename, start, end) as fin:
             for line in fin:
                 line = line.strip()
                 items = re.split(r'\t', line.strip())
@@ -265,10 +517,10 @@ class CandidatesHandler:
                       '<redirectedFrom>'] or not items[2].endswith('@eng .'): continue
                 m_str = items[2][:-6].strip('"')
                 if self._lowercase: m_str = m_str.lower()
-                if not isinstance(self._vocab, type(None)) and m_str not in self._vocab: continue
+                if not self.inMentionVocab(m_str): continue
                 wiki_label = re.sub(r'_', ' ', items[0].strip('<>'))
                 if wiki_label not in self._label2id: continue
-                ent_id = self._label2id[wiki_label]
+                ent_id = self._interner.intern(self._label2id[wiki_label])
                 entity_set.add(ent_id)
                 tmp_cand_set = mention_dict.get(m_str, set())
                 tmp_cand_set.add(ent_id)
@@ -276,18 +528,18 @@ class CandidatesHandler:
         return mention_dict, entity_set
 
     # <string><tab><cprob><tab><id>
-    def loadCandidatesFromNcel(self, filename):
+    def loadCandidatesFromNcel(self, filename, start=0, end=None):
         mention_dict = {}
         entity_set = set()
-        with open(filename, 'r', encoding='UTF-8') as fin:
+        with openFileRange(filename, start, end) as fin:
             for line in fin:
                 items = re.split(r'\t', line.strip())
                 if len(items) < 3: continue
                 m_str = items[0]
                 if self._lowercase: m_str = m_str.lower()
-                if not isinstance(self._vocab, type(None)) and m_str not in self._vocab: continue
+                if not self.inMentionVocab(m_str): continue
                 cprob = float(items[1])
-                ent_id = items[2]
+                ent_id = self._interner.intern(items[2])
                 entity_set.add(ent_id)
                 tmp_cand = mention_dict.get(m_str, {})
                 tmp_cand[ent_id] = cprob
@@ -297,7 +549,7 @@ class CandidatesHandler:
     # return an ordered candidates list
     def get_candidates_for_mention(self, mention, vocab=None, topn=0):
         assert self._mention_dict is not None, "load candidates first!"
-        cand_list = self._mention_dict.get(mention._mention_str, [])
+        cand_list = self.lookupCandidates(mention._mention_str)
 
         candidates = []
         # trim candidate sets by vocab
@@ -306,7 +558,7 @@ class CandidatesHandler:
                 c = Candidate(mention, cand[0])
                 c.setEntityMentionPrior(cand[1])
                 if self._id2label is not None:
-                    c.setLabel(self._id2label[cand[0]] if cand[0] in self._id2label else '')
+                    c.setLabel(self._id2label.get(self._interner.strings[cand[0]], ''))
                 candidates.append(c)
         # crop by topn
         if topn > 0 and len(candidates) > topn:
@@ -327,6 +579,8 @@ def getCandidateHandler():
     return CandidatesHandler
 
 class Candidate():
+    __slots__ = ('id', 'label', '_sense_id', '_mention', '_is_gold', '_pem', '_base', '_yamada_emb')
+
     def __init__(self, mention, id, label=None):
         self.id = id
         self.label = label
@@ -338,16 +592,17 @@ class Candidate():
         self._is_gold = False
         # base
         self._pem = DEFAULT_PRIOR
+        # row in the base feature matrix of the document
         self._base = None
 
     def setLabel(self, label):
         self.label = label
 
-    def setBaseFeature(self, f):
-        self._base = f
+    def setBaseRow(self, row):
+        self._base = row
 
     def getBaseFeature(self):
-        return self._base
+        return self._mention._document.base_features[self._base]
 
     def setSense(self, id):
         self._sense_id = id
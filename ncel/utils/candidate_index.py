@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+from collections.abc import Mapping
+
+import numpy as np
+from pyxdameraulevenshtein import damerau_levenshtein_distance
+
+# files of a compiled candidate index directory
+INDEX_MENTIONS = 'mentions.npy'             # uint8 blob of sorted utf-8 mention strings
+INDEX_MENTION_OFFSETS = 'mention_offsets.npy'   # int64, n_mentions + 1
+INDEX_CANDIDATE_OFFSETS = 'candidate_offsets.npy'   # int64, n_mentions + 1
+INDEX_ENTITIES = 'entities.npy'             # int32 rows of the entity table
+INDEX_PRIORS = 'priors.npy'                 # float32, softmaxed
+INDEX_ENTITY_TABLE = 'entities.txt'         # one entity id per line
+INDEX_SETTINGS = 'settings.txt'             # setting \t value per line, see CandidatesHandler.indexSettings
+
+# mentions setting of an index compiled without a mention vocab
+ALL_MENTIONS = 'all'
+
+# per query bounds of fuzzy lookups
+MIN_FUZZY_LENGTH = 4
+MAX_FUZZY_LENGTH = 40
+MAX_FUZZY_CHECKS = 32
+
+def IsCandidateIndex(path):
+    return path is not None and os.path.isfile(os.path.join(path, INDEX_PRIORS))
+
+def SaveCandidateIndex(path, mention_dict, entity_strings=None, settings=None):
+    """Compiles {mention: [[ent_id, prior], ...]} into an index directory.
+    Mentions are sorted by their utf-8 bytes so lookups can bisect them.
+    Interned entity ids are written as entity_strings[ent_id], settings the
+    candidates were built with are kept to check the index before reuse."""
+    keys = sorted([m.encode('utf-8') for m in mention_dict])
+    mention_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    candidate_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    entity_rows = {}
+    entities = []
+    priors = []
+    for i, key in enumerate(keys):
+        for ent_id, prior in mention_dict[key.decode('utf-8')]:
+            entities.append(entity_rows.setdefault(ent_id, len(entity_rows)))
+            priors.append(prior)
+        mention_offsets[i + 1] = mention_offsets[i] + len(key)
+        candidate_offsets[i + 1] = len(entities)
+
+    tmp_path = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, INDEX_MENTIONS), np.frombuffer(b''.join(keys), dtype=np.uint8))
+    np.save(os.path.join(tmp_path, INDEX_MENTION_OFFSETS), mention_offsets)
+    np.save(os.path.join(tmp_path, INDEX_CANDIDATE_OFFSETS), candidate_offsets)
+    np.save(os.path.join(tmp_path, INDEX_ENTITIES), np.asarray(entities, dtype=np.int32))
+    np.save(os.path.join(tmp_path, INDEX_PRIORS), np.asarray(priors, dtype=np.float32))
+    with open(os.path.join(tmp_path, INDEX_ENTITY_TABLE), 'w', encoding='UTF-8') as fout:
+        for ent_id in sorted(entity_rows, key=entity_rows.get):
+            fout.write((entity_strings[ent_id] if entity_strings is not None else ent_id) + '\n')
+    with open(os.path.join(tmp_path, INDEX_SETTINGS), 'w', encoding='UTF-8') as fout:
+        for name, value in sorted((settings or {}).items()):
+            fout.write("{}\t{}\n".format(name, value))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return len(keys), len(entities)
+
+# {setting: value} saved with an index, empty for indexes saved without them
+def LoadCandidateIndexSettings(path):
+    settings_path = os.path.join(path, INDEX_SETTINGS)
+    if not os.path.isfile(settings_path): return {}
+    with open(settings_path, 'r', encoding='UTF-8') as fin:
+        return dict(line.rstrip('\n').split('\t', 1) for line in fin if '\t' in line)
+
+class CandidateIndex(Mapping):
+    """Read-only view of a compiled candidate index, a drop-in for the
+    {mention: [[ent_id, prior], ...]} dict of CandidatesHandler. The arrays
+    are memory mapped, so processes reading the same index share one copy
+    through the page cache. With an interner, entity ids are interned ints."""
+    def __init__(self, path, interner=None):
+        self._path = path
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode='r')
+        self._mentions = load(INDEX_MENTIONS)
+        self._mention_offsets = load(INDEX_MENTION_OFFSETS)
+        self._candidate_offsets = load(INDEX_CANDIDATE_OFFSETS)
+        self._entities = load(INDEX_ENTITIES)
+        self._priors = load(INDEX_PRIORS)
+        with open(os.path.join(path, INDEX_ENTITY_TABLE), 'r', encoding='UTF-8') as fin:
+            self.entity_ids = fin.read().split('\n')[:-1]
+        if interner is not None:
+            self.entity_ids = [interner.intern(entity) for entity in self.entity_ids]
+        self._n = len(self._mention_offsets) - 1
+
+    def _key(self, i):
+        return self._mentions[self._mention_offsets[i]:self._mention_offsets[i+1]].tobytes()
+
+    def find(self, mention):
+        # bisect the sorted mention table, -1 if absent
+        key = mention.encode('utf-8')
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._n and self._key(lo) == key else -1
+
+    def entityRows(self, i):
+        start, end = self._candidate_offsets[i], self._candidate_offsets[i+1]
+        return self._entities[start:end], self._priors[start:end]
+
+    def __getitem__(self, mention):
+        i = self.find(mention)
+        if i < 0:
+            raise KeyError(mention)
+        rows, priors = self.entityRows(i)
+        return [[self.entity_ids[row], prior] for row, prior in zip(rows.tolist(), priors.tolist())]
+
+    def __contains__(self, mention):
+        return self.find(mention) >= 0
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self._key(i).decode('utf-8')
+
+    def __len__(self):
+        return self._n
+
+    def totalCandidates(self):
+        return int(self._candidate_offsets[-1])
+
+# strings left after deleting up to max_distance characters of s
+def deletesWithin(s, max_distance):
+    deletes = {s}
+    frontier = {s}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i+1:] for w in frontier for i in range(len(w))}
+        deletes |= frontier
+    return deletes
+
+class FuzzyMentionIndex:
+    """SymSpell style deletion index: two strings within max_distance edits
+    share a string left after up to max_distance deletions, so a query only
+    probes its own deletions and verifies a bounded number of hits."""
+    def __init__(self, mentions, max_distance=1, max_length=MAX_FUZZY_LENGTH,
+                 max_checks=MAX_FUZZY_CHECKS):
+        self._max_distance = max_distance
+        self._max_length = max_length
+        self._max_checks = max_checks
+        self._mentions = []
+        self._deletes = {}
+        # sorted, so the bounded scan of lookup does not depend on the order of mentions
+        for m in sorted(mentions):
+            if len(m) < MIN_FUZZY_LENGTH or len(m) > max_length: continue
+            for d in deletesWithin(m, max_distance):
+                self._deletes.setdefault(d, []).append(len(self._mentions))
+            self._mentions.append(m)
+
+    # the closest indexed mention within max_distance, None if there is none
+    def lookup(self, query):
+        if len(query) < MIN_FUZZY_LENGTH or len(query) > self._max_length: return None
+        best, best_dist = None, self._max_distance + 1
+        checked = set()
+        # longest deletes first, ties in string order rather than the order of the set
+        for d in sorted(deletesWithin(query, self._max_distance), key=lambda d: (-len(d), d)):
+            for i in self._deletes.get(d, []):
+                if i in checked: continue
+                checked.add(i)
+                dist = damerau_levenshtein_distance(query, self._mentions[i])
+                if dist > self._max_distance: pass
+                elif dist < best_dist or (dist == best_dist and self._mentions[i] < best):
+                    best, best_dist = self._mentions[i], dist
+                if len(checked) >= self._max_checks:
+                    return best
+        return best
+
+    def __len__(self):
+        return len(self._mentions)
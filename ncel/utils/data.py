@@ -4,12 +4,18 @@
 import random
 import time
 import sys
-import struct
+import os
+import re
+import mmap
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from ncel.utils.layers import buildGraph
+from ncel.utils.layers import buildGraph, buildSparseGraph
 
 from ncel.utils.misc import Accumulator
+from ncel.utils.string_features import LogStringFeatureStats
 
 PADDING_TOKEN = "_PAD"
 # UNK must be existed in pre-trained embeddings
@@ -123,13 +129,14 @@ def get_batch(batch, local_window, m_str_length=3, use_lr_context=True, split_by
     token_pad = CORE_VOCABULARY[PADDING_TOKEN]
     entity_pad = CORE_ENTITY_VOCABULARY[PADDING_ENTITY]
     sense_pad = CORE_SENSE_VOCABULARY[PADDING_SENSE]
-    feature_pad = 0.0
-    base_feature_dim = -1
+    base_feature_dim = next((doc.base_features.shape[1] for doc in docs if doc.base_features is not None), 0)
+    # padded candidate rows keep zero base features
+    B = np.zeros((len(num_candidates), max_cand_num, base_feature_dim), dtype=np.float32)
+    m_idx = 0
 
     C1 = []
     C2 = []
     MS = []
-    B = []
     CID = []
     CID_sense = []
     Y = []
@@ -141,7 +148,6 @@ def get_batch(batch, local_window, m_str_length=3, use_lr_context=True, split_by
             con1 = []
             con2 = []
             ms = []
-            base = []
             cids = []
             cids_sense = []
             num_m = []
@@ -164,10 +170,10 @@ def get_batch(batch, local_window, m_str_length=3, use_lr_context=True, split_by
             elif diff < 0:
                 tmp_m_str = tmp_m_str[:m_str_length]
 
+            B[m_idx, :len(m.candidates)] = doc.base_features[[c._base for c in m.candidates]]
+            m_idx += 1
             gold_idx = -1
             for j, c in enumerate(m.candidates):
-                base.append(c.getBaseFeature())
-                if base_feature_dim <= 0: base_feature_dim = len(c.getBaseFeature())
                 con1.append(tmp_con1)
                 con2.append(tmp_con2)
                 ms.append(tmp_m_str)
@@ -182,11 +188,9 @@ def get_batch(batch, local_window, m_str_length=3, use_lr_context=True, split_by
             # padding current mention candidate to max_cand_num
             paddings = max_cand_num - len(m.candidates)
             if paddings > 0:
-                base_vec = [feature_pad] * base_feature_dim
                 token_vec = [token_pad] * local_window
                 str_vec = [token_pad] * m_str_length
                 for k in range(paddings):
-                    base.append(base_vec)
                     con1.append(token_vec)
                     con2.append(token_vec)
                     ms.append(str_vec)
@@ -194,7 +198,6 @@ def get_batch(batch, local_window, m_str_length=3, use_lr_context=True, split_by
                     cids_sense.append(sense_pad)
                     num_m.append(0 if (i + 1) == tmp_ment_len else 1)
                     y.append(0)
-            B.append(base)
             C1.append(con1)
             C2.append(con2)
             MS.append(ms)
@@ -210,35 +213,91 @@ def get_batch(batch, local_window, m_str_length=3, use_lr_context=True, split_by
         C1 = np.concatenate((C1, C2), axis=2)
         C2 = None
 
-    return np.array(B), C1, C2, np.array(MS), np.array(CID), np.array(CID_sense), num_candidates, np.array(Num_mentions), np.array(Y)
+    return B, C1, C2, np.array(MS), np.array(CID), np.array(CID_sense), num_candidates, np.array(Num_mentions), np.array(Y)
+
+# x : node * features, nodes of all documents stacked if packed
+# adj : CSR arrays if packed, else batch * node_num * node_num
+# length: batch (actual nodes)
+# nodes : (mention, candidate) of each node, mentions numbered as in get_batch
+def get_graph_batch(batch, entity_embeddings, packed=True, thred=0, topk=10):
+    """One graph per document, its nodes are the candidates of all mentions
+    with their base features. Packed batches keep the topk edges of each
+    node, see buildSparseGraph, padded ones the full graph of buildGraph."""
+    xs, graphs = [], []
+    m_rows, c_cols = [], []
+    m_idx = 0
+    for doc in batch:
+        ids = []
+        for i, m in enumerate(doc.mentions):
+            for j, c in enumerate(m.candidates):
+                ids.append((c.id, i))
+                m_rows.append(m_idx + i)
+                c_cols.append(j)
+        m_idx += len(doc.mentions)
+        xs.append(doc.base_features[[c._base for m in doc.mentions for c in m.candidates]])
+        if packed:
+            graphs.append(buildSparseGraph(ids, entity_embeddings, thred=thred, topk=topk))
+        else:
+            graphs.append(buildGraph(ids, entity_embeddings, thred=thred))
+    length = np.array([x.shape[0] for x in xs])
+    # the labels of the nodes are unused, get_batch gives the gold candidate of each mention
+    ys = [np.zeros(n) for n in length]
+    if packed:
+        x, adj, _, _ = PackDocuments(xs, graphs, ys)
+    else:
+        padded = [PadDocument(x, adj, y, length.max()) for x, adj, y in zip(xs, graphs, ys)]
+        x = np.stack([p[0] for p in padded]).astype(np.float32)
+        adj = np.stack([p[1] for p in padded]).astype(np.float32)
+    return x, adj, length, (np.array(m_rows), np.array(c_cols))
+
+# steps of preprocessing count into stats, they log at their end unless
+# a caller passes stats to merge the counts of several chunks first
+def _stepStats(stats):
+    return Counter() if stats is None else stats
 
 def AddCandidatesToDocs(dataset, candidate_handler, vocab=None, topn=0,
-                        include_unresolved=False, logger=None):
+                        include_unresolved=False, logger=None, stats=None):
+    log_stats, stats = stats is None, _stepStats(stats)
     for i, doc in enumerate(dataset):
         candidate_handler.add_candidates_to_document(dataset[i], vocab=vocab,topn=topn)
+    stats['cand_candidates'] += sum([doc.n_candidates for doc in dataset])
+    stats['cand_mentions'] += sum([len(doc.mentions) for doc in dataset])
+    stats['cand_docs'] += len(dataset)
+    if log_stats: LogCandidateStats(stats, logger)
+
+def LogCandidateStats(stats, logger):
     if logger is not None:
         logger.Log("Add candidates success: totally {} candidates of {} mentions in {} documents!".format(
-            sum([doc.n_candidates for doc in dataset]), sum([len(doc.mentions) for doc in dataset]), len(dataset)))
-
-def BuildVocabulary(raw_training_data, raw_eval_sets, word_embedding_path, logger=None):
+            stats['cand_candidates'], stats['cand_mentions'], stats['cand_docs']))
+
+# adds the words and mentions of dataset to the sets, and updates mention sent index
+def CollectVocabularyStats(dataset, words_in_data, mentions_in_data):
+    for j, doc in enumerate(dataset):
+        words_in_data.update(doc.tokens)
+        for k, mention in enumerate(doc.mentions):
+            if not mention._is_trainable : continue
+            mentions_in_data.add(mention._mention_str)
+            dataset[j].mentions[k].updateSentIdxByTokenIdx()
+    return words_in_data, mentions_in_data
+
+# training_stats: (words, mentions) collected from training documents that are not kept in memory
+def BuildVocabulary(raw_training_data, raw_eval_sets, word_embedding_path, logger=None,
+                    training_stats=None):
     # Find the set of words that occur in the data.
     logger.Log("Constructing vocabulary...")
 
     words_in_data = set()
     mentions_in_data = set()
+    if training_stats is not None:
+        words_in_data.update(training_stats[0])
+        mentions_in_data.update(training_stats[1])
     datasets = []
     if raw_training_data is not None:
         datasets.append(raw_training_data)
     for eval_set in raw_eval_sets:
         datasets.append(eval_set)
-    for i, dataset in enumerate(datasets):
-        for j, doc in enumerate(dataset):
-            words_in_data.update(doc.tokens)
-            for k, mention in enumerate(doc.mentions):
-                if not mention._is_trainable : continue
-                mentions_in_data.add(mention._mention_str)
-                datasets[i][j].mentions[k].updateSentIdxByTokenIdx()
-        # update mention sent index
+    for dataset in datasets:
+        CollectVocabularyStats(dataset, words_in_data, mentions_in_data)
 
     logger.Log("Found " + str(len(words_in_data)) + " word types.")
     logger.Log("Found " + str(len(mentions_in_data)) + " mention types.")
@@ -250,11 +309,15 @@ def BuildVocabulary(raw_training_data, raw_eval_sets, word_embedding_path, logge
 
     return word_vocabulary, mentions_in_data
 
-def BuildEntityVocabulary(candidate_entities, entity_embedding_file, sense_embedding_file=None, logger=None):
+def BuildEntityVocabulary(candidate_entities, entity_embedding_file, sense_embedding_file=None, logger=None,
+                          interner=None):
     # Find the set of words that occur in the data.
     logger.Log("Constructing entity vocabulary...")
 
     logger.Log("Found " + str(len(candidate_entities)) + " entity types.")
+    # embedding files are labeled by id strings
+    if interner is not None:
+        candidate_entities = set([interner.strings[id] for id in candidate_entities])
 
     entity_vocabulary = BuildVocabularyForBinaryEmbeddingFile(
         entity_embedding_file, candidate_entities, CORE_ENTITY_VOCABULARY)
@@ -267,231 +330,367 @@ def BuildEntityVocabulary(candidate_entities, entity_embedding_file, sense_embed
     return entity_vocabulary, sense_vocabulary
 
 def BuildVocabularyForBinaryEmbeddingFile(path, types_in_data, core_vocabulary, isSense=False):
-    """Quickly iterates through a GloVe-formatted text vector file to
+    """Quickly iterates through a word2vec-formatted binary vector file to
     extract a working vocabulary of words that occur both in the data and
     in the vector file."""
+    layout = LoadEmbeddingFileLayout(path, isSense=isSense)
+    _embedding_layouts[(path, isSense)] = layout
+    labels, _, _ = layout
+    return VocabularyFromLabels(labels, types_in_data, core_vocabulary)
 
-    num_embeddings = 4 if not isSense else 8
-
+def VocabularyFromLabels(labels, types_in_data, core_vocabulary):
     vocabulary = {}
     vocabulary.update(core_vocabulary)
     next_index = len(vocabulary)
-    vocab_size = 0
-    with open(path, 'rb') as f:
-        # read file head: vocab size and layer size
-        char_set = []
-        while True:
-            ch = f.read(1)
-            if ch == b' ' or ch == b'\t':
-                vocab_size = (int)(b''.join(char_set).decode())
-                del char_set[:]
-                continue
-            if ch == b'\n':
-                layer_size = (int)(b''.join(char_set).decode())
-                break
-            char_set.append(ch)
-        for i in range(vocab_size):
-            # read entity label
-            del char_set[:]
-            while True:
-                ch = struct.unpack('c', f.read(1))[0]
-                # add split interval white space
-                if ch == b' ' or ch == b'\t':
-                    break
-                char_set.append(ch)
-            word = b''.join(char_set)
-            word = word.decode('utf-8', 'ignore')
-            f.read(num_embeddings * layer_size)
-            if word in types_in_data and word not in vocabulary:
-                vocabulary[word] = next_index
-                next_index += 1
-            f.read(1)  # \n
+    for word in labels:
+        if word in types_in_data and word not in vocabulary:
+            vocabulary[word] = next_index
+            next_index += 1
     return vocabulary
 
-def initVectorFormat(size):
-    tmp_struct_fmt = []
-    for i in range(size):
-        tmp_struct_fmt.append('f')
-    p_struct_fmt = "".join(tmp_struct_fmt)
-    return p_struct_fmt
+_LABEL_SEP_RE = re.compile(b'[ \t]')
+
+# scanned (labels, offsets, layer_size) kept between building a vocabulary
+# and loading its embeddings, so that each file is only scanned once
+_embedding_layouts = {}
+
+def ScanBinaryEmbeddingFile(path, isSense=False):
+    """Memory-maps a word2vec-style binary file and returns its labels, the
+    byte offset of each label's vector and the layer size. Vector bytes are
+    skipped, never read; the sense format stores vector and mu (8 * layer bytes)."""
+    num_embeddings = 4 if not isSense else 8
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # read file head: vocab size and layer size
+            eol = mm.find(b'\n')
+            vocab_size, layer_size = [int(x) for x in mm[:eol].split()]
+            record_bytes = num_embeddings * layer_size
+            labels = []
+            offsets = []
+            search = _LABEL_SEP_RE.search
+            pos = eol + 1
+            for i in range(vocab_size):
+                # label ends at the first split interval white space
+                sep = search(mm, pos)
+                labels.append(mm[pos:sep.start()].decode('utf-8', 'ignore'))
+                offsets.append(sep.end())
+                # skip vectors and \n
+                pos = sep.end() + record_bytes + 1
+        finally:
+            mm.close()
+    return labels, np.array(offsets, dtype=np.int64), layer_size
+
+EMBEDDING_INDEX_SUFFIX = '.idx.npz'
+
+def _fileStamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def LoadEmbeddingFileLayout(path, isSense=False):
+    """Returns (labels, offsets, layer_size) of an embedding file, from the
+    sidecar index next to it when it matches the file's size and mtime,
+    otherwise by scanning the file and (re)writing the sidecar."""
+    if IsNpyEmbeddingFile(path):
+        return LoadNpyEmbeddingFileLayout(path, isSense=isSense)
+    index_path = path + EMBEDDING_INDEX_SUFFIX
+    size, mtime = _fileStamp(path)
+    if os.path.isfile(index_path):
+        with np.load(index_path) as index:
+            # meta: file size, mtime, isSense, vocab size, layer size
+            meta = index['meta'].tolist()
+            if meta[:3] == [size, mtime, int(isSense)]:
+                labels = index['labels'].tobytes().decode('utf-8').split('\n') if meta[3] > 0 else []
+                return labels, index['offsets'], meta[4]
+    labels, offsets, layer_size = ScanBinaryEmbeddingFile(path, isSense=isSense)
+    SaveEmbeddingFileIndex(index_path, labels, offsets, layer_size, size, mtime, isSense)
+    return labels, offsets, layer_size
+
+def SaveEmbeddingFileIndex(index_path, labels, offsets, layer_size, size, mtime, isSense=False):
+    # labels are stored '\n' joined, skip files whose labels contain one
+    if any('\n' in label for label in labels): return
+    meta = np.array([size, mtime, int(isSense), len(offsets), layer_size], dtype=np.int64)
+    blob = np.frombuffer('\n'.join(labels).encode('utf-8'), dtype=np.uint8)
+    tmp_path = index_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, meta=meta, labels=blob, offsets=offsets)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # read-only embedding directory, scan again next time
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def GatherVectorsFromBinary(path, offsets, embedding_dim, chunk_size=4096):
+    """Reads float32 vectors at the given byte offsets by fancy indexing a
+    memory-mapped view of the file, chunk by chunk."""
+    emb = np.zeros((len(offsets), embedding_dim), dtype=np.float32)
+    if len(offsets) == 0:
+        return emb
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    byte_range = np.arange(4 * embedding_dim, dtype=np.int64)
+    for start in range(0, len(offsets), chunk_size):
+        idx = offsets[start:start + chunk_size, None] + byte_range
+        emb[start:start + chunk_size] = data[idx].view(np.float32)
+    del data
+    return emb
 
 def LoadEmbeddingsFromBinary(vocabulary, embedding_dim, path, isSense=False):
     """Prepopulates a numpy embedding matrix indexed by vocabulary with
     values from a vector file.
 
     For now, values not found in the file will be set to zero."""
+    layout = _embedding_layouts.pop((path, isSense), None)
+    if layout is None:
+        layout = LoadEmbeddingFileLayout(path, isSense=isSense)
+    labels, offsets, layer_size = layout
+    assert layer_size == embedding_dim, "No matched embeddings dimension."
+    # the last record of a label wins, as in a sequential read
+    rows = {}
     loaded = 0
-    emb = np.zeros( (len(vocabulary), embedding_dim), dtype=np.float32)
-    emb_mu = np.zeros((len(vocabulary), embedding_dim), dtype=np.float32) if isSense else None
-    vocab_size = 0
-    layer_size = 0
-    with open(path, 'rb') as f:
-        # read file head: vocab size and layer size
-        char_set = []
-        while True:
-            ch = f.read(1)
-            if ch == b' ' or ch == b'\t':
-                vocab_size = (int)(b''.join(char_set).decode())
-                del char_set[:]
-                continue
-            if ch == b'\n':
-                layer_size = (int)(b''.join(char_set).decode())
-                break
-            char_set.append(ch)
-        assert layer_size == embedding_dim, "No matched embeddings dimension."
-        p_struct_fmt = initVectorFormat(embedding_dim)
-        for i in range(vocab_size):
-            # read entity label
-            del char_set[:]
-            while True:
-                ch = struct.unpack('c', f.read(1))[0]
-                # add split interval white space
-                if ch == b' ' or ch == b'\t':
-                    break
-                char_set.append(ch)
-            word = b''.join(char_set)
-            word = word.decode('utf-8', 'ignore')
-            tmp_vec = np.array(struct.unpack(p_struct_fmt, f.read(4 * embedding_dim)), dtype=float)
-            # context cluster senter
-            if isSense:
-                tmp_mu = np.array(struct.unpack(p_struct_fmt, f.read(4 * embedding_dim)), dtype=float)
-            if word in vocabulary:
-                emb[vocabulary[word], :] = tmp_vec
-                if isSense:
-                    emb_mu[vocabulary[word], :] = tmp_mu
-                loaded += 1
-            f.read(1)  # \n
+    for i, word in enumerate(labels):
+        if word in vocabulary:
+            rows[vocabulary[word]] = i
+            loaded += 1
     assert loaded > 0, "No word embeddings of correct size found in file."
+    vocab_ids = np.fromiter(rows.keys(), dtype=np.int64, count=len(rows))
+    record_idx = np.fromiter(rows.values(), dtype=np.int64, count=len(rows))
+
+    if IsNpyEmbeddingFile(path):
+        # offsets are row indices, rows are gathered from the mapped matrix
+        matrix = np.load(path, mmap_mode='r')
+        rows = np.asarray(matrix[offsets[record_idx]], dtype=np.float32)
+        del matrix
+        emb = np.zeros((len(vocabulary), embedding_dim), dtype=np.float32)
+        emb[vocab_ids] = rows[:, 0] if isSense else rows
+        if isSense:
+            emb_mu = np.zeros((len(vocabulary), embedding_dim), dtype=np.float32)
+            emb_mu[vocab_ids] = rows[:, 1]
+            return emb, emb_mu
+        return emb
+
+    emb = np.zeros((len(vocabulary), embedding_dim), dtype=np.float32)
+    emb[vocab_ids] = GatherVectorsFromBinary(path, offsets[record_idx], embedding_dim)
     if isSense:
+        # context cluster senter
+        emb_mu = np.zeros((len(vocabulary), embedding_dim), dtype=np.float32)
+        emb_mu[vocab_ids] = GatherVectorsFromBinary(path, offsets[record_idx] + 4 * embedding_dim,
+                                                    embedding_dim)
         return emb, emb_mu
     else:
         return emb
 
+# native format: <prefix>.npy float32 matrix, (n, dim) or (n, 2, dim) for
+# sense and mu, and <prefix>.vocab with one label per line
+NPY_SUFFIX = '.npy'
+NPY_VOCAB_SUFFIX = '.vocab'
+
+def IsNpyEmbeddingFile(path):
+    return path.endswith(NPY_SUFFIX)
+
+def LoadNpyEmbeddingFileLayout(path, isSense=False):
+    matrix = np.load(path, mmap_mode='r')
+    assert matrix.dtype == np.float32 and matrix.ndim == (3 if isSense else 2), \
+        "Error: {} is not a {} embedding matrix!".format(path, 'sense' if isSense else 'float32')
+    with open(path[:-len(NPY_SUFFIX)] + NPY_VOCAB_SUFFIX, 'r', encoding='UTF-8') as fin:
+        labels = fin.read().split('\n')[:matrix.shape[0]]
+    assert len(labels) == matrix.shape[0], "Error: unmatched vocab and embedding matrix!"
+    return labels, np.arange(matrix.shape[0], dtype=np.int64), matrix.shape[-1]
+
+def ConvertBinaryEmbeddingFile(path, out_prefix, isSense=False, chunk_size=65536):
+    """Converts a word2vec-style binary file to <out_prefix>.npy and
+    <out_prefix>.vocab, the sense format to a (n, 2, dim) matrix of vector
+    and mu."""
+    labels, offsets, layer_size = LoadEmbeddingFileLayout(path, isSense=isSense)
+    assert not any('\n' in label for label in labels), "Error: label with line break!"
+    shape = (len(labels), 2, layer_size) if isSense else (len(labels), layer_size)
+    matrix = np.lib.format.open_memmap(out_prefix + NPY_SUFFIX, mode='w+',
+                                       dtype=np.float32, shape=shape)
+    for start in range(0, len(labels), chunk_size):
+        chunk = offsets[start:start + chunk_size]
+        if isSense:
+            matrix[start:start + chunk_size, 0] = GatherVectorsFromBinary(path, chunk, layer_size)
+            matrix[start:start + chunk_size, 1] = GatherVectorsFromBinary(path,
+                                                        chunk + 4 * layer_size, layer_size)
+        else:
+            matrix[start:start + chunk_size] = GatherVectorsFromBinary(path, chunk, layer_size)
+    matrix.flush()
+    del matrix
+    with open(out_prefix + NPY_VOCAB_SUFFIX, 'w', encoding='UTF-8') as fout:
+        fout.write('\n'.join(labels))
+    return len(labels), layer_size
+
+def LoadEmbeddingFilesConcurrently(jobs, num_workers=0, logger=None):
+    """Loads several embedding files at once in a thread pool, jobs are
+    (name, vocabulary, embedding_dim, path, isSense). Reading rows from the
+    mapped files releases the GIL, so files on different disks overlap while
+    reading. Matching labels to the vocabulary is a Python loop holding the
+    GIL, those parts of the files run one at a time."""
+    def load(job):
+        name, vocabulary, embedding_dim, path, isSense = job
+        start = time.time()
+        embeddings = LoadEmbeddingsFromBinary(vocabulary, embedding_dim, path, isSense=isSense)
+        return embeddings, time.time() - start
+
+    start = time.time()
+    workers = num_workers if num_workers > 0 else len(jobs)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        results = list(pool.map(load, jobs))
+    if logger is not None:
+        for (name, vocabulary, _, path, _), (_, load_time) in zip(jobs, results):
+            logger.Log("Loaded {} {} from {} in {:.2f}s.".format(len(vocabulary), name, path, load_time))
+        logger.Log("Loaded {} embedding files in {:.2f}s.".format(len(jobs), time.time() - start))
+    return [embeddings for embeddings, _ in results]
+
 # preprocess raw data
 # todo: may be not to trim dataset
-def TrimDataset(dataset, max_tokens, allow_cropping=True, logger=None):
+def TrimDataset(dataset, max_tokens, allow_cropping=True, logger=None, stats=None):
     """Avoid using excessively long training examples."""
+    log_stats, stats = stats is None, _stepStats(stats)
     # disgard over length sentence and document
     if max_tokens > 0:
         diff_text = sum([1 for doc in dataset if len(doc.tokens) <= max_tokens])
+        stats['trim_docs'] += diff_text
         if not allow_cropping:
-            if logger and diff_text > 0:
-                logger.Log(
-                    "Discarding " +
-                    str(diff_text) +
-                    " textual over-length documents.")
             dataset = [doc for doc in dataset if len(doc.tokens) <= max_tokens]
         else:
-            if logger and diff_text > 0:
-                logger.Log(
-                    "Cropping " +
-                    str(diff_text) +
-                    " textual over-length documents.")
             # cropping
             for i, doc in enumerate(dataset):
                 if len(doc.tokens) > max_tokens:
-                    # trim doc
+                    # trim doc, sentences starting past the crop are dropped
                     dataset[i].tokens = dataset[i].tokens[:max_tokens]
-                    new_sents = []
-                    sent_len = 0
-                    sent_idx = 0
-                    while sent_len < max_tokens and sent_idx < len(doc.sentences):
-                        diff = max_tokens - sent_len - len(doc.sentences[sent_idx])
-                        if diff >= 0 :
-                            new_sents.append(doc.sentences[sent_idx])
-                            sent_len += len(doc.sentences[sent_idx])
-                        else:
-                            new_sents.append(doc.sentences[sent_idx][:diff])
-                            sent_len += len(doc.sentences[sent_idx][:diff])
-                        sent_idx += 1
-                    dataset[i].sentences = new_sents
+                    offsets = np.asarray(doc.sent_offsets, dtype=np.int64)
+                    n_sents = int(np.sum(offsets[:-1] < max_tokens))
+                    dataset[i].sent_offsets = np.append(offsets[:n_sents],
+                                                        min(int(offsets[n_sents]), max_tokens))
                     # trim mentions
                     for j, mention in enumerate(doc.mentions):
                         if not mention._is_trainable: continue
                         if mention._mention_end > max_tokens:
                             dataset[i].mentions[j]._is_trainable = False
+    if log_stats: LogTrimStats(stats, max_tokens, allow_cropping=allow_cropping, logger=logger)
     return dataset
 
-def TokensToIDs(word_vocabulary, dataset, stop_words=None, logger=None):
-    """Replace strings in original boolean dataset with token IDs."""
-
-    tokens = 0
-    unks = 0
-    lowers = 0
-    raises = 0
-    sp_num = 0
+def LogTrimStats(stats, max_tokens, allow_cropping=True, logger=None):
+    if max_tokens > 0 and logger and stats['trim_docs'] > 0:
+        logger.Log(
+            ("Cropping " if allow_cropping else "Discarding ") +
+            str(stats['trim_docs']) +
+            " textual over-length documents.")
+
+# how a token type got its id, counted for the lookup rates
+TOKEN_STOP, TOKEN_EXACT, TOKEN_LOWER, TOKEN_UPPER, TOKEN_UNK = range(5)
+
+def BuildTokenIdTable(word_vocabulary, token_types, stop_words=None, unk_id=1):
+    """Ids and lookup kinds of distinct tokens: -1 for stop words, else the
+    id of the token, its lowercase or its uppercase form, else unk_id."""
+    ids = np.empty(len(token_types), dtype=np.int64)
+    kinds = np.empty(len(token_types), dtype=np.int64)
+    for i, token in enumerate(token_types):
+        if stop_words is not None and token in stop_words:
+            ids[i], kinds[i] = -1, TOKEN_STOP
+        elif token in word_vocabulary:
+            ids[i], kinds[i] = word_vocabulary[token], TOKEN_EXACT
+        elif token.lower() in word_vocabulary:
+            ids[i], kinds[i] = word_vocabulary[token.lower()], TOKEN_LOWER
+        elif token.upper() in word_vocabulary:
+            ids[i], kinds[i] = word_vocabulary[token.upper()], TOKEN_UPPER
+        else:
+            ids[i], kinds[i] = unk_id, TOKEN_UNK
+    return ids, kinds
 
-    unk_m = 0
+def TokensToIDs(word_vocabulary, dataset, stop_words=None, logger=None, stats=None):
+    """Replace strings in original boolean dataset with token IDs."""
+    log_stats, stats = stats is None, _stepStats(stats)
 
     if UNK_TOKEN in CORE_VOCABULARY:
         unk_id = CORE_VOCABULARY[UNK_TOKEN]
     else: unk_id = -1
 
-    for i, doc in enumerate(dataset):
-        # tokens to id
-        for j, sent in enumerate(doc.sentences):
-            for k, token in enumerate(sent):
-                if stop_words is not None and token in stop_words:
-                    dataset[i].sentences[j][k] = -1
-                    sp_num += 1
-                elif token in word_vocabulary:
-                    dataset[i].sentences[j][k] = word_vocabulary[token]
-                elif token.lower() in word_vocabulary:
-                    dataset[i].sentences[j][k] = word_vocabulary[token.lower()]
-                    lowers += 1
-                elif token.upper() in word_vocabulary:
-                    dataset[i].sentences[j][k] = word_vocabulary[token.upper()]
-                    raises += 1
-                else:
-                    dataset[i].sentences[j][k] = unk_id
-                    unks += 1
-                tokens += 1
+    # tokens of all documents as one flat array, with global sentence bounds
+    doc_starts = np.cumsum([0] + [len(doc.tokens) for doc in dataset], dtype=np.int64)
+    offsets = [np.asarray(doc.sent_offsets, dtype=np.int64) + doc_starts[i] for i, doc in enumerate(dataset)]
+    sent_starts = np.concatenate([o[:-1] for o in offsets] + [np.zeros(0, dtype=np.int64)])
+    sent_ends = np.concatenate([o[1:] for o in offsets] + [np.zeros(0, dtype=np.int64)])
+    doc_sents = np.cumsum([0] + [len(o) - 1 for o in offsets], dtype=np.int64)
+    token_index = {}
+    codes = np.fromiter((token_index.setdefault(t, len(token_index)) for doc in dataset for t in doc.tokens),
+                        dtype=np.int64, count=int(doc_starts[-1]))
+    type_ids, type_kinds = BuildTokenIdTable(word_vocabulary, list(token_index),
+                                             stop_words=stop_words, unk_id=unk_id)
+    token_ids = type_ids[codes]
+    kind_counts = np.bincount(type_kinds[codes], minlength=TOKEN_UNK+1)
+    tokens = len(codes)
+    sp_num, lowers, raises, unks = [int(kind_counts[k]) for k in [TOKEN_STOP, TOKEN_LOWER, TOKEN_UPPER, TOKEN_UNK]]
+
+    unk_m = 0
     # filter unk tokens if not assign id in vocab
     if unk_id == -1 or sp_num>0:
+        keep = token_ids != -1
+        # a token at flat position x moves to x - removed[x]
+        removed = np.concatenate(([0], np.cumsum(~keep)))
+        new_sent_starts = sent_starts - removed[sent_starts]
+        new_sent_ends = sent_ends - removed[sent_ends]
+        new_doc_starts = doc_starts - removed[doc_starts]
+        # new sents filter out unk at token level, empty sents are dropped
+        nonempty = new_sent_ends > new_sent_starts
+        empty = np.concatenate(([0], np.cumsum(~nonempty)))
+
+        mentions = [(i, m) for i, doc in enumerate(dataset) for m in doc.mentions if m._is_trainable]
+        doc_idx = np.array([i for i, _ in mentions], dtype=np.int64)
+        sent_idx = np.array([m._sent_idx for _, m in mentions], dtype=np.int64)
+        pos = np.array([m._pos_in_sent for _, m in mentions], dtype=np.int64)
+        length = np.array([m._mention_length for _, m in mentions], dtype=np.int64)
+        g_sent = doc_sents[doc_idx] + sent_idx
+        g_pos = sent_starts[g_sent] + pos
+        g_end = np.minimum(g_pos + length, sent_ends[g_sent])
+        in_empty = (~nonempty[g_sent]).tolist()
+        new_length = (length - (removed[g_end] - removed[g_pos])).tolist()
+        new_sent_idx = (sent_idx - (empty[g_sent] - empty[doc_sents[doc_idx]])).tolist()
+        new_pos = pos - (removed[g_pos] - removed[sent_starts[g_sent]])
+        new_start = (new_sent_starts[g_sent] - new_doc_starts[doc_idx] + new_pos).tolist()
+        new_pos = new_pos.tolist()
+        for k, (_, m) in enumerate(mentions):
+            if in_empty[k]:
+                m._is_trainable = False
+                continue
+            m._mention_length = new_length[k]
+            if new_length[k] == 0:
+                unk_m += 1
+                m._is_trainable = False
+                continue
+            m._sent_idx = new_sent_idx[k]
+            m._pos_in_sent = new_pos[k]
+            m._mention_start = new_start[k]
+            m._mention_end = new_start[k] + new_length[k]
+
+        # update doc tokens and sentence offsets by removing both unk token and empty sents
+        kept_ids = token_ids[keep].astype(np.int32)
         for i, doc in enumerate(dataset):
-            # new sents filter out unk at token level, keep empty sents
-            empty_sent_count = 0
-            empty_cumsum = []
-            new_sents = [[token for token in sent if token != -1] for sent in doc.sentences]
-            for sent in new_sents:
-                empty_cumsum.append(empty_sent_count)
-                if len(sent) == 0: empty_sent_count += 1
-
-            for j, mention in enumerate(doc.mentions):
-                if not mention._is_trainable: continue
-                sent = doc.sentences[mention._sent_idx]
-                if len(new_sents[mention._sent_idx]) == 0:
-                    dataset[i].mentions[j]._is_trainable = False
-                    continue
-                mt_unks = 0
-                for t in sent[mention._pos_in_sent:mention._pos_in_sent + mention._mention_length]:
-                    if t == -1: mt_unks += 1
-                if mt_unks > 0: dataset[i].mentions[j]._mention_length -= mt_unks
-
-                if dataset[i].mentions[j]._mention_length == 0:
-                    unk_m += 1
-                    dataset[i].mentions[j]._is_trainable = False
-                else:
-                    # update mention sent index by new sents
-                    empty_token_in_sent = 0
-                    for t in sent[:mention._pos_in_sent]:
-                        if t == -1: empty_token_in_sent += 1
-                    dataset[i].mentions[j]._sent_idx -= empty_cumsum[mention._sent_idx]
-                    dataset[i].mentions[j]._pos_in_sent -= empty_token_in_sent
-            # update doc sentences by removing both unk token and empty sents
-            dataset[i].sentences = [sent for sent in new_sents if len(sent) > 0]
-            # update mention offset of tokens
-            for j, mention in enumerate(doc.mentions):
-                dataset[i].mentions[j].updateTokenIdxBySentIdx()
-            # update doc tokens
-            doc.tokens = [t for s in dataset[i].sentences for t in s]
+            doc.tokens = kept_ids[new_doc_starts[i]:new_doc_starts[i+1]]
+            rows = slice(doc_sents[i], doc_sents[i+1])
+            starts = new_sent_starts[rows][nonempty[rows]]
+            ends = new_sent_ends[rows][nonempty[rows]]
+            doc.sent_offsets = np.concatenate(([new_doc_starts[i]], starts[1:], ends[-1:])) - new_doc_starts[i]
+    else:
+        token_ids = token_ids.astype(np.int32)
+        for i, doc in enumerate(dataset):
+            doc.tokens = token_ids[doc_starts[i]:doc_starts[i+1]]
+            doc.sent_offsets = offsets[i] - doc_starts[i]
+    stats.update(token_unk_mentions=unk_m, tokens=tokens, token_unks=unks, token_lowers=lowers,
+                 token_uppers=raises, token_stops=sp_num)
+    if log_stats: LogTokenStats(stats, logger)
+    return dataset
+
+def LogTokenStats(stats, logger):
+    tokens = stats['tokens']
     if logger:
         logger.Log("Unk mention:{}, Unk rate {:2.6f}%, downcase rate {:2.6f}%, upcase rate {:2.6f}%, stop rate {:2.6f}%".format(
-            unk_m, (unks * 100.0 / tokens), (lowers * 100.0 / tokens), (raises * 100.0 / tokens), (sp_num * 100.0 / tokens)))
-    return dataset
+            stats['token_unk_mentions'], (stats['token_unks'] * 100.0 / tokens), (stats['token_lowers'] * 100.0 / tokens),
+            (stats['token_uppers'] * 100.0 / tokens), (stats['token_stops'] * 100.0 / tokens)))
 
 def EntityToIDs(entity_vocabulary, dataset, sense_vocab=None,
-                include_unresolved=False, logger=None):
+                include_unresolved=False, logger=None, stats=None):
+    log_stats, stats = stats is None, _stepStats(stats)
 
     if UNK_ENTITY in CORE_ENTITY_VOCABULARY:
         unk_ent_id = CORE_ENTITY_VOCABULARY[UNK_ENTITY]
@@ -582,6 +781,15 @@ def EntityToIDs(entity_vocabulary, dataset, sense_vocab=None,
                 dataset[i].n_candidates += len(new_candidates)
                 # if rank>=0:
                 #    recordCandidates(A, rank, len(new_candidates))
+    stats.update(ent_mentions=m_num, ent_untrainable=m_unk, ent_candidates=c_num, ent_unk_candidates=c_unk,
+                 ent_nil=nil_num, ent_unk_gold=g_unk, ent_no_gold_candidate=no_gold_cand)
+    if log_stats: LogEntityStats(stats, logger)
+    return dataset
+
+def LogEntityStats(stats, logger):
+    m_num, m_unk = stats['ent_mentions'], stats['ent_untrainable']
+    c_num, c_unk = stats['ent_candidates'], stats['ent_unk_candidates']
+    no_gold_cand, g_unk, nil_num = stats['ent_no_gold_candidate'], stats['ent_unk_gold'], stats['ent_nil']
     if logger:
         # avg rank
         # statsCandidates(A, logger=logger)
@@ -594,30 +802,20 @@ def EntityToIDs(entity_vocabulary, dataset, sense_vocab=None,
                (no_gold_cand * 100.0/m_num), no_gold_cand, m_num,
                 (g_unk * 100.0 / m_num), g_unk, m_num,
                 (nil_num * 100.0 / m_num), nil_num, m_num))
-    return dataset
 
-def CropMentionAndCandidates(dataset, max_candidates, allow_cropping=True, logger=None):
+def CropMentionAndCandidates(dataset, max_candidates, allow_cropping=True, logger=None, stats=None):
+    log_stats, stats = stats is None, _stepStats(stats)
     raw_doc_num = len(dataset)
     # over mention-candidate_pairs size that may be cropped
     if max_candidates > 0:
         cropped_dataset = [doc for doc in dataset if doc.n_candidates <= max_candidates]
 
         diff_doc = raw_doc_num - len(cropped_dataset)
+        stats['crop_docs'] += diff_doc
 
         if not allow_cropping:
-            if logger and diff_doc > 0:
-                logger.Log(
-                    "Discarding " +
-                    str(diff_doc) +
-                    " candidate over-length documents.")
             dataset = cropped_dataset
         else:
-            if logger and diff_doc > 0:
-                logger.Log(
-                    "Cropping " +
-                    str(diff_doc) +
-                    " candidate over-length documents.")
-
             cropped_m = 0
             cropped_d = 0
 
@@ -639,17 +837,30 @@ def CropMentionAndCandidates(dataset, max_candidates, allow_cropping=True, logge
                         dataset[i].n_candidates -= tmp_clen
                     if p == len(c2s_ms)-1 : dataset[i].n_candidates = 0
 
-            logger.Log("Actual cropped {} mentions of {} documents! ".format(cropped_m, cropped_d))
+            stats['crop_mentions'] += cropped_m
+            stats['crop_cropped_docs'] += cropped_d
 
     dataset = [doc for doc in dataset if doc.n_candidates > 0]
     for i, doc in enumerate(dataset):
         # filter out cannot trainable mentions
         dataset[i].mentions = [mention for mention in doc.mentions if mention._is_trainable]
 
-    logger.Log("Remove {} docs!".format(raw_doc_num - len(dataset)))
-
+    stats['crop_removed_docs'] += raw_doc_num - len(dataset)
+    if log_stats: LogCropStats(stats, max_candidates, allow_cropping=allow_cropping, logger=logger)
     return dataset
 
+def LogCropStats(stats, max_candidates, allow_cropping=True, logger=None):
+    if max_candidates > 0:
+        if logger and stats['crop_docs'] > 0:
+            logger.Log(
+                ("Cropping " if allow_cropping else "Discarding ") +
+                str(stats['crop_docs']) +
+                " candidate over-length documents.")
+        if allow_cropping:
+            logger.Log("Actual cropped {} mentions of {} documents! ".format(
+                stats['crop_mentions'], stats['crop_cropped_docs']))
+    logger.Log("Remove {} docs!".format(stats['crop_removed_docs']))
+
 # adj : node * node
 def PadDocument(
         x, adj, y,
@@ -672,12 +883,56 @@ def PadDocument(
         y = np.concatenate((y, pad), axis=0)
         tmp_adj = np.zeros((length, length))
         node_num = adj.shape[0]
-        for i in range(node_num):
-            for j in range(node_num):
-                tmp_adj[i][j] = adj[i][j]
+        tmp_adj[:node_num, :node_num] = adj
         adj = tmp_adj
     return x, adj, y
 
+# graph : CSR arrays (indptr, indices, data) of buildSparseGraph
+def PackDocuments(xs, graphs, ys):
+    """Stacks the nodes of all documents instead of padding them to one
+    length, the graphs become one block diagonal CSR adjacency. Nodes of
+    document k are offsets[k]:offsets[k+1]."""
+    offsets = np.cumsum([0] + [x.shape[0] for x in xs], dtype=np.int64)
+    edge_offsets = np.cumsum([0] + [len(g[1]) for g in graphs], dtype=np.int64)
+    indptr = np.concatenate([np.zeros(1, dtype=np.int64)] +
+                            [g[0][1:] + edge_offsets[k] for k, g in enumerate(graphs)])
+    indices = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                             [g[1] + offsets[k] for k, g in enumerate(graphs)])
+    data = np.concatenate([np.zeros(0, dtype=np.float32)] + [g[2] for g in graphs])
+    return np.concatenate(xs), (indptr, indices, data), np.concatenate(ys), offsets
+
+# documents per job of a preprocessing worker
+PREPROCESS_CHUNK_DOCS = 256
+
+# workers are forked, so they inherit the raw documents, vocabularies and handlers
+_preprocess_job = None
+
+def _preprocessChunk(bounds):
+    dataset, kwargs = _preprocess_job
+    string_features = kwargs['feature_manager'].string_features
+    string_features.takeNew()
+    stats = Counter()
+    docs = _preprocessDocuments(dataset[bounds[0]:bounds[1]], stats=stats, **kwargs)
+    # string features computed here go back to the cache of the parent
+    return docs, stats, string_features.takeNew()
+
+# every step below only looks at one document at a time
+def _preprocessDocuments(dataset, vocabulary, max_tokens, max_candidates, feature_manager,
+                         stop_words, include_unresolved, allow_cropping, candidate_handler, topn, stats):
+    word_vocab, entity_vocab, sense_vocab, _ = vocabulary
+    if candidate_handler is not None:
+        AddCandidatesToDocs(dataset, candidate_handler, vocab=entity_vocab, topn=topn, stats=stats)
+    dataset = TokensToIDs(word_vocab, dataset, stop_words=stop_words, stats=stats)
+
+    dataset = TrimDataset(dataset, max_tokens, allow_cropping=allow_cropping, stats=stats)
+
+    dataset = EntityToIDs(entity_vocab, dataset, sense_vocab=sense_vocab,
+                          include_unresolved=include_unresolved, stats=stats)
+    dataset = CropMentionAndCandidates(dataset, max_candidates, stats=stats)
+    # inspectDoc(dataset[0], word_vocab=word_vocabulary)
+    feature_manager.setBaseFeatures(dataset, stats=stats)
+    return dataset
+
 # process raw data
 def PreprocessDataset(
         dataset,
@@ -689,59 +944,93 @@ def PreprocessDataset(
         stop_words={},
         logger=None,
         include_unresolved=False,
-        allow_cropping=False):
-
-    _, entity_embeddings, _, _ = embeddings
-    word_vocab, entity_vocab, sense_vocab, _ = vocabulary
-    dataset = TokensToIDs(word_vocab, dataset, stop_words=stop_words, logger=logger)
-
-    dataset = TrimDataset(dataset, max_tokens, allow_cropping=allow_cropping, logger=logger)
-
-    dataset = EntityToIDs(entity_vocab, dataset, sense_vocab=sense_vocab,
-                          include_unresolved=include_unresolved, logger=logger)
-    dataset = CropMentionAndCandidates(dataset, max_candidates, logger=logger)
-    # inspectDoc(dataset[0], word_vocab=word_vocabulary)
-    for i, doc in enumerate(dataset):
-        feature_manager.setBaseFeature(dataset[i])
+        allow_cropping=False,
+        candidate_handler=None,
+        topn=0,
+        num_workers=1):
+    """Candidates (if a handler is given), token and entity ids, cropping and
+    base features. With num_workers > 1, chunks of documents are preprocessed
+    in worker processes and the counts of every step are summed before logging."""
+    kwargs = dict(vocabulary=vocabulary, max_tokens=max_tokens, max_candidates=max_candidates,
+                  feature_manager=feature_manager, stop_words=stop_words,
+                  include_unresolved=include_unresolved, allow_cropping=allow_cropping,
+                  candidate_handler=candidate_handler, topn=topn)
+    stats = Counter()
+    try:
+        context = multiprocessing.get_context('fork') if num_workers > 1 else None
+    except ValueError:
+        context = None
+    if context is not None and len(dataset) > PREPROCESS_CHUNK_DOCS:
+        global _preprocess_job
+        bounds = [(start, min(start + PREPROCESS_CHUNK_DOCS, len(dataset)))
+                  for start in range(0, len(dataset), PREPROCESS_CHUNK_DOCS)]
+        _preprocess_job = (dataset, kwargs)
+        try:
+            with context.Pool(num_workers) as pool:
+                dataset = []
+                for docs, chunk_stats, string_features in pool.imap(_preprocessChunk, bounds):
+                    dataset.extend(docs)
+                    stats.update(chunk_stats)
+                    feature_manager.string_features.update(string_features)
+        finally:
+            _preprocess_job = None
+        # base features were set in the workers
+        if feature_manager.base_feature_dim is None:
+            feature_manager.base_feature_dim = next((len(c.getBaseFeature()) for doc in dataset
+                                                     for m in doc.mentions for c in m.candidates), None)
+    else:
+        dataset = _preprocessDocuments(dataset, stats=stats, **kwargs)
+
+    if candidate_handler is not None:
+        LogCandidateStats(stats, logger)
+    LogTokenStats(stats, logger)
+    LogTrimStats(stats, max_tokens, allow_cropping=allow_cropping, logger=logger)
+    LogEntityStats(stats, logger)
+    LogCropStats(stats, max_candidates, logger=logger)
+    LogStringFeatureStats(stats, logger)
     if logger is not None:
         logger.Log("After crop and filter: totally {} candidates of {} mentions in {} documents!".format(
             sum([doc.n_candidates for doc in dataset]), sum([len(doc.mentions) for doc in dataset]), len(dataset)))
     return np.array(dataset)
 
+# one epoch of batch indices, shuffled and grouped by mention size
+def BuildSmartBatches(sources, batch_size):
+    dataset_size = len(sources)
+    order = list(range(dataset_size))
+    random.shuffle(order)
+    order = np.array(order)
+
+    num_splits = 10  # TODO: Should we be smarter about split size?
+    order_limit = len(order) // num_splits * num_splits
+    order = order[:order_limit]
+    order_splits = np.split(order, num_splits)
+    batches = []
+
+    for split in order_splits:
+        # Put indices into buckets based on candidate size.
+        keys = []
+        for i in split:
+            n_mentions = len(sources[i].mentions)
+            keys.append((i, n_mentions))
+        keys = sorted(keys, key=lambda __key: __key[1])
+
+        # Group indices from buckets into batches, so that
+        # examples in each batch have similar length.
+        batch = []
+        for i, _ in keys:
+            batch.append(i)
+            if len(batch) == batch_size:
+                batches.append(batch)
+                batch = []
+    return batches
+
 def MakeTrainingIterator(
         sources,
         batch_size,
         smart_batches=True):
 
     def build_batches():
-        dataset_size = len(sources)
-        order = list(range(dataset_size))
-        random.shuffle(order)
-        order = np.array(order)
-
-        num_splits = 10  # TODO: Should we be smarter about split size?
-        order_limit = len(order) // num_splits * num_splits
-        order = order[:order_limit]
-        order_splits = np.split(order, num_splits)
-        batches = []
-
-        for split in order_splits:
-            # Put indices into buckets based on candidate size.
-            keys = []
-            for i in split:
-                n_mentions = len(sources[i].mentions)
-                keys.append((i, n_mentions))
-            keys = sorted(keys, key=lambda __key: __key[1])
-
-            # Group indices from buckets into batches, so that
-            # examples in each batch have similar length.
-            batch = []
-            for i, _ in keys:
-                batch.append(i)
-                if len(batch) == batch_size:
-                    batches.append(batch)
-                    batch = []
-        return batches
+        return BuildSmartBatches(sources, batch_size)
 
     def batch_iter():
         batches = build_batches()
@@ -1,16 +1,48 @@
 # -*- coding: utf-8 -*-
+import numpy as np
 
+# ndarray slices of mapped tokens come back as lists like the raw string tokens
+def _tokenList(tokens):
+    return tokens.tolist() if isinstance(tokens, np.ndarray) else tokens
+
+# documents, mentions and candidates exist in the millions, __slots__ drops their per instance dicts
 class Document:
+    __slots__ = ('name', 'id', 'n_candidates', 'total_mentions', 'mentions', 'tokens', 'sent_offsets',
+                 'base_features')
+
     def __init__(self, doc_name, doc_id):
         self.name = doc_name
         self.id = doc_id
         self.n_candidates = 0
         self.total_mentions = 0
         self.mentions = []
+        # one flat token sequence, an int32 id array once mapped by TokensToIDs,
+        # sentence i is tokens[sent_offsets[i]:sent_offsets[i+1]]
         self.tokens = []
-        self.sentences = []
+        self.sent_offsets = [0]
+        # float32 candidates * base_feature_dim, usually shared by the documents of a dataset
+        self.base_features = None
+
+    # closes a sentence with the tokens appended since the last one
+    def endSentence(self):
+        self.sent_offsets.append(len(self.tokens))
+
+    def numSentences(self):
+        return len(self.sent_offsets) - 1
+
+    def sentence(self, i):
+        return _tokenList(self.tokens[self.sent_offsets[i]:self.sent_offsets[i+1]])
+
+    @property
+    def sentences(self):
+        return [self.sentence(i) for i in range(self.numSentences())]
 
 class Mention:
+    __slots__ = ('_document', '_mention_start', '_mention_end', '_gold_ent_id', '_gold_ent_str',
+                 '_gold_sense_id', '_mention_length', '_mention_str', '_sent_idx', '_pos_in_sent',
+                 '_gold_foreign_str', '_gold_foreign_id', 'candidates', 'context_emb',
+                 '_is_trainable', '_is_NIL')
+
     def __init__(self, document, mention_start, mention_end, gold_ent_id=None,
                  gold_ent_str=None, is_NIL = False):
         self._document = document
@@ -49,22 +81,20 @@ class Mention:
         self._mention_length = self._mention_end - self._mention_start
 
     def updateSentIdxByTokenIdx(self):
-        token_count = 0
-        for i, sent in enumerate(self._document.sentences):
-            if token_count + len(sent) >= self._mention_end :
-                self._sent_idx = i
-                self._pos_in_sent = self._mention_start - token_count
-                break
-            token_count += len(sent)
+        # first sentence ending at or after the mention end
+        offsets = self._document.sent_offsets
+        i = int(np.searchsorted(offsets[1:], self._mention_end, side='left'))
+        if i < len(offsets) - 1:
+            self._sent_idx = i
+            self._pos_in_sent = self._mention_start - int(offsets[i])
 
     def updateTokenIdxBySentIdx(self):
-        offset = sum([len(sent) for sent in self._document.sentences[:self._sent_idx]])
-        self._mention_start = offset + self._pos_in_sent
+        self._mention_start = int(self._document.sent_offsets[self._sent_idx]) + self._pos_in_sent
         self._mention_end = self._mention_start + self._mention_length
 
     def getSent(self):
         if isinstance(self._sent_idx, type(None)) : self.updateSentIdxByTokenIdx()
-        return self._document.sentences[self._sent_idx]
+        return self._document.sentence(self._sent_idx)
 
     def document(self):
         return self._document
@@ -79,39 +109,26 @@ class Mention:
         return ' '.join(self.mention_text_tokenized())
 
     def mention_text_tokenized(self):
-        return self.document().tokens[self._mention_start: self._mention_end]
-
-    def left_context(self, max_len=None, split_by_sent=True):
-        l = [t for t in self.left_context_iter(split_by_sent=split_by_sent)]
-        l = l if max_len is None or len(l) <= max_len else l[0:max_len]
-        l.reverse()
-        return l
+        return _tokenList(self.document().tokens[self._mention_start: self._mention_end])
 
-    def left_context_iter(self, split_by_sent=True):
+    # token bounds of the mention context, its sentence or the whole document
+    def _contextBounds(self, split_by_sent):
+        doc = self.document()
         if split_by_sent:
-            context = self.document().sentences[self._sent_idx]
-            start = self._pos_in_sent
-        else:
-            context = self.document().tokens
-            start = self._mention_start
-        if start > 0:
-            for t in context[start - 1:: -1]:
-                yield t
+            lo = int(doc.sent_offsets[self._sent_idx])
+            hi = int(doc.sent_offsets[self._sent_idx + 1])
+            return lo, hi, lo + self._pos_in_sent, lo + self._pos_in_sent + self._mention_length
+        return 0, len(doc.tokens), self._mention_start, self._mention_end
 
-    def right_context(self, max_len=None, split_by_sent=True):
-        l = [t for t in self.right_context_iter(split_by_sent=split_by_sent)]
-        return l if max_len is None or len(l) <= max_len else l[0:max_len]
+    def left_context(self, max_len=None, split_by_sent=True):
+        lo, _, start, _ = self._contextBounds(split_by_sent)
+        if max_len is not None: lo = max(lo, start - max_len)
+        return _tokenList(self.document().tokens[lo:start]) if start > lo else []
 
-    def right_context_iter(self, split_by_sent=True):
-        if split_by_sent:
-            context = self.document().sentences[self._sent_idx]
-            end = self._pos_in_sent + self._mention_length
-        else:
-            context = self.document().tokens
-            end = self._mention_end
-        if end < len(context):
-            for t in context[end:]:
-                yield t
+    def right_context(self, max_len=None, split_by_sent=True):
+        _, hi, _, end = self._contextBounds(split_by_sent)
+        if max_len is not None: hi = min(hi, end + max_len)
+        return _tokenList(self.document().tokens[end:hi]) if end < hi else []
 
     def left_sent(self, max_len=None):
         l = [t for t in self.left_sent_iter()]
@@ -122,19 +139,20 @@ class Mention:
     # t is a list of tokens
     def left_sent_iter(self):
         if self._sent_idx-1 > 0:
-            for t in self.document().sentences[self._sent_idx-1:: -1]:
-                yield t
+            for i in range(self._sent_idx-1, -1, -1):
+                yield self.document().sentence(i)
 
     def right_sent(self, max_len=None):
         l = [t for t in self.right_sent_iter()]
         return l if max_len is None or len(l) <= max_len else l[0:max_len]
 
     def right_sent_iter(self):
-        if self._sent_idx+1 < len(self.document().sentences):
-            for t in self.document().sentences[self._sent_idx+1:]:
-                yield t
+        for i in range(self._sent_idx+1, self.document().numSentences()):
+            yield self.document().sentence(i)
 
 class Token:
+    __slots__ = ('text', 'pos')
+
     def __init__(self, text):
         self.text = text
         self.pos = None
\ No newline at end of file
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Compiled kernels, cached on disk by numba. Each kernel has a NumPy
+fallback, used when numba is missing and as the reference in
+benchmarks/bench_kernels.py."""
+import math
+
+import numpy as np
+from pyxdameraulevenshtein import normalized_damerau_levenshtein_distance
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# compiled eagerly for the given signatures, so with the on disk cache a new
+# process loads machine code instead of compiling on first call
+def _njit(*signatures):
+    if numba is None:
+        return lambda f: f
+    return numba.njit(list(signatures), cache=True, nogil=True)
+
+# code points of strings as one uint32 array, string k is codes[offsets[k]:offsets[k+1]]
+def packCodePoints(strings):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    if len(strings) > 0:
+        np.cumsum([len(s) for s in strings], out=offsets[1:])
+    codes = np.frombuffer(bytearray(''.join(strings).encode('utf-32-le', 'surrogatepass')), dtype=np.uint32)
+    return codes, offsets
+
+# optimal string alignment distances of pairs, the recurrence of pyxdameraulevenshtein.
+# bounds[k] >= 0 stops pair k at bounds[k] + 1 once it can't end within bounds[k]
+@_njit('void(uint32[::1], int64[::1], uint32[::1], int64[::1], int64[::1], int64[::1])')
+def _osaDistances(codes1, offsets1, codes2, offsets2, bounds, out):
+    max_len = 0
+    for k in range(len(out)):
+        max_len = max(max_len, offsets1[k+1] - offsets1[k], offsets2[k+1] - offsets2[k])
+    two_ago = np.empty(max_len + 1, dtype=np.int64)
+    one_ago = np.empty(max_len + 1, dtype=np.int64)
+    this_row = np.empty(max_len + 1, dtype=np.int64)
+    for k in range(len(out)):
+        s1, e1, s2, e2 = offsets1[k], offsets1[k+1], offsets2[k], offsets2[k+1]
+        # a common prefix costs nothing
+        while s1 < e1 and s2 < e2 and codes1[s1] == codes2[s2]:
+            s1 += 1
+            s2 += 1
+        a, b = codes1, codes2
+        if e2 - s2 < e1 - s1:
+            a, b = codes2, codes1
+            s1, e1, s2, e2 = s2, e2, s1, e1
+        n1 = e1 - s1
+        n2 = e2 - s2
+        bound = bounds[k]
+        # the distance is at least the length difference
+        if bound >= 0 and n2 - n1 > bound:
+            out[k] = bound + 1
+            continue
+        for j in range(n2 + 1):
+            one_ago[j] = j
+        dist = n2
+        for i in range(n1):
+            this_row[0] = i + 1
+            row_min = n2 + n1
+            ai = a[s1 + i]
+            for j in range(1, n2 + 1):
+                bj = b[s2 + j - 1]
+                cost = one_ago[j-1] + (1 if ai != bj else 0)
+                cost = min(cost, one_ago[j] + 1, this_row[j-1] + 1)
+                # transposition
+                if i > 0 and j > 1 and ai != bj and ai == b[s2 + j - 2] and a[s1 + i - 1] == bj:
+                    cost = min(cost, two_ago[j-2] + 1)
+                this_row[j] = cost
+                row_min = min(row_min, cost)
+            if bound >= 0 and row_min > bound:
+                dist = bound + 1
+                break
+            two_ago, one_ago, this_row = one_ago, this_row, two_ago
+            dist = one_ago[n2]
+        if bound >= 0 and dist > bound:
+            dist = bound + 1
+        out[k] = dist
+
+def normalizedDamerauLevenshtein(seqs1, seqs2, max_distance=None):
+    """normalized_damerau_levenshtein_distance(seqs1[k], seqs2[k]) of every
+    pair in one call, over strings packed as code point arrays. As in the
+    library, with max_distance a pair that can't end within it stops early and
+    comes back as a value greater than max_distance."""
+    assert len(seqs1) == len(seqs2)
+    codes1, offsets1 = packCodePoints(seqs1)
+    codes2, offsets2 = packCodePoints(seqs2)
+    divisors = np.maximum(np.maximum(np.diff(offsets1), np.diff(offsets2)), 1)
+    if max_distance is None:
+        bounds = np.full(len(seqs1), -1, dtype=np.int64)
+    else:
+        bounds = (max_distance * divisors).astype(np.int64)
+    if numba is None:
+        return np.array([normalized_damerau_levenshtein_distance(seq1, seq2, max_distance=max_distance)
+                         for seq1, seq2 in zip(seqs1, seqs2)], dtype=np.float64)
+    out = np.empty(len(seqs1), dtype=np.int64)
+    _osaDistances(codes1, offsets1, codes2, offsets2, bounds, out)
+    return out / divisors
+
+_FLOAT_VECTORS = ['float64(float32[:], float32[:])', 'float64(float64[:], float64[:])']
+_FLOAT_MATRIX = ['float32[:, ::1](float32[:, :])', 'float64[:, ::1](float64[:, :])']
+
+# cosine of two vectors, 0 if either is near zero and clipped to [-1, 1]
+@_njit(*_FLOAT_VECTORS)
+def cosineSimilarity(v1, v2):
+    dot = 0.0
+    norm1 = 0.0
+    norm2 = 0.0
+    for k in range(v1.shape[0]):
+        dot += v1[k] * v2[k]
+        norm1 += v1[k] * v1[k]
+        norm2 += v2[k] * v2[k]
+    len_v1 = math.sqrt(norm1)
+    len_v2 = math.sqrt(norm2)
+    res = 0.0
+    if len_v1 > 0.000001 and len_v2 > 0.000001:
+        res = dot / len_v1 / len_v2
+    if math.isnan(res) or math.isinf(res) or res < -1:
+        res = -1.0
+    elif res > 1:
+        res = 1.0
+    return res
+
+def cosineSimilarityNumpy(v1, v2):
+    res = 0.0
+    len_v1 = math.sqrt(np.dot(v1, v1))
+    len_v2 = math.sqrt(np.dot(v2, v2))
+    if len_v1 > 0.000001 and len_v2 > 0.000001:
+        res = np.dot(v1, v2) / len_v1 / len_v2
+    if math.isnan(res) or math.isinf(res) or res < -1:
+        res = -1.0
+    elif res > 1: res = 1.0
+    return float(res)
+
+# transpose of D^-1/2 * mx * D^-1/2 with D the row sums, rows summing to zero or
+# less get zero weight
+@_njit(*_FLOAT_MATRIX)
+def normalizeAdjacency(mx):
+    n = mx.shape[0]
+    r_inv = np.zeros(n, dtype=mx.dtype)
+    for i in range(n):
+        rowsum = mx[i].sum()
+        if rowsum > 0 and not math.isinf(rowsum):
+            r_inv[i] = rowsum ** -0.5
+    out = np.empty((n, n), dtype=mx.dtype)
+    for i in range(n):
+        for j in range(n):
+            out[i, j] = mx[j, i] * r_inv[i] * r_inv[j]
+    return out
+
+def normalizeAdjacencyNumpy(mx):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_inv = np.power(mx.sum(1), -0.5)
+    r_inv[~np.isfinite(r_inv)] = 0.
+    return np.ascontiguousarray((mx * r_inv[None, :]).T * r_inv[None, :])
+
+# similarities of all node pairs, below thred set to zero, then normalized
+@_njit(*['{0}[:, ::1]({0}[:, :], {0})'.format(t) for t in ['float32', 'float64']])
+def fullGraph(embeds, thred):
+    adj = np.ascontiguousarray(embeds) @ np.ascontiguousarray(embeds.T)
+    for i in range(adj.shape[0]):
+        for j in range(adj.shape[1]):
+            if adj[i, j] < thred: adj[i, j] = 0
+    return normalizeAdjacency(adj)
+
+def fullGraphNumpy(embeds, thred):
+    adj = np.dot(embeds, embeds.transpose())
+    adj[adj < thred] = 0
+    return normalizeAdjacencyNumpy(adj)
+
+if numba is None:
+    cosineSimilarity, normalizeAdjacency, fullGraph = \
+        cosineSimilarityNumpy, normalizeAdjacencyNumpy, fullGraphNumpy
@@ -11,7 +11,8 @@ import torch.nn as nn
 from torch.nn.init import kaiming_normal, uniform
 
 import numpy as np
-import numba
+
+from ncel.utils.kernels import cosineSimilarity, fullGraph, normalizeAdjacency
 
 def the_gpu():
     return the_gpu.gpu
@@ -58,33 +59,30 @@ class GraphConvolutionNetwork(Module):
         if self.gc_ln:
             self.ln_inp = LayerNormalization(input_dim)
 
-        self._layers_dim = layers_dim
-        self._layers_dim.append(output_dim)
+        self._layers_dim = list(layers_dim) + [output_dim]
         self._num_layers = len(self._layers_dim)
         features_dim = input_dim
         for i in range(self._num_layers):
-            hidden_dim = layers_dim[i]
+            hidden_dim = self._layers_dim[i]
             setattr(self, 'l{}'.format(i), GraphConvolution(features_dim, hidden_dim, bias=bias))
-            setattr(self, 'd{}'.format(i), hidden_dim)
             features_dim = hidden_dim
 
+    # h: batch_size * node_num * input_dim with dense adj and mask: batch_size * node_num,
+    # or packed, h: node_num * input_dim with sparse adj and no mask
     def forward(self, h, adj, mask=None):
-        batch_size, node_num, feature_dim = h.size()
         if self.gc_ln:
             h = self.ln_inp(h)
         h = F.dropout(h, self.dropout_rate, training=self.training)
         for i in range(self._num_layers):
             layer = getattr(self, 'l{}'.format(i))
-            dim = getattr(self, 'd{}'.format(i))
             h = layer(h, adj)
             h = F.relu(h)
             if mask is not None:
-                mask = mask.unsqueeze(1).expand(batch_size, dim)
-                h = h * mask
+                h = h * mask.unsqueeze(-1).float()
         return h
 
     def reset_parameters(self):
-        for i in range(self.num_layers):
+        for i in range(self._num_layers):
             layer = getattr(self, 'l{}'.format(i))
             layer.reset_parameters()
 
@@ -185,9 +183,13 @@ class GraphConvolution(Module):
 
     # input: batch_size * node_num * in_features
     # adj : batch_size * node_num * node_num
+    # or packed, input: node_num * in_features, adj: sparse node_num * node_num
     def forward(self, input, adj):
         support = input.matmul(self.weight)
-        output = torch.bmm(adj, support)
+        if adj.is_sparse:
+            output = torch.sparse.mm(adj, support)
+        else:
+            output = torch.bmm(adj, support)
 
         if self.bias is not None:
             return output + self.bias
@@ -416,6 +418,41 @@ def Linear(initializer=kaiming_normal,
                 bias_initializer(self.bias)
     return CustomLinear
 
+EMBEDDING_QUANTIZATION = ["none", "float16", "int8"]
+
+class QuantizedEmbeddings(object):
+    """
+    Frozen embedding table kept as float16, or as int8 with a float32 scale
+    per row; only the rows gathered by take() are dequantized to float32.
+    """
+    def __init__(self, vectors, dtype="int8"):
+        assert dtype in EMBEDDING_QUANTIZATION[1:], "Unknown quantization {}!".format(dtype)
+        self.dtype = dtype
+        self.shape = vectors.shape
+        if dtype == "float16":
+            self.vectors = vectors.astype(np.float16)
+            self.scales = None
+        else:
+            # symmetric per-row scale, all-zero rows keep scale 1
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self.scales = scales.astype(np.float32)
+            self.vectors = np.rint(vectors / self.scales[:, None]).astype(np.int8)
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def take(self, indices, axis=0):
+        assert axis == 0, "Only rows can be gathered!"
+        rows = self.vectors.take(indices, axis=0).astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales.take(indices)[..., None]
+        return rows
+
+    def __getitem__(self, index):
+        return self.take(index)
+
 class Embed(nn.Module):
     def __init__(self, size, vocab_size, vectors, fine_tune=False):
         super(Embed, self).__init__()
@@ -439,59 +476,88 @@ class Embed(nn.Module):
                     volatile=tokens.volatile))
         return embeds
 
-@numba.autojit
+# the kernels are compiled for float32 and float64 arrays only
+def _floatArrays(*arrays):
+    arrays = [np.asarray(a) for a in arrays]
+    dtype = np.result_type(*arrays)
+    if dtype != np.float32: dtype = np.float64
+    return [a.astype(dtype, copy=False) for a in arrays]
+
 def cosSim(v1, v2):
-    res = 0
-    len_v1 = math.sqrt(np.dot(v1, v1))
-    len_v2 = math.sqrt(np.dot(v2, v2))
-    if len_v1 > 0.000001 and len_v2 > 0.000001:
-        res = np.dot(v1, v2) / len_v1 / len_v2
-        # res = (res + 1) / 2
-    if math.isnan(res) or math.isinf(res) or res < -1:
-        res = -1
-    elif res > 1 : res = 1
-    return res
+    return cosineSimilarity(*_floatArrays(v1, v2))
+
+# unit length candidate embeddings and mention ids of the nodes, zero vectors stay zero
+def _graphNodes(ids, embeddings, dtype=np.float64):
+    ids = np.asarray(ids)
+    embeds = np.asarray(embeddings.take(ids[:, 0].ravel(), axis=0), dtype=dtype)
+    norms = np.sqrt(np.einsum('ij,ij->i', embeds, embeds))
+    inv_norms = np.zeros_like(norms)
+    np.divide(1.0, norms, out=inv_norms, where=norms > 0.000001)
+    return embeds * inv_norms[:, None], ids[:, 1]
 
 # input all candidates in one document, return one graph much like self attention
 # todo: no mention group split
 def buildGraph(ids, embeddings, thred=0):
-    node_num = ids.shape[0]
-    adj = np.zeros((node_num, node_num))
-    # node * dim
-    embeds = embeddings.take(np.array([cid[0] for cid in ids]).ravel(), axis=0)
-
-    for i, ei in enumerate(embeds):
-        for j, ej in enumerate(embeds):
-            if i == j: adj[i][j] = 1.0
-            elif i > j or ids[i][1] == ids[j][1]: continue
-            else:
-                tmp_sim = cosSim(ei, ej)
-                if tmp_sim < thred : tmp_sim = 0
-                adj[i][j] = adj[j][i] = tmp_sim
-
+    # cosine of every pair, candidates of the same mention are not connected
+    units, mentions = _graphNodes(ids, embeddings)
+    adj = np.clip(units.dot(units.T), -1, 1)
+    adj[(adj < thred) | (mentions[:, None] == mentions[None, :])] = 0
+    np.fill_diagonal(adj, 1.0)
     adj = normalize(adj)
     return adj
 
+def buildSparseGraph(ids, embeddings, thred=0, topk=10, block_size=1024):
+    """buildGraph keeping the topk strongest edges of each node, plus the
+    edges pointing to it, as CSR arrays (indptr, indices, data). Similarities
+    are computed block_size rows at a time, so memory grows with the edges
+    rather than with node_num squared."""
+    units, mentions = _graphNodes(ids, embeddings, dtype=np.float32)
+    node_num = units.shape[0]
+    topk = min(topk, node_num - 1)
+    rows, cols, weights = [np.arange(node_num)], [np.arange(node_num)], [np.ones(node_num, dtype=np.float32)]
+    if topk > 0:
+        for start in range(0, node_num, block_size):
+            block = np.arange(start, min(start + block_size, node_num))
+            sim = units[block].dot(units.T)
+            np.clip(sim, -1, 1, out=sim)
+            np.copyto(sim, -np.inf, where=mentions[block, None] == mentions[None, :])
+            sim[np.arange(len(block)), block] = -np.inf
+            top = np.argpartition(sim, node_num - topk, axis=1)[:, node_num - topk:]
+            top_sim = np.take_along_axis(sim, top, axis=1)
+            # pairs below thred are only picked when fewer than topk are above it
+            keep = np.isfinite(top_sim) & (top_sim >= thred) & (top_sim != 0)
+            i, j, w = np.repeat(block, topk)[keep.ravel()], top[keep], top_sim[keep]
+            rows.extend([i, j])
+            cols.extend([j, i])
+            weights.extend([w, w])
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    # an edge kept by both ends appears twice
+    keys, first = np.unique(rows.astype(np.int64) * node_num + cols, return_index=True)
+    rows, cols, weights = keys // node_num, keys % node_num, weights[first]
+    # symmetric normalization D^-1/2 * adj * D^-1/2
+    rowsum = np.bincount(rows, weights=weights, minlength=node_num)
+    r_inv = np.zeros(node_num)
+    np.power(rowsum, -0.5, out=r_inv, where=rowsum > 0)
+    data = (weights * r_inv[rows] * r_inv[cols]).astype(np.float32)
+    indptr = np.zeros(node_num + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=node_num), out=indptr[1:])
+    return indptr, cols, data
+
+# CSR arrays of buildSparseGraph or PackDocuments as a torch sparse matrix
+def sparseAdjacency(indptr, indices, data):
+    node_num = len(indptr) - 1
+    rows = np.repeat(np.arange(node_num, dtype=np.int64), np.diff(indptr))
+    index = torch.from_numpy(np.stack([rows, np.asarray(indices, dtype=np.int64)]))
+    values = torch.from_numpy(np.asarray(data, dtype=np.float32))
+    return torch.sparse_coo_tensor(index, values, (node_num, node_num)).coalesce()
+
 # input all candidates in one document, return one graph much like self attention
-@numba.autojit
 def buildFullGraph(ids, embeddings, thred=0):
-    node_num = ids.shape[0]
     # node * dim
-    embeds = embeddings.take(np.array([cid[0] for cid in ids]).ravel(), axis=0)
-
-    adj = np.dot(embeds, embeds.transpose())
-    adj[ adj<thred ] = 0
-    adj = normalize(adj)
-    return adj
+    embeds, = _floatArrays(embeddings.take(np.array([cid[0] for cid in ids]).ravel(), axis=0))
+    return fullGraph(embeds, embeds.dtype.type(thred))
 
-@numba.autojit
 def normalize(mx):
     """Row-normalize sparse matrix"""
-    rowsum = np.array(mx.sum(1))
-    r_inv = np.power(rowsum, -0.5).flatten()
-    r_inv[np.isnan(r_inv)] = 0.
-    r_inv[np.isinf(r_inv)] = 0.
-    r_mat_inv = np.diag(r_inv)
-    mx = np.dot(mx, r_mat_inv)
-    norm_mx = np.dot(mx.transpose(), r_mat_inv)
-    return norm_mx
\ No newline at end of file
+    mx, = _floatArrays(mx)
+    return normalizeAdjacency(mx)
\ No newline at end of file
@@ -86,6 +86,33 @@ def ComputeAccuracy(output, y, docs, include_unresolved=False):
 
     return total_mentions, actual_mentions, actual_correct
 
+class EntityInterner(object):
+    """Maps knowledge base id strings to dense ints, so candidate sets, redirect
+    maps and gold ids hold one small int per entity instead of its string."""
+
+    def __init__(self):
+        self._ids = {}
+        self.strings = []
+
+    def intern(self, entity):
+        id = self._ids.get(entity)
+        if id is None:
+            id = self._ids[entity] = len(self.strings)
+            self.strings.append(entity)
+        return id
+
+    def get(self, entity, default=None):
+        return self._ids.get(entity, default)
+
+    def internMap(self, vocab):
+        return dict([(self.intern(k), self.intern(v)) for k, v in vocab.items()])
+
+    def internKeys(self, vocab):
+        return dict([(self.intern(k), v) for k, v in vocab.items()])
+
+    def __len__(self):
+        return len(self.strings)
+
 # wiki_id \t wiki_label
 def loadWikiVocab(filename, id_vocab=None):
     label2id_map = {}
@@ -132,7 +159,7 @@ def inspectDoc(doc, word_vocab=None):
     print(sentences)
     for m in doc.mentions:
         if m._sent_idx is None : m.updateSentIdxByTokenIdx()
-        sent_ids = doc.sentences[m._sent_idx][m._pos_in_sent:m._pos_in_sent+m._mention_length]
+        sent_ids = doc.sentence(m._sent_idx)[m._pos_in_sent:m._pos_in_sent+m._mention_length]
         if not isinstance(word_vocab, type(None)):
             print("ment_str:{}, m_len:{}, m_pos:{}, m_sent_pos:{}.".format(m._mention_str, m._mention_length,
                  ' '.join(tokens[m._mention_start:m._mention_end]),
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import numba
 import numpy as np
 
 from ncel.utils.data import LoadEmbeddingsFromBinary
@@ -57,7 +56,6 @@ class ModelReader(object):
         vectors = [v for v in vectors if v is not None]
         return vectors
 
-    @numba.autojit
     def get_text_vector(self, vectors):
         if vectors is None or len(vectors) < 1:
             return None
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Preprocessed datasets stored as flat numpy arrays instead of pickled objects."""
+
+import os
+import hashlib
+
+import numpy as np
+
+from ncel.utils.document import Document, Mention
+from ncel.utils.Candidates import Candidate
+
+# bumped whenever the arrays written by SaveDatasetArrays change
+DATASET_ARRAYS_VERSION = 3
+
+# utf-8 blob, offsets and None mask of a list of optional strings
+def packStrings(strings):
+    encoded = [s.encode('utf-8') if s is not None else b'' for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if len(encoded) > 0:
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets, np.array([s is None for s in strings], dtype=bool)
+
+def unpackStrings(blob, offsets, is_none):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [None if is_none[i] else data[offsets[i]:offsets[i+1]].decode('utf-8')
+            for i in range(len(offsets) - 1)]
+
+def _saveStrings(arrays, name, strings):
+    arrays[name], arrays[name + '_offsets'], arrays[name + '_none'] = packStrings(strings)
+
+def _loadStrings(arrays, name):
+    return unpackStrings(arrays[name], arrays[name + '_offsets'], arrays[name + '_none'])
+
+def SaveDatasetArrays(path, dataset):
+    """Writes documents out of PreprocessDataset to one .npz file. Documents,
+    mentions, tokens and candidates are rows of flat arrays, with offset
+    arrays marking the rows of each parent."""
+    docs = list(dataset)
+    mentions = [m for doc in docs for m in doc.mentions]
+    candidates = [c for m in mentions for c in m.candidates]
+    base_dim = next((doc.base_features.shape[1] for doc in docs if doc.base_features is not None), 0)
+
+    arrays = {}
+    _saveStrings(arrays, 'doc_name', [doc.name for doc in docs])
+    arrays['doc_ints'] = np.array([[doc.id, doc.n_candidates, doc.total_mentions] for doc in docs],
+                                  dtype=np.int64).reshape(len(docs), 3)
+    arrays['doc_mentions'] = np.cumsum([0] + [len(doc.mentions) for doc in docs], dtype=np.int64)
+    # token ids and sentence offsets of all documents, each doc keeps its own offsets
+    arrays['doc_tokens'] = np.cumsum([0] + [len(doc.tokens) for doc in docs], dtype=np.int64)
+    arrays['doc_sent_offsets'] = np.cumsum([0] + [len(doc.sent_offsets) for doc in docs], dtype=np.int64)
+    arrays['token_id'] = np.concatenate([np.asarray(doc.tokens, dtype=np.int32) for doc in docs]
+                                        + [np.zeros(0, dtype=np.int32)])
+    arrays['sent_offsets'] = np.concatenate([np.asarray(doc.sent_offsets, dtype=np.int64) for doc in docs]
+                                            + [np.zeros(0, dtype=np.int64)])
+
+    arrays['mention_ints'] = np.array([[m._mention_start, m._mention_end, m._gold_ent_id, m._gold_sense_id,
+                                        m._mention_length, m._sent_idx, m._pos_in_sent, m._is_NIL]
+                                       for m in mentions], dtype=np.int64).reshape(len(mentions), 8)
+    arrays['mention_candidates'] = np.cumsum([0] + [len(m.candidates) for m in mentions], dtype=np.int64)
+    _saveStrings(arrays, 'mention_str', [m._mention_str for m in mentions])
+    _saveStrings(arrays, 'gold_ent_str', [m._gold_ent_str for m in mentions])
+    _saveStrings(arrays, 'gold_foreign_str', [m._gold_foreign_str for m in mentions])
+
+    arrays['candidate_ints'] = np.array([[c.id, c._sense_id, c._is_gold] for c in candidates],
+                                        dtype=np.int64).reshape(len(candidates), 3)
+    arrays['candidate_pem'] = np.array([c._pem for c in candidates], dtype=np.float64)
+    arrays['candidate_base'] = np.concatenate(
+        [doc.base_features[[c._base for m in doc.mentions for c in m.candidates]] for doc in docs
+         if doc.base_features is not None] + [np.zeros((0, base_dim), dtype=np.float32)]).astype(np.float32)
+    _saveStrings(arrays, 'candidate_label', [c.label for c in candidates])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        np.savez(fout, **arrays)
+    os.replace(tmp_path, path)
+
+def LoadDatasetArrays(path):
+    """Rebuilds the document array saved by SaveDatasetArrays."""
+    with np.load(path) as arrays:
+        arrays = dict(arrays)
+    doc_names = _loadStrings(arrays, 'doc_name')
+    mention_strs = _loadStrings(arrays, 'mention_str')
+    gold_ent_strs = _loadStrings(arrays, 'gold_ent_str')
+    gold_foreign_strs = _loadStrings(arrays, 'gold_foreign_str')
+    labels = _loadStrings(arrays, 'candidate_label')
+    doc_ints = arrays['doc_ints'].tolist()
+    doc_mentions = arrays['doc_mentions'].tolist()
+    doc_tokens = arrays['doc_tokens'].tolist()
+    doc_sent_offsets = arrays['doc_sent_offsets'].tolist()
+    token_id = arrays['token_id']
+    sent_offsets = arrays['sent_offsets']
+    mention_ints = arrays['mention_ints'].tolist()
+    mention_candidates = arrays['mention_candidates'].tolist()
+    candidate_ints = arrays['candidate_ints'].tolist()
+    candidate_pem = arrays['candidate_pem'].tolist()
+    candidate_base = arrays['candidate_base']
+
+    dataset = []
+    for i, name in enumerate(doc_names):
+        doc = Document(name, doc_ints[i][0])
+        doc.n_candidates, doc.total_mentions = doc_ints[i][1], doc_ints[i][2]
+        doc.base_features = candidate_base
+        doc.tokens = token_id[doc_tokens[i]:doc_tokens[i+1]]
+        doc.sent_offsets = sent_offsets[doc_sent_offsets[i]:doc_sent_offsets[i+1]]
+        for j in range(doc_mentions[i], doc_mentions[i+1]):
+            start, end, gold_ent_id, gold_sense_id, length, sent_idx, pos_in_sent, is_NIL = mention_ints[j]
+            m = Mention(doc, start, end, gold_ent_id=gold_ent_id, gold_ent_str=gold_ent_strs[j],
+                        is_NIL=bool(is_NIL))
+            m._gold_sense_id = gold_sense_id
+            m._mention_length = length
+            m._mention_str = mention_strs[j]
+            m._sent_idx = sent_idx
+            m._pos_in_sent = pos_in_sent
+            m._gold_foreign_str = gold_foreign_strs[j]
+            m.candidates = []
+            for k in range(mention_candidates[j], mention_candidates[j+1]):
+                c = Candidate(m, candidate_ints[k][0], label=labels[k])
+                c._sense_id = candidate_ints[k][1]
+                c._is_gold = bool(candidate_ints[k][2])
+                c._pem = candidate_pem[k]
+                c._base = k
+                m.candidates.append(c)
+            doc.mentions.append(m)
+        dataset.append(doc)
+    return np.array(dataset)
+
+def _updatePathStamp(sha, path):
+    if os.path.isdir(path):
+        for fname in sorted(os.listdir(path)):
+            _updatePathStamp(sha, os.path.join(path, fname))
+    elif os.path.exists(path):
+        st = os.stat(path)
+        sha.update("{}\t{}\t{}\n".format(os.path.abspath(path), st.st_size,
+                                         st.st_mtime_ns).encode('utf-8'))
+
+def DatasetFingerprint(settings, paths=(), vocabularies=()):
+    """sha1 over setting strings, the size and mtime of files (or all files
+    of directories) and the items of string keyed vocabularies."""
+    sha = hashlib.sha1()
+    for setting in settings:
+        sha.update("{}\n".format(setting).encode('utf-8'))
+    for path in paths:
+        if path is not None: _updatePathStamp(sha, path)
+    for vocab in vocabularies:
+        sha.update(b'vocab\n')
+        if vocab is None: continue
+        for k in sorted(vocab):
+            sha.update("{}\t{}\n".format(k, vocab[k]).encode('utf-8'))
+    return sha.hexdigest()
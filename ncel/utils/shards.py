@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Training data preprocessed into shards of documents, streamed while training."""
+
+import os
+import pickle
+import queue
+import random
+import threading
+
+from ncel.utils.data import BuildSmartBatches
+from ncel.utils.preprocessed import SaveDatasetArrays, LoadDatasetArrays
+
+# manifest of a shard directory:
+#   sources: fingerprint of the raw training data the stats were collected from
+#   words, mentions, gold_ids: vocabulary stats of the raw training documents
+#   preprocess: fingerprint of the vocabularies and settings the shards were built with
+#   shards: [(file_name, n_docs), ...]
+SHARD_MANIFEST = 'manifest.pkl'
+SHARD_FILE = 'shard-{:05d}.npz'
+
+def LoadShardManifest(shard_dir):
+    path = os.path.join(shard_dir, SHARD_MANIFEST)
+    if not os.path.isfile(path): return None
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
+
+def SaveShardManifest(shard_dir, manifest):
+    os.makedirs(shard_dir, exist_ok=True)
+    path = os.path.join(shard_dir, SHARD_MANIFEST)
+    with open(path + '.tmp', 'wb') as fout:
+        pickle.dump(manifest, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+def RemoveShards(shard_dir, manifest):
+    for fname, _ in manifest['shards']:
+        path = os.path.join(shard_dir, fname)
+        if os.path.exists(path): os.remove(path)
+    manifest['shards'] = []
+    manifest['preprocess'] = None
+
+def WriteShard(shard_dir, k, dataset):
+    fname = SHARD_FILE.format(k)
+    SaveDatasetArrays(os.path.join(shard_dir, fname), dataset)
+    return fname
+
+def ReadShard(path):
+    return LoadDatasetArrays(path)
+
+def ChunkDocuments(docs, shard_size):
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) == shard_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def MakeShardedTrainingIterator(
+        shard_paths,
+        batch_size,
+        smart_batches=True,
+        prefetch=2):
+    """Endless training batches over shards visited in a shuffled order per
+    epoch. A thread reads ahead at most prefetch shards, so besides them only
+    the shard being batched and the one being read are in memory."""
+    assert len(shard_paths) > 0, "No training shards!"
+    shards = queue.Queue(maxsize=max(prefetch, 1))
+
+    def read_shards():
+        rng = random.Random()
+        order = list(range(len(shard_paths)))
+        try:
+            while True:
+                rng.shuffle(order)
+                for k in order:
+                    shards.put(ReadShard(shard_paths[k]))
+        except Exception as e:
+            shards.put(e)
+
+    reader = threading.Thread(target=read_shards)
+    reader.daemon = True
+    reader.start()
+
+    def batch_iter():
+        # shards read since the last full batch, smart batches need ten per shard
+        empty_shards = 0
+        while True:
+            sources = shards.get()
+            if isinstance(sources, Exception):
+                raise sources
+            if smart_batches:
+                batches = BuildSmartBatches(sources, batch_size)
+                random.shuffle(batches)
+            else:
+                order = list(range(len(sources)))
+                random.shuffle(order)
+                batches = [order[start:start + batch_size]
+                           for start in range(0, len(order) - batch_size + 1, batch_size)]
+            empty_shards = empty_shards + 1 if len(batches) == 0 else 0
+            if empty_shards > len(shard_paths):
+                raise ValueError("Training shards are too small to fill a batch!")
+            for batch_indices in batches:
+                yield sources[batch_indices]
+
+    return batch_iter()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""String similarity base features of (candidate label, mention string) pairs."""
+
+import os
+import pickle
+from collections import OrderedDict
+
+from ncel.utils.kernels import normalizedDamerauLevenshtein
+
+# edit distance, is equal, mlabel contains clabel, clabel contains mlabel, mlabel starts
+# with clabel, clabel starts with mlabel, mlabel ends with clabel, clabel ends with mlabel
+STRING_FEATURE_DIM = 8
+
+def StringFeatures(pairs):
+    distances = normalizedDamerauLevenshtein([c_label for c_label, _ in pairs],
+                                             [m_label for _, m_label in pairs]).tolist()
+    return [(distance, c_label == m_label, c_label in m_label, m_label in c_label,
+             m_label.startswith(c_label), c_label.startswith(m_label),
+             m_label.endswith(c_label), c_label.endswith(m_label))
+            for distance, (c_label, m_label) in zip(distances, pairs)]
+
+class StringFeatureCache:
+    """Features of the max_size most recently used pairs. Popular entities are
+    candidates of many mentions, so most pairs repeat across documents, datasets
+    and, with a path to persist to, across runs."""
+    def __init__(self, max_size=1000000, path=None):
+        self._max_size = max_size
+        self._path = path
+        self._features = OrderedDict()
+        # pairs computed since the last takeNew, tracked once a forked worker
+        # asks for them to send back
+        self._new = None
+        if path is not None and os.path.isfile(path):
+            with open(path, 'rb') as fin:
+                self._features.update(pickle.load(fin))
+            self._evict()
+
+    def _evict(self):
+        while len(self._features) > self._max_size:
+            self._features.popitem(last=False)
+
+    def update(self, items):
+        self._features.update(items)
+        self._evict()
+
+    def takeNew(self):
+        new, self._new = self._new or [], []
+        return new
+
+    # features of every pair, only pairs neither cached nor repeated are computed
+    def features(self, pairs, stats=None):
+        found = {}
+        missing = []
+        for pair in dict.fromkeys(pairs):
+            value = self._features.get(pair)
+            if value is None:
+                missing.append(pair)
+            else:
+                self._features.move_to_end(pair)
+                found[pair] = value
+        computed = list(zip(missing, StringFeatures(missing)))
+        found.update(computed)
+        if self._new is not None: self._new.extend(computed)
+        self.update(computed)
+        if stats is not None:
+            stats['str_pairs'] += len(pairs)
+            stats['str_computed'] += len(missing)
+        return [found[pair] for pair in pairs]
+
+    def __len__(self):
+        return len(self._features)
+
+    def save(self):
+        if self._path is None: return
+        with open(self._path + '.tmp', 'wb') as fout:
+            pickle.dump(list(self._features.items()), fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self._path + '.tmp', self._path)
+
+def LogStringFeatureStats(stats, logger):
+    if logger and stats['str_pairs'] > 0:
+        logger.Log("String features of {} candidates, {} computed, cache hit rate {:2.6f}%".format(
+            stats['str_pairs'], stats['str_computed'],
+            (stats['str_pairs'] - stats['str_computed']) * 100.0 / stats['str_pairs']))
@@ -5,6 +5,16 @@ except ImportError:
     import xml.etree.ElementTree as ET
 
 import html
+import multiprocessing
+
+# raw files per task sent to a document worker
+DOC_CHUNKSIZE = 16
+
+# workers are forked, so they inherit the loader and its mention index
+_doc_handler = None
+
+def _parseDocumentFile(job):
+    return _doc_handler.parseDocumentFile(*job)
 
 class xmlHandler(object):
     def __init__(self, txt_elem_list, int_elem_list):
@@ -43,6 +53,24 @@ class xmlHandler(object):
                                 self.annotations.append(annotation)
                             path.pop()
 
+    # parses [(doc_name, file_path), ...] in a process pool, documents come back
+    # in job order and files without any mention as None
+    def parseDocumentFiles(self, jobs, num_workers):
+        global _doc_handler
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            for job in jobs:
+                yield self.parseDocumentFile(*job)
+            return
+        _doc_handler = self
+        try:
+            with context.Pool(num_workers) as pool:
+                for doc in pool.imap(_parseDocumentFile, jobs, chunksize=DOC_CHUNKSIZE):
+                    yield doc
+        finally:
+            _doc_handler = None
+
 class kbp10XmlHandler():
     def __init__(self, xml_file):
         self._xml_file = xml_file
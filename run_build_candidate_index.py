@@ -0,0 +1,34 @@
+import sys
+
+import gflags
+
+from ncel.utils.Candidates import CandidatesHandler
+from ncel.utils.misc import loadWikiVocab, loadRedirectVocab
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string("candidates_file", None, "type:file, use ',' to separate multiple files.")
+gflags.DEFINE_string("wiki_entity_vocab", None, "line: entity_label \t entity_id")
+gflags.DEFINE_string("wiki_redirect_vocab", None, "line: redirect_id \t entity_id")
+gflags.DEFINE_boolean("lowercase", False, "")
+gflags.DEFINE_boolean("support_fuzzy", True, "")
+gflags.DEFINE_integer("topn_candidate", 30, "Use all candidates if set 0.")
+gflags.DEFINE_integer("candidate_workers", 1, "Processes parsing each candidate file.")
+gflags.DEFINE_string("candidate_index", None, "Output directory of the compiled index.")
+
+if __name__ == '__main__':
+    # python run_build_candidate_index.py --candidates_file wiki_anchor:anchors.tsv,yago:yago.ttl
+    #   --wiki_entity_vocab wiki_vocab.tsv --candidate_index wiki_candidates
+    FLAGS(sys.argv)
+    wiki2id_vocab, id2wiki_vocab = loadWikiVocab(FLAGS.wiki_entity_vocab)
+    redirect_vocab = loadRedirectVocab(FLAGS.wiki_redirect_vocab) if FLAGS.wiki_redirect_vocab is not None else None
+    # no mention vocab, the index covers every mention in the sources
+    candidate_handler = CandidatesHandler(FLAGS.candidates_file, lowercase=FLAGS.lowercase,
+                                          id2label=id2wiki_vocab, label2id=wiki2id_vocab,
+                                          support_fuzzy=FLAGS.support_fuzzy,
+                                          redirect_vocab=redirect_vocab, topn=FLAGS.topn_candidate,
+                                          num_workers=FLAGS.candidate_workers)
+    candidate_handler.loadCandidates()
+    n_mentions, n_candidates = candidate_handler.saveCandidateIndex(FLAGS.candidate_index)
+    print("Compiled {} mentions with {} candidates to {}".format(n_mentions, n_candidates,
+                                                                  FLAGS.candidate_index))
@@ -0,0 +1,18 @@
+import sys
+
+import gflags
+
+from ncel.utils.data import ConvertBinaryEmbeddingFile
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string("embedding_file", None, "word2vec-style binary embedding file.")
+gflags.DEFINE_string("out_prefix", None, "Writes out_prefix.npy and out_prefix.vocab.")
+gflags.DEFINE_boolean("is_sense", False, "The input holds sense and mu vectors.")
+
+if __name__ == '__main__':
+    # python run_convert_embeddings.py --embedding_file vectors_sense1 --out_prefix vectors_sense1 --is_sense
+    FLAGS(sys.argv)
+    vocab_size, layer_size = ConvertBinaryEmbeddingFile(FLAGS.embedding_file, FLAGS.out_prefix,
+                                                        isSense=FLAGS.is_sense)
+    print("Converted {} vectors of size {} to {}.npy".format(vocab_size, layer_size, FLAGS.out_prefix))
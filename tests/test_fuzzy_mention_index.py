@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from ncel.utils.Candidates import CandidatesHandler
+from ncel.utils.candidate_index import FuzzyMentionIndex, SaveCandidateIndex, ALL_MENTIONS
+
+
+def test_exact_key_beats_farther_key_sorting_first():
+    index = FuzzyMentionIndex(['london', 'aondonx'], max_distance=2)
+    assert index.lookup('london') == 'london'
+
+
+def test_closer_key_beats_farther_key_sorting_first():
+    index = FuzzyMentionIndex(['londom', 'aondonx'], max_distance=2)
+    assert index.lookup('london') == 'londom'
+
+
+def test_equally_close_keys_pick_the_first_in_order():
+    index = FuzzyMentionIndex(['londob', 'londoa'], max_distance=1)
+    assert index.lookup('londox') == 'londoa'
+
+
+# more distance one variants of abcdefgh than a lookup checks
+def _variants():
+    letters = 'ijklmnopqrstuvwxyz'
+    variants = set()
+    for i in range(8):
+        for c in letters:
+            variants.add('abcdefgh'[:i] + c + 'abcdefgh'[i+1:])
+    return sorted(variants)[:129]
+
+
+def test_lookup_does_not_depend_on_the_order_of_mentions():
+    mentions = _variants()
+    expected = FuzzyMentionIndex(mentions, max_distance=1).lookup('abcdefgh')
+    rng = random.Random(0)
+    for _ in range(5):
+        rng.shuffle(mentions)
+        assert FuzzyMentionIndex(mentions, max_distance=1).lookup('abcdefgh') == expected
+
+
+def test_lookup_does_not_depend_on_the_hash_seed():
+    code = ("from ncel.utils.candidate_index import FuzzyMentionIndex\n"
+            "from tests.test_fuzzy_mention_index import _variants\n"
+            "print(FuzzyMentionIndex(_variants(), max_distance=1).lookup('abcdefgh'))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = set()
+    for seed in ['0', '1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=root)
+        results.add(subprocess.check_output([sys.executable, '-c', code], env=env, cwd=root))
+    assert len(results) == 1
+
+
+def test_fuzzy_lookups_refuse_an_index_of_all_mentions(tmp_path):
+    handler = CandidatesHandler(None, vocab={'london'}, fuzzy_distance=1)
+    settings = handler.indexSettings()
+    settings['mentions'] = ALL_MENTIONS
+    path = str(tmp_path / 'index')
+    SaveCandidateIndex(path, {'london': [['e1', 1.0]], 'londom': [['e2', 1.0]]}, settings=settings)
+    with pytest.raises(ValueError):
+        handler.loadCandidateIndex(path)